@@ -0,0 +1,152 @@
+"""
+Deterministic synthetic media corpus for benchmarks.
+
+    python -m benchmarks.corpus OUTPUT_DIR [--files N] [--seed S]
+
+Generates N images in mixed formats and sizes plus controlled fractions of
+exact duplicates, near duplicates (resized / re-encoded), corrupt and
+truncated files, small icons and fake MP4 blobs, spread over a few
+subdirectories. A manifest.json next to the files records what is what.
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_FRACTIONS = {
+    'exact_duplicate': 0.10,
+    'near_duplicate': 0.10,
+    'corrupt': 0.02,
+    'truncated': 0.02,
+    'icon': 0.03,
+    'video': 0.05,
+}
+FORMATS = (('.jpg', 'JPEG'), ('.png', 'PNG'), ('.bmp', 'BMP'), ('.gif', 'GIF'))
+FORMAT_WEIGHTS = (0.7, 0.15, 0.05, 0.1)
+SIZES = ((640, 480), (1280, 960), (1920, 1080), (3000, 2000))
+SUBDIRECTORIES = 8
+VIDEO_SIZES = (256 * 1024, 2 * 1024 * 1024, 6 * 1024 * 1024)
+MANIFEST_NAME = 'manifest.json'
+
+
+def synthetic_photo(rng, size):
+    """Upscaled coarse colour blocks plus noise: stable low frequencies like a real photo."""
+    coarse = Image.fromarray((rng.random((rng.integers(4, 12), rng.integers(4, 12), 3)) * 255).astype('uint8'))
+    base = np.asarray(coarse.resize(size, Image.Resampling.BICUBIC), dtype=np.float32)
+    noise = rng.normal(0, 8, base.shape).astype(np.float32)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype('uint8'))
+
+
+def save_image(img, path, pil_format):
+    if pil_format == 'GIF':
+        img = img.convert('P')
+    img.save(path, pil_format, **({'quality': 88} if pil_format == 'JPEG' else {}))
+
+
+def generate_corpus(output_dir, files=500, seed=0, fractions=None):
+    """Writes the corpus into output_dir and returns its manifest."""
+    fractions = dict(DEFAULT_FRACTIONS, **(fractions or {}))
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {kind: int(round(files * fraction)) for kind, fraction in fractions.items()}
+    counts['original'] = max(1, files - sum(counts.values()))
+
+    manifest = {'seed': seed, 'files': files, 'fractions': fractions, 'entries': []}
+    originals = []
+
+    def new_path(extension):
+        index = len(manifest['entries'])
+        directory = os.path.join(output_dir, f"dir_{index % SUBDIRECTORIES:02d}")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"file_{index:06d}{extension}")
+
+    def record(path, kind, source=None):
+        manifest['entries'].append({
+            'path': os.path.relpath(path, output_dir),
+            'kind': kind,
+            'source': os.path.relpath(source, output_dir) if source else None,
+        })
+
+    for _ in range(counts['original']):
+        extension, pil_format = FORMATS[rng.choice(len(FORMATS), p=FORMAT_WEIGHTS)]
+        path = new_path(extension)
+        save_image(synthetic_photo(rng, SIZES[rng.integers(len(SIZES))]), path, pil_format)
+        originals.append(path)
+        record(path, 'original')
+
+    for _ in range(counts['exact_duplicate']):
+        source = originals[rng.integers(len(originals))]
+        path = new_path(os.path.splitext(source)[1])
+        shutil.copyfile(source, path)
+        record(path, 'exact_duplicate', source)
+
+    for _ in range(counts['near_duplicate']):
+        source = originals[rng.integers(len(originals))]
+        path = new_path('.jpg')
+        with Image.open(source) as img:
+            scale = rng.uniform(0.5, 0.9)
+            resized = img.convert('RGB').resize((int(img.width * scale), int(img.height * scale)))
+            resized.save(path, 'JPEG', quality=int(rng.integers(60, 90)))
+        record(path, 'near_duplicate', source)
+
+    for _ in range(counts['corrupt']):
+        path = new_path('.jpg')
+        with open(path, 'wb') as f:
+            f.write(rng.bytes(int(rng.integers(2_000, 200_000))))
+        record(path, 'corrupt')
+
+    for _ in range(counts['truncated']):
+        source = originals[rng.integers(len(originals))]
+        path = new_path(os.path.splitext(source)[1])
+        with open(source, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        record(path, 'truncated', source)
+
+    for _ in range(counts['icon']):
+        path = new_path('.png')
+        icon = synthetic_photo(rng, (int(rng.integers(16, 128)),) * 2).convert('RGBA')
+        icon.putalpha(200)
+        icon.save(path, 'PNG')
+        record(path, 'icon')
+
+    videos = []
+    for _ in range(counts['video']):
+        if videos and rng.random() < 0.3:
+            source = videos[rng.integers(len(videos))]
+            path = new_path('.mp4')
+            shutil.copyfile(source, path)
+            record(path, 'video_duplicate', source)
+            continue
+        path = new_path('.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'\x00\x00\x00\x18ftypmp42' + rng.bytes(int(rng.choice(VIDEO_SIZES))))
+        videos.append(path)
+        record(path, 'video')
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def load_manifest(corpus_dir):
+    with open(os.path.join(corpus_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output_dir')
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    manifest = generate_corpus(args.output_dir, args.files, args.seed)
+    print(f"Wrote {len(manifest['entries'])} files to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
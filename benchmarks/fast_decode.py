@@ -0,0 +1,89 @@
+"""
+Compares full-resolution and draft-mode (reduced DCT scale) JPEG decoding
+for pHash computation: time per image and how far the hashes drift.
+
+    python -m benchmarks.fast_decode [folder] [--limit N]
+
+Without a folder, a few synthetic camera-sized JPEGs are generated first.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import dupchecker as DC
+
+SYNTHETIC_SIZE = (6000, 4000)
+
+
+def make_synthetic_jpegs(folder, count=8, size=SYNTHETIC_SIZE):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        # Upscaled coarse colour blocks plus sensor-like noise resemble photos
+        # far better than pure noise, which has no stable low frequencies.
+        coarse = Image.fromarray((rng.random((6 + i, 9 + i, 3)) * 255).astype('uint8'))
+        base = np.asarray(coarse.resize(size, Image.Resampling.BICUBIC), dtype=np.float32)
+        noise = rng.normal(0, 10, base.shape).astype(np.float32)
+        pixels = np.clip(base + noise, 0, 255).astype('uint8')
+        path = os.path.join(folder, f"synthetic_{i:03d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def iter_jpegs(folder, limit):
+    found = 0
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            if os.path.splitext(file_name)[1].lower() in {'.jpg', '.jpeg'}:
+                yield os.path.join(root, file_name)
+                found += 1
+                if found >= limit:
+                    return
+
+
+def time_hashes(paths, fast_decode):
+    start = time.perf_counter()
+    hashes = [DC.calculate_phash(path, fast_decode=fast_decode) for path in paths]
+    return hashes, time.perf_counter() - start
+
+
+def run(paths):
+    full_hashes, full_seconds = time_hashes(paths, fast_decode=False)
+    fast_hashes, fast_seconds = time_hashes(paths, fast_decode=True)
+
+    distances = [
+        (int(full, 16) ^ int(fast, 16)).bit_count()
+        for full, fast in zip(full_hashes, fast_hashes)
+        if full and fast
+    ]
+    count = len(paths)
+    print(f"Images: {count}")
+    print(f"Full decode:  {full_seconds / count * 1000:.1f} ms/image")
+    print(f"Draft decode: {fast_seconds / count * 1000:.1f} ms/image "
+          f"({full_seconds / fast_seconds:.1f}x faster)")
+    if distances:
+        print(f"pHash drift (Hamming bits): mean {np.mean(distances):.2f}, "
+              f"max {max(distances)}, identical {distances.count(0) / len(distances):.0%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', nargs='?')
+    parser.add_argument('--limit', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.folder:
+        run(list(iter_jpegs(args.folder, args.limit)))
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        print("Generating synthetic JPEGs...")
+        run(make_synthetic_jpegs(folder))
+
+
+if __name__ == '__main__':
+    main()
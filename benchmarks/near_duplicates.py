@@ -0,0 +1,73 @@
+"""
+Times MultiIndexHash.clusters and pairs on random pHashes at doubling sizes
+and reports how the time grows, so a return to quadratic bucket scans shows.
+
+    python -m benchmarks.near_duplicates [--sizes 10000 20000 ...] [--distance K]
+                                         [--max-exponent E] [--output report.json]
+
+The exponent is the log-log slope of time against size from the smallest to
+the largest size (1.0 is linear, 2.0 quadratic). With --max-exponent the run
+fails if either method grows faster.
+"""
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+
+import nearduplicates as ND
+
+DEFAULT_SIZES = (10000, 20000, 40000, 80000, 160000)
+
+
+def random_index(count, max_distance, seed=0):
+    index = ND.MultiIndexHash(max_distance)
+    hashes = np.random.default_rng(seed).integers(0, 1 << 63, count, dtype=np.int64).view(np.uint64) << np.uint64(1)
+    for key, hash_value in enumerate(hashes.tolist()):
+        index.add(key, hash_value)
+    return index
+
+
+def time_index(count, max_distance):
+    index = random_index(count, max_distance)
+    index.build()
+    start = time.perf_counter()
+    index.clusters()
+    clustered = time.perf_counter()
+    sum(1 for _ in index.pairs())
+    paired = time.perf_counter()
+    return {'clusters_s': round(clustered - start, 3), 'pairs_s': round(paired - clustered, 3)}
+
+
+def growth_exponent(results, key):
+    first, last = results[0], results[-1]
+    return math.log(max(last[key], 1e-6) / max(first[key], 1e-6)) / math.log(last['count'] / first['count'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark near-duplicate search scaling.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--distance', type=int, default=ND.DEFAULT_MAX_DISTANCE)
+    parser.add_argument('--max-exponent', type=float, help="Fail if time grows faster than size ** this")
+    parser.add_argument('--output', help="Write the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'hashes':>9} {'bands':>5} {'radius':>6} {'clusters s':>10} {'pairs s':>8}")
+    for count in sorted(args.sizes):
+        bands, radius = ND.split_bands(args.distance, count)
+        result = {'count': count, 'bands': len(bands), 'radius': radius, **time_index(count, args.distance)}
+        results.append(result)
+        print(f"{count:9d} {len(bands):5d} {radius:6d} {result['clusters_s']:10.3f} {result['pairs_s']:8.3f}")
+    exponents = {key: round(growth_exponent(results, key), 2) for key in ('clusters_s', 'pairs_s')}
+    print(f"Growth exponent: clusters {exponents['clusters_s']}, pairs {exponents['pairs_s']}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'distance': args.distance, 'results': results, 'exponents': exponents}, file, indent=2)
+    if args.max_exponent is not None and max(exponents.values()) > args.max_exponent:
+        raise SystemExit(f"Near-duplicate search grows faster than size ** {args.max_exponent}")
+
+
+if __name__ == '__main__':
+    main()
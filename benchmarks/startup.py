@@ -0,0 +1,152 @@
+"""
+Measures how long the toolchain takes to start: importing each module in a
+fresh interpreter, running light main.py subcommands, and bringing up a
+dupchecker worker pool (per multiprocessing start method) until every worker
+has hashed its first batch.
+
+    python -m benchmarks.startup [--runs N] [--workers N] [--output report.json]
+
+Import times are the best of --runs fresh interpreters minus a bare
+interpreter's startup; the heavy column lists which of HEAVY_MODULES the
+import dragged in.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('info', 'traverse', 'metrics', 'thumbcache', 'corruptfiles', 'dupchecker',
+           'pipeline', 'nearduplicates', 'mergeshards', 'workqueue', 'makemaster', 'split', 'main')
+HEAVY_MODULES = ('PIL.Image', 'numpy', 'scipy', 'imagehash')
+IMPORT_PROBE = (
+    "import importlib, json, sys; importlib.import_module({module!r}); "
+    "print(json.dumps([name for name in {heavy!r} if name in sys.modules]))"
+)
+
+
+def best_of(command, runs):
+    """Runs command (in the repo directory) runs times; returns (best seconds, last stdout)."""
+    best = None
+    output = ''
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(command, cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def time_imports(runs):
+    baseline, _ = best_of([sys.executable, '-c', 'pass'], runs)
+    imports = {}
+    for module in MODULES:
+        seconds, output = best_of([sys.executable, '-c', IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)], runs)
+        imports[module] = {'ms': round((seconds - baseline) * 1000, 1), 'heavy': json.loads(output)}
+    return round(baseline * 1000, 1), imports
+
+
+def time_commands(runs):
+    with tempfile.TemporaryDirectory() as empty_dir:
+        commands = {
+            'main.py --help': ['main.py', '--help'],
+            'main.py info': ['main.py', 'info', '--no-sizes', empty_dir],
+            'main.py corrupt --help': ['main.py', 'corrupt', '--help'],
+        }
+        return {
+            name: round(best_of([sys.executable] + args, runs)[0] * 1000, 1)
+            for name, args in commands.items()
+        }
+
+
+def first_batch(_):
+    import numpy as np
+
+    import dupchecker as DC
+
+    # Noise, not a flat image: flat ones take phash_batch's scipy fallback.
+    pixels = np.random.default_rng(0).integers(0, 256, (DC.PHASH_BATCH_SIZE, DC.PHASH_IMAGE_SIZE, DC.PHASH_IMAGE_SIZE))
+    DC.phash_batch(pixels.astype(np.uint8))
+    return os.getpid()
+
+
+def time_pool(method, workers):
+    """In this (fresh) process: seconds from creating the pool until every worker has hashed a batch."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    import dupchecker as DC
+
+    start = time.perf_counter()
+    pids = set()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                             initializer=DC.init_worker) as executor:
+        while len(pids) < workers:
+            pids.update(executor.map(first_batch, range(workers * 4)))
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def time_pools(workers, runs):
+    pools = {}
+    for method in multiprocessing.get_all_start_methods():
+        command = [sys.executable, '-m', 'benchmarks.startup', '--pool', method, '--workers', str(workers)]
+        best = min(
+            float(subprocess.run(command, cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout)
+            for _ in range(runs)
+        )
+        pools[method] = round(best * 1000, 1)
+    return pools
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--output', default='startup_report.json')
+    parser.add_argument('--pool', metavar='METHOD', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.pool:
+        print(time_pool(args.pool, args.workers))
+        return
+
+    baseline_ms, imports = time_imports(args.runs)
+    commands = time_commands(args.runs)
+    pools = time_pools(args.workers, max(1, args.runs // 2))
+    # Imported last: the suite pulls in every stage, and with them the heavy modules.
+    from benchmarks.suite import git_commit
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'interpreter_ms': baseline_ms,
+        'imports': imports,
+        'commands_ms': commands,
+        'workers': args.workers,
+        'pool_ms': pools,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"Bare interpreter: {baseline_ms:.1f} ms\n")
+    print(f"{'import':<16} {'ms':>8}  heavy")
+    for module, result in imports.items():
+        print(f"{module:<16} {result['ms']:>8.1f}  {', '.join(result['heavy']) or '-'}")
+    print(f"\n{'command':<24} {'ms':>8}")
+    for name, ms in commands.items():
+        print(f"{name:<24} {ms:>8.1f}")
+    print(f"\n{'pool start':<24} {'ms':>8}   ({args.workers} workers, until each hashed a batch)")
+    for method, ms in pools.items():
+        print(f"{method:<24} {ms:>8.1f}")
+    print(f"\nReport written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+Times each stage of the toolchain on a synthetic corpus and writes a JSON
+report that can be compared across commits.
+
+    python -m benchmarks.suite [--files N] [--seed S] [--corpus DIR]
+                               [--output report.json] [--compare old.json]
+
+Stages: walk, decode, check (tiered corruptfiles check), hash, db_insert,
+copy and split. Each records files/s, MB/s, per-file latency percentiles
+(where meaningful) and the process's peak RSS so far.
+Everything runs in one process so numbers reflect per-core throughput; for
+the same reason the RSS figure is a high-water mark over all stages up to
+and including this one, not the stage's own peak.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import corruptfiles as CF
+import dupchecker as DC
+import materialize as MAT
+import pipeline as PL
+import split as SPL
+import traverse as TRV
+from benchmarks import corpus as CORPUS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mb():
+    """The process's peak RSS since it started (ru_maxrss never goes down)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stage:
+    """Collects timing for one benchmark stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.latencies = []
+        self.start = None
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        return False
+
+    def timed(self, function, *args, size=0):
+        start = time.perf_counter()
+        result = function(*args)
+        self.latencies.append(time.perf_counter() - start)
+        self.files += 1
+        self.bytes += size
+        return result
+
+    def report(self):
+        seconds = self.seconds or 1e-9
+        result = {
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 4),
+            'files_per_s': round(self.files / seconds, 1),
+            'mb_per_s': round(self.bytes / 1e6 / seconds, 1),
+            'cumulative_peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        if self.latencies:
+            latencies_ms = np.array(self.latencies) * 1000
+            result['latency_ms'] = {
+                f"p{q}": round(float(np.percentile(latencies_ms, q)), 3) for q in (50, 90, 99)
+            }
+            result['latency_ms']['max'] = round(float(latencies_ms.max()), 3)
+        return result
+
+
+def run_stages(corpus_dir, work_dir, video_hash=DC.VIDEO_HASH_ALGORITHM):
+    stages = {}
+    video_algorithm = DC.resolve_hash_algorithm(video_hash)
+
+    with Stage('walk') as stage:
+        entries = []
+        for path, name, size, mtime_ns, inode in TRV.walk(corpus_dir):
+            stage.files += 1
+            stage.bytes += size
+            entries.append((path, size, mtime_ns, inode))
+    stages['walk'] = stage.report()
+
+    images = [entry for entry in entries if os.path.splitext(entry[0])[1].lower() in PL.ANALYZED_IMAGE_EXTENSIONS]
+    videos = [entry for entry in entries if os.path.splitext(entry[0])[1].lower() in DC.VIDEO_EXTENSIONS]
+
+    with Stage('decode') as stage:
+        for entry in images:
+            stage.timed(CF.inspect_image, entry[0], size=entry[1])
+    stages['decode'] = stage.report()
+
+    with Stage('check') as stage:
+        for entry in images:
+            stage.timed(CF.check_image, entry[0], size=entry[1])
+    stages['check'] = stage.report()
+
+    rows = []
+    with Stage('hash') as stage:
+        hashable = [entry for entry in images if os.path.splitext(entry[0])[1].lower() in DC.IMAGE_EXTENSIONS]
+        for batch in DC.chunked(hashable, 32):
+            start = time.perf_counter()
+            results = DC.process_image_batch(batch)
+            per_file = (time.perf_counter() - start) / len(batch)
+            stage.latencies.extend([per_file] * len(batch))
+            stage.files += len(batch)
+            stage.bytes += sum(entry[1] for entry in batch)
+            rows.extend(result for result in results if result)
+        for entry in videos:
+            digest = stage.timed(DC.calculate_mhash, entry[0], video_algorithm, size=entry[1])
+            rows.append(('video_hashes', os.path.basename(entry[0]), entry[0], digest) + entry[1:] + ('full', video_algorithm, None))
+    stages['hash'] = stage.report()
+
+    db_name = os.path.join(work_dir, 'bench.db')
+    conn = DC.initialize_database(db_name)
+    try:
+        with Stage('db_insert') as stage:
+            writer = DC.DatabaseWriter(db_name, bulk=DC.is_fresh_database(conn))
+            for row in rows:
+                stage.files += 1
+                writer.put(row[0], row[1:])
+            writer.close()
+        stages['db_insert'] = stage.report()
+    finally:
+        conn.close()
+
+    copy_dir = os.path.join(work_dir, 'copy')
+    os.makedirs(copy_dir)
+    with Stage('copy') as stage:
+        pairs = [(entry[0], os.path.join(copy_dir, f"{index:06d}{os.path.splitext(entry[0])[1]}"))
+                 for index, entry in enumerate(entries)]
+        stats = MAT.materialize(pairs, strategy='copy', verbose=False)
+        stage.files = stats['copied']
+        stage.bytes = stats['bytes']
+    stages['copy'] = stage.report()
+
+    with Stage('split') as stage:
+        plan = SPL.build_plan(copy_dir, 0.05)
+        stats = SPL.execute_plan(plan, os.path.join(work_dir, 'split'), strategy='copy')
+        stage.files = stats['copied']
+        stage.bytes = stats['bytes']
+    stages['split'] = stage.report()
+
+    return stages
+
+
+def compare(report, baseline):
+    print(f"\nChange vs {baseline.get('commit') or 'baseline'} (files/s):")
+    for name, stage in report['stages'].items():
+        old = baseline.get('stages', {}).get(name)
+        if not old or not old.get('files_per_s'):
+            continue
+        change = stage['files_per_s'] / old['files_per_s'] - 1
+        print(f"  {name:<10} {old['files_per_s']:>10.1f} -> {stage['files_per_s']:>10.1f} ({change:+.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help="Existing corpus directory to reuse (generated if missing)")
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--compare', help="Earlier report to compare against")
+    parser.add_argument('--video-hash', default=DC.VIDEO_HASH_ALGORITHM,
+                        help=f"Video hash algorithm or alias (one of {', '.join(sorted(DC.VIDEO_HASHERS))}, fast, strict)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_dir = args.corpus or os.path.join(work_dir, 'corpus')
+        if not os.path.exists(os.path.join(corpus_dir, CORPUS.MANIFEST_NAME)):
+            print(f"Generating {args.files}-file corpus (seed {args.seed})...")
+            CORPUS.generate_corpus(corpus_dir, args.files, args.seed)
+        manifest = CORPUS.load_manifest(corpus_dir)
+
+        scratch = os.path.join(work_dir, 'scratch')
+        os.makedirs(scratch)
+        stages = run_stages(corpus_dir, scratch, args.video_hash)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': {'files': len(manifest['entries']), 'seed': manifest['seed']},
+        'video_hash': DC.resolve_hash_algorithm(args.video_hash),
+        'stages': stages,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"\n{'stage':<10} {'files/s':>10} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'peak RSS so far MB':>19}")
+    for name, stage in stages.items():
+        latency = stage.get('latency_ms', {})
+        print(f"{name:<10} {stage['files_per_s']:>10.1f} {stage['mb_per_s']:>8.1f} "
+              f"{latency.get('p50', 0):>8.2f} {latency.get('p99', 0):>8.2f} {stage['cumulative_peak_rss_mb']:>19.1f}")
+    print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
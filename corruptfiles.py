@@ -1,13 +1,59 @@
 import os
+import shutil
+import stat
+import struct
+import time
+import zlib
 from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image, UnidentifiedImageError
 
+import metrics as MET
+import thumbcache as TC
+import traverse as TRV
+
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff'}
 MAX_WORKERS = 2
+# Decode JPEGs at a reduced DCT scale; every compressed block is still read,
+# so truncated and damaged files are still caught.
+FAST_DECODE = True
+FAST_DECODE_SIZE = (256, 256)
+# How far every file is checked before it counts as fine: 'structure' (magic
+# bytes, JPEG SOI/EOI markers, PNG chunk CRCs, header dimensions), 'verify'
+# (structure plus Pillow's verify()) or 'decode' (full decode of every file).
+# Files a cheaper tier flags as suspicious are fully decoded before they are
+# called corrupt, so no tier deletes a file that decodes. Files that pass a
+# cheaper tier are not decoded, though: damage inside the compressed image
+# data (as opposed to the markers, chunks and lengths the tiers check) is
+# only caught by 'decode'.
+CHECK_TIER = 'verify'
+CHECK_TIERS = ('structure', 'verify', 'decode')
+# Bytes at the end of a JPEG searched for its EOI marker (allows trailers).
+JPEG_TAIL_SIZE = 64 * 1024
+CRC_READ_SIZE = 256 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOFn markers carrying the frame dimensions (0xC4, 0xC8 and 0xCC are not frames).
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+TIFF_VALUE_FORMATS = {3: 'H', 4: 'I'}
+# (offsets tag, byte counts tag) for strip- and tile-based TIFFs.
+TIFF_DATA_TAGS = ((273, 279), (324, 325))
+TIFF_CHECKED_TAGS = {256, 257, 273, 279, 324, 325}
+
+
+def detect_icon(img, width, height, size_threshold=(128, 128)):
+    """Flags a loaded image as a likely icon by its original dimensions or transparency."""
+    if width <= size_threshold[0] and height <= size_threshold[1]:
+        return True
+    return TC.has_transparency(img)
+
+
+def detect_icon_from_features(features, size_threshold=(128, 128)):
+    """detect_icon for an image known from the thumbnail cache."""
+    return (features.width <= size_threshold[0] and features.height <= size_threshold[1]) or features.has_alpha
 
 
-def inspect_image(image_path, size_threshold=(128, 128)):
+def inspect_image(image_path, size_threshold=(128, 128), fast_decode=FAST_DECODE):
     """
     Checks if an image file at the given path is corrupted or invalid.
     Also flags likely icons based on small dimensions or transparency.
@@ -17,60 +63,296 @@ def inspect_image(image_path, size_threshold=(128, 128)):
 
     try:
         with Image.open(image_path) as img:
+            width, height = img.size
+            if fast_decode:
+                img.draft(img.mode, FAST_DECODE_SIZE)
             img.load()
 
-            is_icon = False
-            if img.width <= size_threshold[0] and img.height <= size_threshold[1]:
-                is_icon = True
-            elif img.mode in ("RGBA", "LA") or (img.mode == "P" and 'transparency' in img.info):
-                alpha = img.convert("RGBA").getchannel("A")
-                if alpha.getextrema()[0] < 255:
-                    is_icon = True
-
+            is_icon = detect_icon(img, width, height, size_threshold)
             return False, is_icon, "Image loaded successfully."
     except (UnidentifiedImageError, OSError) as e:
         return True, False, f"Image could not be decoded: {e}"
     except Exception as e:
         return True, False, f"An unexpected error occurred during processing: {e}"
 
-def iter_image_paths(root_directory):
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
-                yield os.path.join(dirpath, filename)
+def check_jpeg_structure(file, file_size):
+    if file.read(2) != b'\xff\xd8':
+        return "Missing JPEG SOI marker."
+    has_frame = False
+    while True:
+        prefix = file.read(1)
+        if prefix != b'\xff':
+            return "Broken JPEG marker segment."
+        code = file.read(1)
+        while code == b'\xff':
+            code = file.read(1)
+        if not code:
+            return "JPEG ends inside its headers."
+        code = code[0]
+        if code in JPEG_STANDALONE_MARKERS:
+            continue
+        length_bytes = file.read(2)
+        if len(length_bytes) < 2:
+            return "JPEG ends inside its headers."
+        length = struct.unpack('>H', length_bytes)[0]
+        if length < 2:
+            return "Broken JPEG marker segment."
+        if code in JPEG_SOF_MARKERS:
+            frame = file.read(5)
+            if len(frame) < 5:
+                return "JPEG ends inside its frame header."
+            _, height, width = struct.unpack('>BHH', frame)
+            if width == 0 or height == 0:
+                return f"Invalid JPEG dimensions {width}x{height}."
+            has_frame = True
+            file.seek(length - 7, os.SEEK_CUR)
+        elif code == 0xDA:
+            break
+        else:
+            file.seek(length - 2, os.SEEK_CUR)
+    if not has_frame:
+        return "JPEG has no frame header."
+    # Only look after the scan starts so an EXIF thumbnail's EOI doesn't count.
+    scan_start = file.tell()
+    if scan_start >= file_size:
+        return "JPEG ends before its scan data."
+    file.seek(max(scan_start, file_size - JPEG_TAIL_SIZE))
+    if file.read().rfind(b'\xff\xd9') < 0:
+        return "Missing JPEG EOI marker (truncated?)."
+    return None
+
+
+def check_png_structure(file, file_size):
+    if file.read(8) != PNG_SIGNATURE:
+        return "Missing PNG signature."
+    first_chunk = True
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            return "PNG ends before its IEND chunk."
+        length, chunk_type = struct.unpack('>I4s', header)
+        if first_chunk:
+            if chunk_type != b'IHDR' or length != 13:
+                return "PNG does not start with an IHDR chunk."
+            data = file.read(13)
+            width, height = struct.unpack('>II', data[:8]) if len(data) == 13 else (0, 0)
+            if width == 0 or height == 0:
+                return f"Invalid PNG dimensions {width}x{height}."
+            crc = zlib.crc32(data, zlib.crc32(chunk_type))
+            first_chunk = False
+        else:
+            crc = zlib.crc32(chunk_type)
+            remaining = length
+            while remaining:
+                data = file.read(min(remaining, CRC_READ_SIZE))
+                if not data:
+                    return f"PNG ends inside its {chunk_type.decode('latin-1')} chunk."
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+        stored = file.read(4)
+        if len(stored) < 4:
+            return f"PNG ends inside its {chunk_type.decode('latin-1')} chunk."
+        if struct.unpack('>I', stored)[0] != crc:
+            return f"PNG {chunk_type.decode('latin-1')} chunk CRC mismatch."
+        if chunk_type == b'IEND':
+            return None
+
+
+def check_bmp_structure(file, file_size):
+    header = file.read(34)
+    if len(header) < 26 or header[:2] != b'BM':
+        return "Missing BMP header."
+    offset, dib_size = struct.unpack('<II', header[10:18])
+    if dib_size == 12:
+        width, height = struct.unpack('<HH', header[18:22])
+        bits, compression = struct.unpack('<H', header[24:26])[0], 0
+    elif len(header) == 34:
+        width, height, _, bits, compression = struct.unpack('<iiHHI', header[18:34])
+    else:
+        return "BMP ends inside its header."
+    if width <= 0 or height == 0:
+        return f"Invalid BMP dimensions {width}x{height}."
+    if offset >= file_size:
+        return "BMP pixel data starts past the end of the file."
+    if compression in (0, 3):  # BI_RGB / BI_BITFIELDS: raster size is known.
+        raster_size = (bits * width + 31) // 32 * 4 * abs(height)
+        if offset + raster_size > file_size:
+            return "BMP pixel data is truncated."
+    return None
+
+
+def check_gif_structure(file, file_size):
+    header = file.read(10)
+    if len(header) < 10 or header[:6] not in (b'GIF87a', b'GIF89a'):
+        return "Missing GIF header."
+    width, height = struct.unpack('<HH', header[6:10])
+    if width == 0 or height == 0:
+        return f"Invalid GIF dimensions {width}x{height}."
+    file.seek(max(0, file_size - 16))
+    if not file.read().rstrip(b'\x00').endswith(b';'):
+        return "Missing GIF trailer (truncated?)."
+    return None
+
+
+def read_tiff_values(file, file_size, byte_order, field_type, count, inline):
+    """Reads a TIFF field's SHORT/LONG values; returns None if they lie past the end of the file."""
+    value_format = TIFF_VALUE_FORMATS.get(field_type)
+    if value_format is None:
+        return ()
+    size = struct.calcsize(value_format) * count
+    if size <= 4:
+        data = inline[:size]
+    else:
+        offset = struct.unpack(f'{byte_order}I', inline)[0]
+        if offset + size > file_size:
+            return None
+        file.seek(offset)
+        data = file.read(size)
+    return struct.unpack(f'{byte_order}{count}{value_format}', data)
+
+
+def check_tiff_structure(file, file_size):
+    header = file.read(8)
+    if len(header) < 8:
+        return "TIFF ends inside its header."
+    byte_order = '<' if header[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(f'{byte_order}I', header[4:8])[0]
+    if ifd_offset + 2 > file_size:
+        return "TIFF directory starts past the end of the file."
+    file.seek(ifd_offset)
+    entry_count = struct.unpack(f'{byte_order}H', file.read(2))[0]
+    entries = file.read(12 * entry_count)
+    if len(entries) < 12 * entry_count:
+        return "TIFF ends inside its first directory."
+    fields = {}
+    for position in range(0, len(entries), 12):
+        tag, field_type, count = struct.unpack(f'{byte_order}HHI', entries[position:position + 8])
+        if tag in TIFF_CHECKED_TAGS:
+            values = read_tiff_values(file, file_size, byte_order, field_type, count, entries[position + 8:position + 12])
+            if values is None:
+                return "TIFF field data lies past the end of the file."
+            fields[tag] = values
+    width, height = fields.get(256, (0,))[0], fields.get(257, (0,))[0]
+    if width == 0 or height == 0:
+        return f"Invalid TIFF dimensions {width}x{height}."
+    for offsets_tag, counts_tag in TIFF_DATA_TAGS:
+        offsets, counts = fields.get(offsets_tag), fields.get(counts_tag)
+        if offsets and counts and max(offset + count for offset, count in zip(offsets, counts)) > file_size:
+            return "TIFF image data is truncated."
+    return None
+
+
+STRUCTURE_CHECKS = (
+    (b'\xff\xd8', check_jpeg_structure),
+    (PNG_SIGNATURE, check_png_structure),
+    (b'BM', check_bmp_structure),
+    (b'GIF8', check_gif_structure),
+    (b'II*\x00', check_tiff_structure),
+    (b'MM\x00*', check_tiff_structure),
+)
 
-def check_directory_for_corrupted_images_recursive(root_directory):
+
+def check_structure(image_path):
     """
-    Recursively walks through a directory and its subdirectories, 
-    checks for images, and reports on their status and count.
+    Cheap byte-level checks picked by the file's magic bytes, not its extension.
+    Returns a message describing the problem, or None if nothing looks wrong.
     """
-    corrupted_images = []
-    possible_icons = []
-    total_files_checked = 0
+    with open(image_path, 'rb') as file:
+        file_size = os.fstat(file.fileno()).st_size
+        magic = file.read(8)
+        file.seek(0)
+        for signature, check in STRUCTURE_CHECKS:
+            if magic.startswith(signature):
+                return check(file, file_size)
+    return "Unrecognized image signature."
 
-    print(f"--- Checking Images Recursively in: {root_directory} ---")
 
-    def process_image(image_path):
-        is_corrupt, is_icon, message = inspect_image(image_path)
-        if is_corrupt:
-            print(f"Corrupted: {image_path} -> {message}")
+def may_have_transparency(img):
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and 'transparency' in img.info)
+
+
+def check_image(image_path, tier=CHECK_TIER, size_threshold=(128, 128), fast_decode=FAST_DECODE, timings=None, cache=None):
+    """
+    Tiered version of inspect_image: runs the checks up to tier and only fully
+    decodes files that look suspicious (or whose transparency decides whether
+    they are icons). Returns (is_corrupt, is_icon, message, flagged_by), where
+    flagged_by names the tier that sent the file to a full decode.
+
+    Files in cache (a thumbcache.ThumbnailCache) with an unchanged signature
+    were decoded successfully before and are not checked again.
+    """
+    if tier not in CHECK_TIERS:
+        raise ValueError(f"Unknown check tier: {tier}")
+    if not os.path.exists(image_path):
+        return True, False, "File path does not exist.", None
+
+    if cache is not None:
+        start = time.perf_counter()
+        try:
+            features = cache.get(image_path, TRV.stat_entry(image_path), reduced=True)
+        except OSError:
+            features = None
+        if features is not None:
+            MET.record(timings, 'cache_hit', time.perf_counter() - start)
+            return False, detect_icon_from_features(features, size_threshold), "Image decoded earlier (thumbnail cache).", None
+
+    problem = flagged_by = None
+    if tier != 'decode':
+        start = time.perf_counter()
+        try:
+            problem = check_structure(image_path)
+            if problem is None:
+                with Image.open(image_path) as img:
+                    width, height = img.size
+                    transparent = may_have_transparency(img)
+        except Exception as e:
+            problem = f"Image header could not be read: {e}"
+        MET.record(timings, 'structure', time.perf_counter() - start)
+        if problem:
+            flagged_by = 'structure'
+
+        if problem is None and tier == 'verify':
+            start = time.perf_counter()
             try:
-                os.remove(image_path)
+                with Image.open(image_path) as img:
+                    img.verify()
             except Exception as e:
-                print(f"Failed to delete {image_path}: {e}")
-            return image_path, True, False
-        if is_icon:
-            return image_path, False, True
-        return image_path, False, False
+                problem, flagged_by = f"Pillow verify() failed: {e}", 'verify'
+            MET.record(timings, 'verify', time.perf_counter() - start)
+
+        if problem is None:
+            is_icon = width <= size_threshold[0] and height <= size_threshold[1]
+            if is_icon or not transparent:
+                return False, is_icon, f"Image passed {tier} checks.", None
+
+    start = time.perf_counter()
+    is_corrupt, is_icon, message = inspect_image(image_path, size_threshold, fast_decode)
+    MET.record(timings, 'decode', time.perf_counter() - start)
+    if is_corrupt and problem:
+        message = f"{message} ({problem})"
+    return is_corrupt, is_icon, message, flagged_by
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        for image_path, is_corrupt, is_icon in executor.map(process_image, iter_image_paths(root_directory)):
-            total_files_checked += 1
-        if is_corrupt:
-            corrupted_images.append(image_path)
-        if is_icon:
-            possible_icons.append(image_path)
 
+def init_worker():
+    """
+    Thread pool initializer: registers every Pillow format plugin up front, so
+    the import is not billed to the first TIFF (or other late plugin) a thread
+    checks.
+    """
+    Image.init()
+
+def iter_image_paths(root_directory, include=(), exclude=()):
+    for image_path, *_ in TRV.walk(root_directory, include, exclude, IMAGE_EXTENSIONS, skip_stat=lambda path: True):
+        yield image_path
+
+def delete_corrupted_image(image_path, message):
+    print(f"Corrupted: {image_path} -> {message}")
+    try:
+        os.remove(image_path)
+    except Exception as e:
+        print(f"Failed to delete {image_path}: {e}")
+
+def print_summary(total_files_checked, corrupted_images, possible_icons):
     print(f"\n--- Summary 📊 ---")
     print(f"Total image files checked: **{total_files_checked}**")
     valid_count = total_files_checked - len(corrupted_images)
@@ -89,38 +371,102 @@ def check_directory_for_corrupted_images_recursive(root_directory):
             print(f"- {path}")
     else:
         print("No possible icons were found.")
+
+def print_tier_summary(total_files_checked, metrics):
+    """Reports how many files each tier looked at, flagged and confirmed as corrupt."""
+    snapshot = metrics.snapshot()
+    counters, timings = snapshot['counters'], snapshot['timings']
+    print("\n--- Check tiers ---")
+    for tier in CHECK_TIERS:
+        checked = timings.get(tier, {}).get('count', 0)
+        if not checked:
+            continue
+        if tier == 'decode':
+            print(f"{tier:<9} {checked:>8} decoded ({checked / total_files_checked:.1%} of files)")
+            continue
+        flagged = counters.get(f'{tier}_flagged', 0)
+        confirmed = counters.get(f'{tier}_confirmed', 0)
+        print(f"{tier:<9} {checked:>8} checked, {flagged} flagged ({flagged / checked:.2%}), {confirmed} confirmed corrupt")
+
+def check_directory_for_corrupted_images_recursive(root_directory, tier=CHECK_TIER, include=(), exclude=(), thumbnail_cache=None):
+    """
+    Recursively walks through a directory and its subdirectories, 
+    checks for images, and reports on their status and count.
+    Only files the cheap tiers up to tier find suspicious are fully decoded,
+    and none that the thumbcache database thumbnail_cache already holds.
+    """
+    corrupted_images = []
+    possible_icons = []
+    total_files_checked = 0
+
+    print(f"--- Checking Images Recursively in: {root_directory} ---")
+
+    def process_image(image_path):
+        timings = {}
+        start = time.perf_counter()
+        cache = TC.open_cache(thumbnail_cache) if thumbnail_cache else None
+        is_corrupt, is_icon, message, flagged_by = check_image(image_path, tier, timings=timings, cache=cache)
+        metrics.incr('worker_busy_seconds', time.perf_counter() - start)
+        metrics.observe_many(timings)
+        if flagged_by:
+            metrics.incr(f'{flagged_by}_flagged')
+            if is_corrupt:
+                metrics.incr(f'{flagged_by}_confirmed')
+        if is_corrupt:
+            delete_corrupted_image(image_path, message)
+            return image_path, True, False
+        if is_icon:
+            return image_path, False, True
+        return image_path, False, False
+
+    with MET.track('corruptfiles') as metrics, ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker) as executor:
+        metrics.set_gauge('workers', MAX_WORKERS)
+        for image_path, is_corrupt, is_icon in executor.map(process_image, iter_image_paths(root_directory, include, exclude)):
+            total_files_checked += 1
+            metrics.incr('files')
+            if is_corrupt:
+                corrupted_images.append(image_path)
+            if is_icon:
+                possible_icons.append(image_path)
+    if thumbnail_cache:
+        TC.close_caches()
+
+    print_summary(total_files_checked, corrupted_images, possible_icons)
+    if total_files_checked:
+        print_tier_summary(total_files_checked, metrics)
     return corrupted_images, possible_icons
 
 # --- Example Usage ---
 # CHANGE THIS PATH to the root directory you want to check recursively
 
 
-def corruptfiles_main(target_directory):
+def corruptfiles_main(target_directory, tier=CHECK_TIER, thumbnail_cache=None):
     if not os.path.isdir(target_directory):
             print(f"Error: Directory not found at {target_directory}")
     else:
-        corrupted_files, possible_icons = check_directory_for_corrupted_images_recursive(target_directory)
-
-        # Move possible icons to ./possible_icons
-        import shutil
-        icon_dir = os.path.join(os.getcwd(), "possible_icons")
-        if not os.path.exists(icon_dir):
-            os.makedirs(icon_dir)
-        import stat
-        for icon_path in possible_icons:
-            dest_path = os.path.join(icon_dir, os.path.basename(icon_path))
+        corrupted_files, possible_icons = check_directory_for_corrupted_images_recursive(target_directory, tier, thumbnail_cache=thumbnail_cache)
+
+        move_possible_icons(possible_icons)
+
+def move_possible_icons(possible_icons):
+    """Moves possible icons to ./possible_icons."""
+    icon_dir = os.path.join(os.getcwd(), "possible_icons")
+    if not os.path.exists(icon_dir):
+        os.makedirs(icon_dir)
+    for icon_path in possible_icons:
+        dest_path = os.path.join(icon_dir, os.path.basename(icon_path))
+        try:
+            shutil.move(icon_path, dest_path)
+            print(f"Moved icon: {icon_path} -> {dest_path}")
+        except PermissionError:
             try:
+                os.chmod(icon_path, stat.S_IWUSR | stat.S_IRUSR)
                 shutil.move(icon_path, dest_path)
-                print(f"Moved icon: {icon_path} -> {dest_path}")
-            except PermissionError:
-                try:
-                    os.chmod(icon_path, stat.S_IWUSR | stat.S_IRUSR)
-                    shutil.move(icon_path, dest_path)
-                    print(f"Changed permissions and moved icon: {icon_path} -> {dest_path}")
-                except Exception as e:
-                    print(f"Failed to move icon {icon_path} after changing permissions: {e}")
+                print(f"Changed permissions and moved icon: {icon_path} -> {dest_path}")
             except Exception as e:
-                print(f"Failed to move icon {icon_path}: {e}")
+                print(f"Failed to move icon {icon_path} after changing permissions: {e}")
+        except Exception as e:
+            print(f"Failed to move icon {icon_path}: {e}")
 
 if __name__ == "__main__":
     target_directory = "/media/piir/PiTB/PICTURES/NewPics"  # Replace with the path to your target directory
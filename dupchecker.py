@@ -1,41 +1,370 @@
 import os
+import mmap
+import queue
+import signal
+import socket
 import sqlite3
 import hashlib
-import imagehash
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+import numpy as np
 from PIL import Image
-from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import metrics as MET
+import thumbcache as TC
+import traverse as TRV
 
 IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
 VIDEO_EXTENSIONS = {'.mp4'}
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
 DEFAULT_BATCH_SIZE = 500
+STAT_COLUMNS = (('size', 'INTEGER'), ('mtime_ns', 'INTEGER'), ('inode', 'INTEGER'))
+VIDEO_SAMPLE_SIZE = 1024 * 1024
+# Head and tail hashed to tell apart same-size images before reading them whole.
+IMAGE_SAMPLE_SIZE = 64 * 1024
+# Images read ahead of the one being handed to the pool while the hashes
+# that tell whether it is a copy are still being computed.
+EXACT_LOOKAHEAD = 256
+PHASH_SIZE = 8
+PHASH_IMAGE_SIZE = PHASH_SIZE * 4
+PHASH_PREPROCESS_SIZE = (256, 256)
+# Low-frequency DCT coefficients closer than this to their median are rounding
+# noise (flat images); those pHashes are recomputed with scipy's DCT, whose
+# noise imagehash.phash and existing databases reflect.
+PHASH_TIE_TOLERANCE = 1e-6
+# Thumbnails per batch the pool initializer sizes the pHash buffers for.
+PHASH_BATCH_SIZE = 32
+# Let Pillow decode JPEGs at a reduced DCT scale (1/2..1/8) when hashing.
+# Off by default because the hashes drift slightly from full-resolution
+# decoding (see benchmarks/fast_decode.py) and mixing both in one database
+# hides exact pHash matches.
+FAST_DECODE = False
+# Content hash for new databases. BLAKE2b ships with hashlib, so databases
+# scanned on different machines (see mergeshards) always compare. 'fast' is
+# opt-in: it picks the quickest one installed (blake3, then xxh3_128, then
+# BLAKE2b), which depends on the host's packages. 'strict' is SHA-256 and
+# 'md5' matches databases written before video_hashes recorded the
+# algorithm. An existing database keeps the algorithm it was built with
+# unless one is asked for.
+VIDEO_HASH_ALGORITHM = 'blake2b'
+VIDEO_HASHERS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': partial(hashlib.blake2b, digest_size=16),
+}
+if xxhash is not None:
+    VIDEO_HASHERS['xxh3_128'] = xxhash.xxh3_128
+if blake3 is not None:
+    VIDEO_HASHERS['blake3'] = blake3.blake3
+HASH_ALGORITHM_ALIASES = {
+    'fast': ('blake3', 'xxh3_128', 'blake2b'),
+    'strict': ('sha256',),
+}
+# Rows the DatabaseWriter thread may have queued, and the most seconds it
+# holds rows (and journal progress) before committing them.
+WRITER_QUEUE_SIZE = 10000
+WRITER_COMMIT_INTERVAL = 5.0
+# Bulk loading a fresh database: rows per transaction and connection settings
+# (256 MiB page cache, 1 GiB of memory-mapped reads, temp tables in memory).
+BULK_BATCH_SIZE = 20000
+BULK_PRAGMAS = (
+    'PRAGMA cache_size=-262144',
+    'PRAGMA mmap_size=1073741824',
+    'PRAGMA temp_store=MEMORY',
+)
+# Reads go through one reused, page-aligned buffer per thread. 'mmap' hashes
+# the mapped file in one call instead; it is a little faster from page cache,
+# but a file truncated mid-hash kills the worker with SIGBUS.
+VIDEO_READ_MODE = 'readinto'
+HASH_CHUNK_SIZE = 1024 * 1024
+_read_buffers = threading.local()
+_phash_buffers = threading.local()
+
+def resolve_hash_algorithm(name):
+    """Maps an algorithm name or alias to an installed entry of VIDEO_HASHERS."""
+    for candidate in HASH_ALGORITHM_ALIASES.get(name, (name,)):
+        if candidate in VIDEO_HASHERS:
+            return candidate
+    raise ValueError(f"Unknown or unavailable hash algorithm: {name}")
+
+def read_buffer(size):
+    """Returns a memoryview of size bytes over this thread's reused read buffer."""
+    buffer = getattr(_read_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        # An anonymous mmap is page-aligned, unlike a bytearray. It must be
+        # private: a shared one would be shared with forked pool workers too.
+        if hasattr(mmap, 'MAP_PRIVATE'):
+            buffer = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
+        else:
+            buffer = mmap.mmap(-1, size)
+        _read_buffers.buffer = buffer
+    return memoryview(buffer)[:size]
+
+def update_from_file(hasher, file, length=None, chunk_size=HASH_CHUNK_SIZE):
+    """Feeds the next length bytes of file (or all of it) to hasher via readinto."""
+    view = read_buffer(chunk_size)
+    try:
+        while length is None or length > 0:
+            wanted = chunk_size if length is None else min(chunk_size, length)
+            read = file.readinto(view[:wanted])
+            if not read:
+                break
+            hasher.update(view[:read])
+            if length is not None:
+                length -= read
+    finally:
+        view.release()
+
+def advise_sequential(file):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def calculate_mhash(file_path, algorithm=VIDEO_HASH_ALGORITHM, read_mode=None):
+    """Hashes the file content with algorithm and returns the hex digest."""
+    hasher = VIDEO_HASHERS[resolve_hash_algorithm(algorithm)]()
+    try:
+        with open(file_path, 'rb', buffering=0) as file:
+            if (read_mode or VIDEO_READ_MODE) == 'mmap':
+                try:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        hasher.update(mapped)
+                    return hasher.hexdigest()
+                except ValueError:
+                    pass  # Empty files cannot be mapped.
+            advise_sequential(file)
+            update_from_file(hasher, file)
+        return hasher.hexdigest()
+    except FileNotFoundError:
+        return None
 
-def calculate_mhash(file_path, buffer_size=65536):
-    """Generates an MD5 hash of the file content."""
-    hasher = hashlib.md5()
+def calculate_sample_hash(file_path, file_size, sample_size=VIDEO_SAMPLE_SIZE, algorithm=VIDEO_HASH_ALGORITHM):
+    """
+    Hashes the file size plus its first and last sample_size bytes.
+    Files small enough to be covered by the samples get a plain full hash instead.
+    """
+    if file_size <= 2 * sample_size:
+        return calculate_mhash(file_path, algorithm)
+    hasher = VIDEO_HASHERS[resolve_hash_algorithm(algorithm)]()
+    hasher.update(str(file_size).encode())
     try:
-        with open(file_path, 'rb') as file:
-            while True:
-                chunk = file.read(buffer_size)
-                if not chunk:
-                    break
-                hasher.update(chunk)
+        with open(file_path, 'rb', buffering=0) as file:
+            update_from_file(hasher, file, sample_size)
+            file.seek(-sample_size, os.SEEK_END)
+            update_from_file(hasher, file, sample_size)
         return hasher.hexdigest()
     except FileNotFoundError:
         return None
 
-def calculate_phash(image_path):
+def draft_for_thumbnail(img, size=PHASH_PREPROCESS_SIZE, mode='L'):
+    """
+    Asks the decoder for a reduced-resolution image no smaller than size.
+    Only formats with DCT scaling (JPEG) support this; others decode as usual.
+    """
+    return img.draft(mode, size) is not None
+
+def calculate_phash(image_path, fast_decode=FAST_DECODE):
+    # imagehash pulls in scipy and PyWavelets; only this single-image path needs it.
+    import imagehash
     try:
         with Image.open(image_path) as img:
-            processed = img.convert('L').resize((256, 256))
+            if fast_decode:
+                draft_for_thumbnail(img)
+            processed = img.convert('L').resize(PHASH_PREPROCESS_SIZE)
             return str(imagehash.phash(processed))
     except Exception as e:
         print(f"Error calculating pHash for {image_path}: {e}")
         return None
 
+def phash_thumbnail(img):
+    """Reduces an image to the 32x32 grayscale array imagehash.phash works on."""
+    processed = img.convert('L').resize(PHASH_PREPROCESS_SIZE)
+    return np.asarray(processed.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.Resampling.LANCZOS))
+
+def image_features(img, width, height):
+    """
+    Everything the thumbnail cache keeps for a decoded image; width and height
+    are the original dimensions (img.size before any draft()).
+    """
+    processed = img.convert('L').resize(PHASH_PREPROCESS_SIZE)
+    return TC.ImageFeatures(
+        width, height, img.mode, TC.has_transparency(img),
+        np.asarray(processed.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.Resampling.LANCZOS)),
+        np.asarray(processed.resize((TC.THUMBNAIL_SIZE, TC.THUMBNAIL_SIZE), Image.Resampling.LANCZOS)),
+    )
+
+def phash_workspace(count):
+    """
+    Returns this thread's DCT basis and (pixels, rows, lowfreq) buffers sized
+    for count thumbnails. The basis holds the PHASH_SIZE lowest-frequency rows
+    of the unnormalized DCT-II scipy.fftpack.dct computes.
+    """
+    workspace = getattr(_phash_buffers, 'workspace', None)
+    if workspace is None or len(workspace[1]) < count:
+        n = np.arange(PHASH_IMAGE_SIZE)
+        k = np.arange(PHASH_SIZE)[:, None]
+        basis = 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * PHASH_IMAGE_SIZE))
+        workspace = _phash_buffers.workspace = (
+            basis,
+            np.empty((count, PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE)),
+            np.empty((count, PHASH_SIZE, PHASH_IMAGE_SIZE)),
+            np.empty((count, PHASH_SIZE, PHASH_SIZE)),
+        )
+    basis, pixels, rows, lowfreq = workspace
+    return basis, pixels[:count], rows[:count], lowfreq[:count]
+
+def phash_batch(thumbnails):
+    """
+    Computes pHashes for N 32x32 thumbnails (a list or stacked array) at once.
+
+    Uses the same DCT, median and bit order as imagehash.phash, so the
+    results match it bit-for-bit. Only the 8x8 low-frequency corner of the
+    DCT is computed, as two small products with a cached basis, in reused
+    buffers. Returns a uint64 array.
+    """
+    count = len(thumbnails)
+    basis, pixels, rows, lowfreq = phash_workspace(count)
+    np.stack(thumbnails, out=pixels)
+    np.matmul(basis, pixels, out=rows)
+    np.matmul(rows, basis.T, out=lowfreq)
+    lowfreq = lowfreq.reshape(count, -1)
+    median = np.median(lowfreq, axis=1, keepdims=True)
+    ties = np.flatnonzero((np.abs(lowfreq - median) < PHASH_TIE_TOLERANCE).any(axis=1))
+    if len(ties):
+        import scipy.fftpack
+        dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels[ties], axis=1), axis=2)
+        lowfreq[ties] = dct[:, :PHASH_SIZE, :PHASH_SIZE].reshape(len(ties), -1)
+        median[ties] = np.median(lowfreq[ties], axis=1, keepdims=True)
+    bits = lowfreq > median
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def format_phash(value):
+    """Formats a 64-bit pHash the same way str(imagehash.ImageHash) does."""
+    return f"{int(value):016x}"
+
+def phash_to_int(phash):
+    """
+    Converts a pHash (hex string or unsigned 64-bit value) to the signed 64-bit
+    integer stored in hashes.phash; SQLite integers are signed, so the top bit
+    becomes the sign.
+    """
+    value = int(phash, 16) if isinstance(phash, str) else int(phash)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def phash_to_hex(value):
+    """Inverse of phash_to_int."""
+    return format_phash(int(value) & 0xFFFFFFFFFFFFFFFF)
+
+def calculate_phash_batch(image_paths, fast_decode=FAST_DECODE, timings=None, cache=None, signatures=None):
+    """
+    Returns a hex pHash (or None on error) for each path, hashing them as one batch.
+    With a thumbcache.ThumbnailCache and the paths' stat signatures, cached
+    images are not decoded and newly decoded ones are added to the cache.
+    """
+    thumbnails = []
+    positions = []
+    for position, image_path in enumerate(image_paths):
+        if cache is not None:
+            start = time.perf_counter()
+            features = cache.get(image_path, signatures[position], fast_decode)
+            if features is not None:
+                MET.record(timings, 'cache_hit', time.perf_counter() - start)
+                thumbnails.append(features.phash_pixels)
+                positions.append(position)
+                continue
+        try:
+            start = time.perf_counter()
+            with Image.open(image_path) as img:
+                opened = time.perf_counter()
+                width, height = img.size
+                if fast_decode:
+                    draft_for_thumbnail(img)
+                if cache is None:
+                    thumbnails.append(phash_thumbnail(img))
+                else:
+                    features = image_features(img, width, height)
+                    cache.put(image_path, signatures[position], features, fast_decode)
+                    thumbnails.append(features.phash_pixels)
+                positions.append(position)
+            MET.record(timings, 'open', opened - start)
+            MET.record(timings, 'decode', time.perf_counter() - opened)
+        except Exception as e:
+            print(f"Error calculating pHash for {image_path}: {e}")
+    if cache is not None:
+        cache.flush()
+
+    phashes = [None] * len(image_paths)
+    if thumbnails:
+        start = time.perf_counter()
+        values = phash_batch(thumbnails)
+        per_image = (time.perf_counter() - start) / len(thumbnails)
+        for position, value in zip(positions, values):
+            phashes[position] = format_phash(value)
+            MET.record(timings, 'hash', per_image)
+    return phashes
+
+def process_image_batch(entries, fast_decode=FAST_DECODE, timings=None, thumbnail_cache=None):
+    """
+    Hashes a batch of image stat entries; returns one result (or None) per entry.
+    Exact duplicates (entries that carry their original's path) are not decoded
+    and get None; the caller fills them in from the original. thumbnail_cache
+    is the path of a thumbcache database to read and fill.
+    """
+    decoded = [entry for entry in entries if len(entry) == 4]
+    cache = TC.open_cache(thumbnail_cache) if thumbnail_cache else None
+    phashes = iter(calculate_phash_batch(
+        [entry[0] for entry in decoded], fast_decode, timings, cache, [entry[1:] for entry in decoded]
+    ))
+    results = []
+    for entry in entries:
+        phash = next(phashes) if len(entry) == 4 else None
+        file_path, size, mtime_ns, inode = entry[:4]
+        results.append(
+            ("hashes", os.path.basename(file_path), file_path, phash_to_int(phash), size, mtime_ns, inode) if phash else None
+        )
+    return results
+
+def exact_duplicate_rows(entry, original, phash):
+    """
+    Rows recording entry as a byte-identical copy of original: a hashes row
+    carrying the original's pHash (only scan_state keeps it, as hashes already
+    has that pHash) and the exact_duplicates link itself.
+    """
+    file_path, size, mtime_ns, inode = entry[:4]
+    return (
+        (os.path.basename(file_path), file_path, phash, size, mtime_ns, inode),
+        (file_path, original.path, original.digest.result()),
+    )
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 def process_single_image(img_path):
     phash = calculate_phash(img_path)
     if phash:
-        return ("hashes", os.path.basename(img_path), img_path, phash)
+        return ("hashes", os.path.basename(img_path), img_path, phash_to_int(phash))
     return None
 
 def process_single_video(video_path):
@@ -63,16 +392,376 @@ def process_single_file(file_path):
 
     return None
 
-def iter_media_files(folder):
-    for root, _, files in os.walk(folder):
-        for file_name in files:
-            extension = os.path.splitext(file_name)[1].lower()
-            if extension in IMAGE_EXTENSIONS or extension in VIDEO_EXTENSIONS:
-                yield os.path.join(root, file_name)
+def process_video_stage(task, timings=None):
+    """Runs one stage ('sample' or 'full') of the video pipeline for a stat entry."""
+    entry, stage, algorithm = task
+    try:
+        start = time.perf_counter()
+        if stage == 'full':
+            digest = calculate_mhash(entry[0], algorithm)
+        else:
+            digest = calculate_sample_hash(entry[0], entry[1], algorithm=algorithm)
+        MET.record(timings, 'hash', time.perf_counter() - start)
+        return entry, digest
+    except Exception as e:
+        print(f"Error processing {entry[0]}: {e}")
+        return entry, None
+
+def run_video_stage(executor, tasks, chunksize, metrics=None):
+    """Maps process_video_stage over tasks, merging worker timings into metrics."""
+    if metrics is None:
+        yield from executor.map(process_video_stage, tasks, chunksize=chunksize)
+        return
+    for result, timings in executor.map(partial(MET.call_with_timings, process_video_stage), tasks, chunksize=chunksize):
+        metrics.observe_many(timings)
+        yield result
+
+def video_row(entry, mhash, stage, algorithm, sample_hash=None):
+    file_path, size, mtime_ns, inode = entry
+    return (os.path.basename(file_path), file_path, mhash, size, mtime_ns, inode, stage, algorithm, sample_hash)
+
+def hash_videos_staged(executor, video_entries, chunksize=8, metrics=None, algorithm=VIDEO_HASH_ALGORITHM):
+    """
+    Hashes videos in stages so only possible duplicates are read in full:
+    files are grouped by size, size collisions get a head+tail sample hash,
+    and only files whose samples still collide get a full-content hash.
+    A file whose size nothing else has is not read at all.
+
+    Yields video_hashes rows. mhash only ever holds a full-content hash and
+    stays NULL for files that never needed one; the stage element records
+    the last stage the file went through ('size', 'sample' or 'full'), and
+    the last two elements the algorithm and the sample hash, if one was taken.
+    """
+    algorithm = resolve_hash_algorithm(algorithm)
+    by_size = {}
+    for entry in video_entries:
+        by_size.setdefault(entry[1], []).append(entry)
+
+    sample_tasks = []
+    for entries in by_size.values():
+        if len(entries) == 1:
+            yield video_row(entries[0], None, 'size', algorithm)
+        else:
+            sample_tasks.extend((entry, 'sample', algorithm) for entry in entries)
+
+    by_sample = {}
+    for entry, digest in run_video_stage(executor, sample_tasks, chunksize, metrics):
+        if digest is None:
+            continue
+        if entry[1] <= 2 * VIDEO_SAMPLE_SIZE:
+            # The sample already covered the whole file.
+            yield video_row(entry, digest, 'full', algorithm, digest)
+            continue
+        by_sample.setdefault((entry[1], digest), []).append(entry)
+
+    full_tasks = []
+    for (_, digest), entries in by_sample.items():
+        if len(entries) == 1:
+            yield video_row(entries[0], None, 'sample', algorithm, digest)
+        else:
+            full_tasks.extend(((entry, 'full', algorithm), digest) for entry in entries)
+
+    for (entry, digest), (_, sample_hash) in zip(
+            run_video_stage(executor, [task for task, _ in full_tasks], chunksize, metrics), full_tasks):
+        if digest is not None:
+            yield video_row(entry, digest, 'full', algorithm, sample_hash)
+
+def exact_file_hash(path, size, stage, algorithm, signature=None):
+    """
+    Pool task for ExactImageIndex: the head+tail sample ('sample') or full
+    hash of an image, or False if it cannot be read or, for a file recorded
+    by an earlier run, no longer matches its signature.
+    """
+    try:
+        if signature is not None and TRV.stat_entry(path) != signature:
+            return False
+        if stage == 'sample':
+            return calculate_sample_hash(path, size, IMAGE_SAMPLE_SIZE, algorithm) or False
+        return calculate_mhash(path, algorithm) or False
+    except OSError:
+        return False
+
+class ExactCandidate:
+    __slots__ = ('path', 'signature', 'sample', 'digest', 'outcome', 'original')
+
+    def __init__(self, path, signature=None, outcome=None):
+        self.path = path
+        # Set for files from an earlier run; they must still match it to be trusted.
+        self.signature = signature
+        # Futures of exact_file_hash, submitted when first needed.
+        self.sample = None
+        self.digest = None
+        self.outcome = outcome
+        # The candidate this one turned out to be a copy of.
+        self.original = None
+
+class ExactCheck:
+    """
+    Whether one image is a byte-identical copy of an earlier one of the same
+    size (see ExactImageIndex.submit). The hashes it needs run in the pool;
+    done() advances the comparison as far as finished hashes allow.
+    """
+
+    def __init__(self, index, new, size, candidates):
+        self.index = index
+        self.new = new
+        self.size = size
+        self.candidates = deque(candidates)
+        self.resolved = not candidates
+        self.original = None
+        self.waiting = None
+        if candidates:
+            # All samples go out at once so their reads overlap.
+            index.sample(new, size)
+            for candidate in candidates:
+                index.sample(candidate, size)
+
+    def done(self):
+        while not self.resolved:
+            candidate = self.candidates[0]
+            if candidate.original is not None:
+                # A copy itself; the original it matched is earlier in the list.
+                self.candidates.popleft()
+            elif not self._ready(self.new.sample, candidate.sample):
+                return False
+            elif not self.new.sample.result():
+                self._resolve(None)
+            elif candidate.sample.result() != self.new.sample.result():
+                self.candidates.popleft()
+            else:
+                digests = self.index.digest(candidate, self.size), self.index.digest(self.new, self.size)
+                if not self._ready(*digests):
+                    return False
+                if digests[0].result() and digests[0].result() == digests[1].result():
+                    self._resolve(candidate)
+                    continue
+                self.candidates.popleft()
+            if not self.candidates and not self.resolved:
+                self._resolve(None)
+        return True
+
+    def result(self):
+        """The candidate the image is a copy of, or None; waits for the hashes it needs."""
+        while not self.done():
+            self.waiting.result()
+        return self.original
+
+    def _ready(self, *futures):
+        for future in futures:
+            if not future.done():
+                self.waiting = future
+                return False
+        return True
+
+    def _resolve(self, original):
+        self.resolved = True
+        self.original = original
+        if original is not None:
+            self.new.original = original
+            self.index.duplicates += 1
+            if self.index.metrics is not None:
+                self.index.metrics.incr('exact_duplicates')
+
+class ExactImageIndex:
+    """
+    Spots byte-identical images as they stream past, so only the first copy
+    gets decoded. Like the video stages, files are compared by size, then by a
+    head+tail sample hash, then by a full hash; a file whose size nothing else
+    has costs no reads at all. With an executor the hashing runs in its pool
+    (see resolve_exact_copies), otherwise in the calling thread.
+
+    With conn, images recorded in scan_state by earlier runs are candidates
+    too (their outcome comes from known_outcome(phash)); they only count while
+    their size, mtime and inode still match what was recorded.
+    """
+
+    def __init__(self, conn=None, known_outcome=None, algorithm=VIDEO_HASH_ALGORITHM, metrics=None, executor=None):
+        self.conn = conn
+        self.known_outcome = known_outcome or (lambda phash: phash)
+        self.algorithm = resolve_hash_algorithm(algorithm)
+        self.metrics = metrics
+        self.executor = executor
+        self.by_size = {}
+        self.duplicates = 0
+
+    def _candidates(self, size):
+        candidates = self.by_size.get(size)
+        if candidates is None:
+            candidates = self.by_size[size] = []
+            if self.conn is not None:
+                for path, mtime_ns, inode, hash_value in self.conn.execute(
+                        "SELECT path, mtime_ns, inode, hash_value FROM scan_state WHERE kind = 'hashes' AND size = ?",
+                        (size,)):
+                    if hash_value is not None:
+                        candidates.append(ExactCandidate(
+                            path, (size, mtime_ns, inode), self.known_outcome(int(hash_value))
+                        ))
+        return candidates
+
+    def _submit(self, candidate, size, stage):
+        if self.metrics is not None:
+            self.metrics.incr(f'exact_{stage}_hashes')
+        args = (candidate.path, size, stage, self.algorithm, candidate.signature)
+        if self.executor is not None:
+            return self.executor.submit(exact_file_hash, *args)
+        future = Future()
+        future.set_result(exact_file_hash(*args))
+        return future
+
+    def sample(self, candidate, size):
+        if candidate.sample is None:
+            candidate.sample = self._submit(candidate, size, 'sample')
+        return candidate.sample
+
+    def digest(self, candidate, size):
+        if candidate.digest is None:
+            if size <= 2 * IMAGE_SAMPLE_SIZE:
+                # The sample already covered the whole file.
+                candidate.digest = self.sample(candidate, size)
+            else:
+                candidate.digest = self._submit(candidate, size, 'full')
+        return candidate.digest
+
+    def submit(self, path, size):
+        """
+        Registers path as a candidate for the files that follow and returns an
+        ExactCheck of whether it copies one that came before. Checks must be
+        resolved in submission order.
+        """
+        candidates = self._candidates(size)
+        earlier = [candidate for candidate in candidates if candidate.path != path]
+        new = ExactCandidate(path)
+        candidates.append(new)
+        return ExactCheck(self, new, size, earlier)
+
+    def find(self, path, size):
+        """Returns the candidate path is a byte-identical copy of, or None."""
+        return self.submit(path, size).result()
+
+    def lookup(self, path, size):
+        # Newest first: a rescanned file is also listed as it was in an earlier run.
+        for candidate in reversed(self.by_size.get(size, ())):
+            if candidate.path == path:
+                return candidate
+        return None
+
+    def record(self, path, size, outcome):
+        """Stores what decoding path produced, for the copies of it still to come."""
+        candidate = self.lookup(path, size)
+        if candidate is not None:
+            candidate.outcome = outcome
+
+def resolve_exact_copies(entries, exact_index, lookahead=EXACT_LOOKAHEAD):
+    """
+    Yields the image stat entries in order, each with its original's path
+    appended if exact_index finds it a byte-identical copy. Up to lookahead
+    entries are read ahead, so the pool hashes size collisions while the
+    entries before them are already being decoded.
+    """
+    window = deque()
+
+    def resolved(entry, check):
+        original = check.result()
+        return entry if original is None else entry + (original.path,)
+
+    for entry in entries:
+        window.append((entry, exact_index.submit(entry[0], entry[1])))
+        while window and (len(window) >= lookahead or window[0][1].done()):
+            yield resolved(*window.popleft())
+    while window:
+        yield resolved(*window.popleft())
+
+def iter_media_files(folder, include=(), exclude=()):
+    for file_path, *_ in TRV.walk(folder, include, exclude, MEDIA_EXTENSIONS, skip_stat=lambda path: True):
+        yield file_path
+
+def iter_media_entries(folder, skip_image_dirs=(), metrics=None, include=(), exclude=(), walk_snapshot=None, failures=None):
+    """
+    Yields (path, size, mtime_ns, inode) for every media file under folder,
+    one directory at a time (see traverse.walk for include, exclude, walk_snapshot
+    and failures). Images in skip_image_dirs are yielded as (path, None, None, None)
+    without a stat.
+    """
+    skip_stat = None
+    if skip_image_dirs:
+        def skip_stat(file_path):
+            return os.path.dirname(file_path) in skip_image_dirs \
+                and os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+
+    for file_path, _, size, mtime_ns, inode in TRV.walk(
+            folder, include, exclude, MEDIA_EXTENSIONS,
+            snapshot_path=walk_snapshot, skip_stat=skip_stat, metrics=metrics, failures=failures):
+        yield (file_path, size, mtime_ns, inode)
+
+def ensure_columns(cursor, table_name, columns):
+    """
+    Adds any missing columns to an existing table (used to upgrade older
+    databases) and returns the names of the columns it added.
+    """
+    existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table_name})')}
+    added = []
+    for column_name, column_type in columns:
+        if column_name not in existing:
+            cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}')
+            added.append(column_name)
+    return added
+
+def migrate_phash_column(conn):
+    """
+    Rebuilds a hashes table from an older database that stored pHashes as hex
+    TEXT so they are kept as signed 64-bit INTEGERs (see phash_to_int), and
+    converts the image hashes kept in scan_state to match. image_ids are
+    preserved so near_duplicates groups stay valid. Returns True if it migrated.
+    """
+    columns = {row[1]: row[2] for row in conn.execute('PRAGMA table_info(hashes)')}
+    if columns.get('phash', '').upper() != 'TEXT':
+        return False
+    conn.create_function('phash_to_int', 1, phash_to_int, deterministic=True)
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'hashes'").fetchone()
+    conn.execute('BEGIN')
+    with conn:
+        conn.execute('''
+            CREATE TABLE hashes_migrated (
+                image_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT UNIQUE,
+                path TEXT UNIQUE,
+                phash INTEGER UNIQUE,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER
+            )
+        ''')
+        conn.execute('''
+            INSERT INTO hashes_migrated (image_id, filename, path, phash, size, mtime_ns, inode)
+            SELECT image_id, filename, path,
+                   CASE typeof(phash) WHEN 'text' THEN phash_to_int(phash) ELSE phash END,
+                   size, mtime_ns, inode
+            FROM hashes
+        ''')
+        conn.execute('DROP TABLE hashes')
+        conn.execute('ALTER TABLE hashes_migrated RENAME TO hashes')
+        if sequence:
+            conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'hashes'", sequence)
+        conn.execute(
+            "UPDATE scan_state SET hash_value = phash_to_int(hash_value) WHERE kind = 'hashes' AND hash_value IS NOT NULL"
+        )
+    print(f"Migrated {conn.execute('SELECT count(*) FROM hashes').fetchone()[0]} pHashes to INTEGER storage")
+    return True
+
+def journal_mode(conn):
+    """
+    WAL, unless the database's meta table records another journal mode
+    (workqueue plan --shared does, for a database shared between hosts).
+    """
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'journal_mode'").fetchone()
+    except sqlite3.OperationalError:
+        return 'WAL'  # No meta table yet.
+    return row[0] if row else 'WAL'
 
 def initialize_database(db_name):
     conn = sqlite3.connect(db_name)
-    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA journal_mode={journal_mode(conn)}')
     conn.execute('PRAGMA synchronous=NORMAL')
     conn.execute('PRAGMA busy_timeout=5000')
     cursor = conn.cursor()
@@ -82,7 +771,7 @@ def initialize_database(db_name):
             image_id INTEGER PRIMARY KEY AUTOINCREMENT,
             filename TEXT UNIQUE,
             path TEXT UNIQUE,
-            phash TEXT UNIQUE
+            phash INTEGER UNIQUE
         )
     ''')
     cursor.execute('''
@@ -93,68 +782,682 @@ def initialize_database(db_name):
             mhash TEXT UNIQUE
         )
     ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scan_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            folder TEXT NOT NULL,
+            started_at REAL,
+            updated_at REAL,
+            finished_at REAL,
+            status TEXT NOT NULL,
+            last_batch INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scan_run_dirs (
+            run_id INTEGER NOT NULL,
+            directory TEXT NOT NULL,
+            PRIMARY KEY (run_id, directory)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scan_state (
+            path TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            filename TEXT,
+            hash_value TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exact_duplicates (
+            path TEXT PRIMARY KEY,
+            original_path TEXT NOT NULL,
+            content_hash TEXT
+        )
+    ''')
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    ensure_columns(cursor, 'hashes', STAT_COLUMNS)
+    video_columns = STAT_COLUMNS + (('hash_stage', 'TEXT'), ('hash_algorithm', 'TEXT'), ('sample_hash', 'TEXT'))
+    added = ensure_columns(cursor, 'video_hashes', video_columns)
+    if 'hash_algorithm' in added:
+        # Everything hashed before the column existed was MD5.
+        cursor.execute("UPDATE video_hashes SET hash_algorithm = 'md5'")
+    if 'sample_hash' in added:
+        # Before the column existed, 'size' and 'sample' rows kept their sample hash in mhash.
+        cursor.execute('''
+            UPDATE scan_state SET hash_value = NULL WHERE kind = 'video_hashes'
+              AND path IN (SELECT path FROM video_hashes WHERE hash_stage IN ('size', 'sample'))
+        ''')
+        cursor.execute("UPDATE video_hashes SET sample_hash = mhash, mhash = NULL WHERE hash_stage IN ('size', 'sample')")
+    if 'hash_algorithm' in ensure_columns(cursor, 'scan_state', (('hash_algorithm', 'TEXT'),)):
+        cursor.execute("UPDATE scan_state SET hash_algorithm = 'md5' WHERE kind = 'video_hashes'")
+    # ExactImageIndex looks up earlier images by size.
+    cursor.execute('CREATE INDEX IF NOT EXISTS scan_state_size ON scan_state (size)')
     conn.commit()
+    migrate_phash_column(conn)
     return conn
 
-def flush_batches(conn, batches):
+def resolve_video_algorithm(conn, requested=None):
+    """
+    Picks the video hash algorithm for a run: requested if given, otherwise the
+    one most stored videos were hashed with, so an existing database stays
+    comparable, otherwise VIDEO_HASH_ALGORITHM.
+    """
+    if requested is None:
+        row = conn.execute('''
+            SELECT hash_algorithm FROM video_hashes WHERE hash_algorithm IS NOT NULL
+            GROUP BY hash_algorithm ORDER BY count(*) DESC LIMIT 1
+        ''').fetchone()
+        requested = row[0] if row else VIDEO_HASH_ALGORITHM
+    return resolve_hash_algorithm(requested)
+
+def resolve_source_id(conn, requested=None, folder=None):
+    """
+    The source (volume/machine) ID this database is a shard of, which
+    mergeshards tags its rows with. requested replaces the stored one; a
+    database without one gets "<hostname>:<folder>" on its first scan.
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key = 'source_id'").fetchone()
+    if requested is None and row is not None:
+        return row[0]
+    source_id = requested or f"{socket.gethostname()}:{os.path.abspath(folder)}"
+    if row is None or row[0] != source_id:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source_id', ?)", (source_id,))
+    return source_id
+
+def load_known_videos(conn, folder):
+    """Returns {size: [(path, size, mtime_ns, inode), ...]} for previously scanned videos under folder."""
+    prefix = os.path.join(folder, '')
+    cursor = conn.execute(
+        "SELECT path, size, mtime_ns, inode FROM scan_state WHERE kind = 'video_hashes' AND substr(path, 1, ?) = ?",
+        (len(prefix), prefix),
+    )
+    known = {}
+    for entry in cursor:
+        known.setdefault(entry[1], []).append(entry)
+    return known
+
+def load_stat_signatures(conn, folder, video_algorithm=None):
+    """
+    Returns {path: (size, mtime_ns, inode)} for every previously scanned file under folder.
+    With video_algorithm, videos hashed with a different algorithm are left out
+    so they are re-hashed and every video under folder ends up comparable.
+    """
+    prefix = os.path.join(folder, '')
+    cursor = conn.execute(
+        '''SELECT path, size, mtime_ns, inode FROM scan_state
+           WHERE substr(path, 1, ?) = ?
+             AND (kind != 'video_hashes' OR ? IS NULL OR hash_algorithm = ?)''',
+        (len(prefix), prefix, video_algorithm, video_algorithm),
+    )
+    return {path: (size, mtime_ns, inode) for path, size, mtime_ns, inode in cursor}
+
+def prune_missing_files(conn, missing_paths):
+    """Removes rows for files that were scanned before but no longer exist."""
+    rows = [(path,) for path in missing_paths]
+    with conn:
+        conn.executemany('DELETE FROM hashes WHERE path = ?', rows)
+        conn.executemany('DELETE FROM video_hashes WHERE path = ?', rows)
+        conn.executemany('DELETE FROM scan_state WHERE path = ?', rows)
+        conn.executemany('DELETE FROM exact_duplicates WHERE path = ? OR original_path = ?', [row * 2 for row in rows])
+    return len(rows)
+
+def promote_orphaned_duplicates(conn):
+    """
+    Re-inserts known duplicates whose representative row was pruned or changed,
+    using the hashes kept in scan_state so nothing has to be decoded again.
+    """
+    with conn:
+        conn.execute('''
+            INSERT OR IGNORE INTO hashes (filename, path, phash, size, mtime_ns, inode)
+            SELECT filename, path, hash_value, size, mtime_ns, inode FROM scan_state
+            WHERE kind = 'hashes'
+              AND hash_value NOT IN (SELECT phash FROM hashes WHERE phash IS NOT NULL)
+            ORDER BY rowid
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO video_hashes (filename, path, mhash, size, mtime_ns, inode, hash_algorithm)
+            SELECT filename, path, hash_value, size, mtime_ns, inode, hash_algorithm FROM scan_state
+            WHERE kind = 'video_hashes' AND hash_value IS NOT NULL
+              AND hash_value NOT IN (SELECT mhash FROM video_hashes WHERE mhash IS NOT NULL)
+            ORDER BY rowid
+        ''')
+
+def flush_batches(conn, batches, checkpoint=None, metrics=None, defer_hashes=False):
+    """
+    Writes all pending rows in one transaction. checkpoint, if given, is called
+    inside the same transaction so journal updates commit together with the rows.
+    With defer_hashes, image rows only go to scan_state; build_deferred_hashes
+    fills the hashes table from there afterwards.
+    """
     rows_to_write = 0
+    start = time.perf_counter()
     with conn:
         for table_name, rows in batches.items():
             if not rows:
                 continue
-            if table_name == 'hashes':
+            if table_name == 'exact_duplicates':
                 conn.executemany(
-                    'INSERT OR IGNORE INTO hashes (filename, path, phash) VALUES (?, ?, ?)',
+                    'INSERT OR REPLACE INTO exact_duplicates (path, original_path, content_hash) VALUES (?, ?, ?)',
                     rows,
                 )
+                rows_to_write += len(rows)
+                rows.clear()
+                continue
+            # A changed file keeps its path, so drop its old row before inserting the new hash.
+            paths = [(row[1],) for row in rows]
+            if table_name == 'hashes':
+                if not defer_hashes:
+                    conn.executemany('DELETE FROM hashes WHERE path = ?', paths)
+                    # A re-hashed file may no longer be a copy, nor the original of its old copies; links
+                    # that still hold are staged after this, and promote_orphaned_duplicates re-inserts the rest.
+                    conn.executemany('DELETE FROM exact_duplicates WHERE path = ? OR original_path = ?', [path * 2 for path in paths])
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO hashes (filename, path, phash, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?)',
+                        rows,
+                    )
             else:
+                conn.executemany('DELETE FROM video_hashes WHERE path = ?', paths)
                 conn.executemany(
-                    'INSERT OR IGNORE INTO video_hashes (filename, path, mhash) VALUES (?, ?, ?)',
+                    'INSERT OR IGNORE INTO video_hashes (filename, path, mhash, size, mtime_ns, inode, hash_stage, hash_algorithm, sample_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
                     rows,
                 )
+            conn.executemany(
+                'INSERT OR REPLACE INTO scan_state (path, kind, filename, hash_value, size, mtime_ns, inode, hash_algorithm) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(path, table_name, filename, hash_value, size, mtime_ns, inode, rest[1] if table_name == 'video_hashes' else None)
+                 for filename, path, hash_value, size, mtime_ns, inode, *rest in rows],
+            )
             rows_to_write += len(rows)
             rows.clear()
+        if checkpoint is not None:
+            checkpoint(conn)
+        inserted = time.perf_counter()
+    if metrics is not None:
+        committed = time.perf_counter()
+        metrics.observe('db_flush', committed - start)
+        metrics.observe('db_commit', committed - inserted)
+        metrics.incr('rows_written', rows_to_write)
     return rows_to_write
 
-def process_images_and_store_hashes(folder, db_name='imagehash.db', max_workers=2, batch_size=DEFAULT_BATCH_SIZE, chunksize=32):
-    conn = None
+def stage_row(conn, batches, table_name, row, batch_size, checkpoint=None, metrics=None):
+    """Queues a row for table_name and flushes all batches once batch_size rows are pending."""
+    batches[table_name].append(row)
+    if sum(len(rows) for rows in batches.values()) >= batch_size:
+        return flush_batches(conn, batches, checkpoint, metrics)
+    return 0
+
+def is_fresh_database(conn):
+    return conn.execute('SELECT 1 FROM scan_state LIMIT 1').fetchone() is None
+
+def resolve_bulk_load(conn, requested=None):
+    """
+    Whether a run loads in bulk: requested if given, otherwise whether the
+    database has no scan state yet. Bulk mode only adds hashes rows, so it
+    cannot replace those of files rewritten since an earlier scan; asking
+    for it on a database that has been scanned before is an error.
+    """
+    fresh = is_fresh_database(conn)
+    if requested and not fresh:
+        raise ValueError("bulk_load=True needs a database that has not been scanned yet")
+    return fresh if requested is None else requested
+
+def build_deferred_hashes(conn):
+    """Fills hashes from scan_state after a bulk load and restores the index dropped for it."""
+    promote_orphaned_duplicates(conn)
+    with conn:
+        conn.execute('CREATE INDEX IF NOT EXISTS scan_state_size ON scan_state (size)')
+
+class DatabaseWriter(threading.Thread):
+    """
+    Commits rows on its own thread and connection, so the thread consuming
+    worker results never waits for a transaction. Rows are queued with put();
+    with a run_id, directories passed to finish_directory() are journaled in
+    the same transaction as the rows queued before them.
+
+    bulk=True is for filling a fresh database: bigger transactions and page
+    cache, and image rows only go to scan_state during the load. close()
+    then builds the hashes table, and its UNIQUE indexes, in one pass.
+    """
+
+    STOP = object()
+
+    def __init__(self, db_name, batch_size=DEFAULT_BATCH_SIZE, metrics=None, run_id=None, bulk=False):
+        super().__init__(name='db-writer', daemon=True)
+        self.db_name = db_name
+        self.batch_size = max(batch_size, BULK_BATCH_SIZE) if bulk else batch_size
+        self.metrics = metrics if metrics is not None else MET.Metrics('db_writer')
+        self.run_id = run_id
+        self.bulk = bulk
+        self.queue = queue.Queue(WRITER_QUEUE_SIZE)
+        self.error = None
+        self.rows = 0
+        self.commits = 0
+        self.busy_seconds = 0.0
+        self.start()
+
+    def put(self, table_name, row):
+        if self.error is not None:
+            raise RuntimeError("Database writer failed") from self.error
+        self.queue.put((table_name, row))
+
+    def finish_directory(self, directory):
+        self.put(None, directory)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name)
+        conn.execute(f'PRAGMA journal_mode={journal_mode(conn)}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        if self.bulk:
+            for pragma in BULK_PRAGMAS:
+                conn.execute(pragma)
+            with conn:
+                # Rebuilt by build_deferred_hashes (or the next initialize_database).
+                conn.execute('DROP INDEX IF EXISTS scan_state_size')
+        return conn
+
+    def run(self):
+        conn = None
+        stopped = False
+        try:
+            conn = self.connect()
+            batches = {'hashes': [], 'video_hashes': [], 'exact_duplicates': []}
+            finished_dirs = []
+            checkpoint = None
+            if self.run_id is not None:
+                def checkpoint(conn):
+                    record_checkpoint(conn, self.run_id, finished_dirs)
+
+            pending = 0
+            deadline = time.monotonic() + WRITER_COMMIT_INTERVAL
+            while not stopped:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    item = None
+                if item is self.STOP:
+                    stopped = True
+                elif item is not None:
+                    table_name, row = item
+                    if table_name is None:
+                        finished_dirs.append(row)
+                    else:
+                        batches[table_name].append(row)
+                        pending += 1
+                    if pending < self.batch_size and time.monotonic() < deadline:
+                        continue
+                if pending or finished_dirs:
+                    self.metrics.set_gauge('writer_queue', self.queue.qsize())
+                    self.flush(conn, batches, checkpoint)
+                    pending = 0
+                deadline = time.monotonic() + WRITER_COMMIT_INTERVAL
+            if self.bulk:
+                with self.metrics.timer('db_build'):
+                    build_deferred_hashes(conn)
+        except BaseException as e:
+            self.error = e
+            if not stopped:
+                # Keep taking rows so a producer blocked on the full queue wakes up and sees the error.
+                while self.queue.get() is not self.STOP:
+                    pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def flush(self, conn, batches, checkpoint):
+        start = time.perf_counter()
+        self.rows += flush_batches(conn, batches, checkpoint, self.metrics, defer_hashes=self.bulk)
+        self.busy_seconds += time.perf_counter() - start
+        self.commits += 1
+
+    def close(self):
+        """Commits everything queued (building deferred hashes after a bulk load) and reports throughput."""
+        self.queue.put(self.STOP)
+        self.join()
+        if self.error is not None:
+            raise RuntimeError("Database writer failed") from self.error
+        if self.commits:
+            commit = self.metrics.histograms.get('db_commit')
+            print(
+                f"Database writer{' (bulk load)' if self.bulk else ''}: {self.rows} rows in {self.commits} "
+                f"transactions, {self.rows / self.busy_seconds if self.busy_seconds else 0:.0f} rows/s while writing, "
+                f"commit p50<={commit.quantile(0.5) * 1000:g}ms p99<={commit.quantile(0.99) * 1000:g}ms"
+            )
+
+def start_run(conn, folder, resume=True):
+    """
+    Returns (run_id, finished_dirs). Resumes the newest unfinished run for
+    folder when resume is set, otherwise starts a new one.
+    """
+    now = time.time()
+    row = None
+    if resume:
+        row = conn.execute(
+            "SELECT run_id, last_batch FROM scan_runs WHERE folder = ? AND status != 'completed' "
+            "ORDER BY run_id DESC LIMIT 1",
+            (folder,),
+        ).fetchone()
+    with conn:
+        if row is None:
+            cursor = conn.execute(
+                "INSERT INTO scan_runs (folder, started_at, updated_at, status) VALUES (?, ?, ?, 'running')",
+                (folder, now, now),
+            )
+            return cursor.lastrowid, set()
+        run_id, last_batch = row
+        conn.execute(
+            "UPDATE scan_runs SET status = 'running', updated_at = ?, error = NULL WHERE run_id = ?",
+            (now, run_id),
+        )
+    finished_dirs = {directory for directory, in conn.execute(
+        'SELECT directory FROM scan_run_dirs WHERE run_id = ?', (run_id,)
+    )}
+    print(f"Resuming run {run_id} after batch {last_batch}: {len(finished_dirs)} directories already done")
+    # A bulk load that died without closing its writer left images in scan_state only.
+    promote_orphaned_duplicates(conn)
+    return run_id, finished_dirs
+
+def record_checkpoint(conn, run_id, finished_dirs):
+    """Marks a committed batch and the directories it completed; call inside the batch transaction."""
+    conn.execute(
+        'UPDATE scan_runs SET last_batch = last_batch + 1, updated_at = ? WHERE run_id = ?',
+        (time.time(), run_id),
+    )
+    conn.executemany(
+        'INSERT OR IGNORE INTO scan_run_dirs (run_id, directory) VALUES (?, ?)',
+        [(run_id, directory) for directory in finished_dirs],
+    )
+    finished_dirs.clear()
+
+def finish_run(conn, run_id, status, error=None):
+    now = time.time()
+    with conn:
+        conn.execute(
+            'UPDATE scan_runs SET status = ?, updated_at = ?, finished_at = ?, error = ? WHERE run_id = ?',
+            (status, now, now if status == 'completed' else None, error, run_id),
+        )
+        if status == 'completed':
+            conn.execute('DELETE FROM scan_run_dirs WHERE run_id = ?', (run_id,))
+
+def load_image_libraries(batch_size=PHASH_BATCH_SIZE):
+    """
+    Registers every Pillow format plugin and sizes this thread's pHash buffers,
+    so the first batch a worker gets does not pay for it (or show it in its
+    open/hash timings).
+    """
+    Image.init()
+    phash_workspace(batch_size)
+
+def init_worker(batch_size=PHASH_BATCH_SIZE):
+    """
+    Pool initializer: leaves SIGINT to the parent, which drains the pool instead
+    of letting workers die mid-batch, and loads the image libraries once.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_image_libraries(batch_size)
+
+def map_ordered_bounded(executor, function, items, max_pending, stop_event=None, metrics=None):
+    """
+    Like executor.map, but submits lazily with at most max_pending items in
+    flight and stops pulling new items once stop_event is set. Yields
+    (item, result) in submission order.
+    """
+    pending = deque()
+    iterator = iter(items)
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending and not (stop_event and stop_event.is_set()):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.append((item, executor.submit(function, item)))
+        if metrics is not None:
+            metrics.set_gauge('queue_depth', len(pending))
+        if not pending:
+            return
+        item, future = pending.popleft()
+        yield item, future.result()
+
+class StopRequest:
+    """Turns SIGINT/SIGTERM into a flag while active, restoring the old handlers afterwards."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.previous = {}
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.previous[signum] = signal.signal(signum, self.handle)
+        return self.event
+
+    def handle(self, signum, frame):
+        if self.event.is_set():
+            # A second signal means "stop now".
+            raise KeyboardInterrupt
+        print(f"\nReceived {signal.Signals(signum).name}, finishing in-flight work and saving progress...")
+        self.event.set()
+
+    def __exit__(self, *exc_info):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+        return False
+
+def add_known_same_size_videos(conn, folder, video_entries, seen_paths):
+    """Unchanged videos that share a size with new ones must take part in the staging again."""
+    known_videos = load_known_videos(conn, folder)
+    queued_paths = {entry[0] for entry in video_entries}
+    for size in {entry[1] for entry in video_entries}:
+        video_entries.extend(
+            entry for entry in known_videos.get(size, ())
+            if entry[0] in seen_paths and entry[0] not in queued_paths
+        )
+
+def under_failures(path, failures):
+    """Whether path is one of the failed paths traverse.walk reported, or lies under one."""
+    while path not in failures:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return True
+
+def finish_incremental(conn, known_signatures, seen_paths, changed_files, failures=()):
+    """
+    Prunes rows for vanished files and re-promotes their duplicates; returns the pruned count.
+    Files that were not seen because they are, or lie under, one of the failures
+    the walk reported are kept: they could not be read, which is not the same as gone.
+    """
+    pruned_files = 0
+    missing_paths = known_signatures.keys() - seen_paths
+    if failures:
+        failures = set(failures)
+        missing_paths = {path for path in missing_paths if not under_failures(path, failures)}
+    if missing_paths:
+        pruned_files = prune_missing_files(conn, missing_paths)
+    if pruned_files or changed_files:
+        promote_orphaned_duplicates(conn)
+    return pruned_files
+
+def process_images_and_store_hashes(folder, db_name='imagehash.db', max_workers=2, batch_size=DEFAULT_BATCH_SIZE, chunksize=32, incremental=True, fast_decode=FAST_DECODE, resume=True, metrics_path=None, video_hash=None, include=(), exclude=(), walk_snapshot=None, exact_duplicates=True, thumbnail_cache=None, bulk_load=None, source_id=None):
+    """
+    Hashes every media file under folder into db_name.
+
+    With incremental=True, files whose (size, mtime_ns, inode) signature matches
+    the previous run are skipped, changed files are re-hashed, and rows for files
+    that disappeared from folder are pruned. fast_decode hashes JPEGs from a
+    reduced-resolution decode. video_hash names the video content hash (see
+    VIDEO_HASH_ALGORITHM); videos hashed with another one are re-hashed.
+    include/exclude globs and walk_snapshot are passed to traverse.walk.
+
+    With exact_duplicates=True, byte-identical copies of an image seen earlier
+    (in this run or a previous one) are not decoded: they take the original's
+    pHash and are linked to it in the exact_duplicates table.
+
+    thumbnail_cache names a thumbcache database: images cached there with an
+    unchanged signature are hashed without being decoded, the others are
+    added to it, and it is trimmed to thumbcache.CACHE_MAX_BYTES afterwards.
+
+    Every run is journaled in scan_runs/scan_run_dirs. An interrupted or failed
+    run is resumed by the next call (unless resume=False): images in directories
+    it finished are not looked at again. SIGINT/SIGTERM stop submitting work,
+    drain the pool and commit what is pending before returning.
+
+    Rows are committed by a DatabaseWriter thread, batch_size per transaction.
+    bulk_load (by default: whether db_name has no scan state yet) loads in
+    bulk mode, building the hashes table at the end; it raises ValueError
+    for a database that has been scanned before (see resolve_bulk_load).
+
+    source_id tags db_name as a shard for mergeshards (see resolve_source_id).
+
+    A progress line with stage timings, queue depth and worker utilization is
+    printed every metrics.PROGRESS_INTERVAL seconds, and written to metrics_path
+    (Prometheus textfile for *.prom, JSON otherwise) when given.
+    """
+    conn = initialize_database(db_name)
+    run_id = None
     try:
-        conn = initialize_database(db_name)
-        batches = {
-            'hashes': [],
-            'video_hashes': [],
-        }
+        bulk_load = resolve_bulk_load(conn, bulk_load)
+        run_id, resumed_dirs = start_run(conn, folder, resume)
+        resolve_source_id(conn, source_id, folder)
 
-        scanned_files = 0
-        staged_rows = 0
+        video_algorithm = resolve_video_algorithm(conn, video_hash)
+        known_signatures = load_stat_signatures(conn, folder, video_algorithm) if incremental else {}
+        if include or exclude:
+            # Files filtered out of this walk are not missing; keep them out of pruning.
+            known_signatures = {
+                path: signature for path, signature in known_signatures.items()
+                if TRV.selects(folder, path, include, exclude)
+            }
+        seen_paths = set()
+        walk_failures = []
+        video_entries = []
+        counts = {'skipped': 0, 'rehashed': 0, 'changed': 0}
 
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            for result in executor.map(process_single_file, iter_media_files(folder), chunksize=chunksize):
-                scanned_files += 1
-                if result is None:
+        def entries_to_hash():
+            for entry in iter_media_entries(folder, resumed_dirs, metrics, include, exclude, walk_snapshot, walk_failures):
+                file_path = entry[0]
+                seen_paths.add(file_path)
+                if entry[1] is None:
+                    # Image in a directory a previous attempt of this run already finished.
+                    counts['skipped'] += 1
+                    continue
+                if known_signatures.get(file_path) == entry[1:]:
+                    counts['skipped'] += 1
                     continue
+                counts['rehashed'] += 1
+                if file_path in known_signatures:
+                    counts['changed'] += 1
+                if os.path.splitext(file_path)[1].lower() in VIDEO_EXTENSIONS:
+                    video_entries.append(entry)
+                    continue
+                yield entry
+
+        scanned_files = 0
+        current_dir = None
+
+        with MET.track('dupchecker', snapshot_path=metrics_path) as metrics, StopRequest() as stop_event, \
+                ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(chunksize,)) as executor:
+            metrics.set_gauge('workers', max_workers)
+            # A fresh database has no earlier images to match, and no size index during a bulk load.
+            exact_index = None
+            image_entries = entries_to_hash()
+            if exact_duplicates:
+                exact_index = ExactImageIndex(None if bulk_load else conn, metrics=metrics, executor=executor)
+                image_entries = resolve_exact_copies(image_entries, exact_index)
+            writer = DatabaseWriter(db_name, batch_size, metrics, run_id, bulk_load)
+            try:
+                # Images are hashed chunksize at a time so the DCT runs over a whole stack.
+                image_batches = chunked(image_entries, chunksize)
+                hash_batch = partial(MET.call_with_timings, process_image_batch, fast_decode=fast_decode, thumbnail_cache=thumbnail_cache)
+                for entries, (results, timings) in map_ordered_bounded(executor, hash_batch, image_batches, max_workers * 2, stop_event, metrics):
+                    metrics.observe_many(timings)
+                    metrics.incr('files', len(entries))
+                    for entry, result in zip(entries, results):
+                        scanned_files += 1
+                        # Results arrive in walk order, so a new directory means the previous one is done.
+                        entry_dir = os.path.dirname(entry[0])
+                        if entry_dir != current_dir:
+                            if current_dir is not None:
+                                writer.finish_directory(current_dir)
+                            current_dir = entry_dir
+                        if len(entry) == 5:
+                            # The original came earlier in the same order, so its pHash is known by now.
+                            original = exact_index.lookup(entry[4], entry[1])
+                            if original.outcome is None:
+                                metrics.incr('exact_copies_unhashed')
+                                print(f"Error calculating pHash for {entry[0]}: exact copy of {original.path}, which could not be hashed")
+                                continue
+                            row, link = exact_duplicate_rows(entry, original, original.outcome)
+                            writer.put('hashes', row)
+                            # Queued after the hashes row, whose flush clears links for its path.
+                            writer.put('exact_duplicates', link)
+                        else:
+                            if exact_index is not None:
+                                exact_index.record(entry[0], entry[1], result[3] if result else None)
+                            if result is not None:
+                                writer.put(result[0], result[1:])
+
+                if current_dir is not None and not stop_event.is_set():
+                    writer.finish_directory(current_dir)
 
-                table_name, filename, path, hash_value = result
-                batches[table_name].append((filename, path, hash_value))
-                staged_rows += 1
+                if not stop_event.is_set():
+                    if video_entries and incremental:
+                        add_known_same_size_videos(conn, folder, video_entries, seen_paths)
 
-                if staged_rows >= batch_size:
-                    written_rows = flush_batches(conn, batches)
-                    print(f"Scanned {scanned_files} files, staged {written_rows} rows")
-                    staged_rows = 0
+                    for row in hash_videos_staged(executor, video_entries, metrics=metrics, algorithm=video_algorithm):
+                        scanned_files += 1
+                        metrics.incr('files')
+                        writer.put('video_hashes', row)
+                        if stop_event.is_set():
+                            break
 
-        if any(batches.values()):
-            written_rows = flush_batches(conn, batches)
-            print(f"Flushed final {written_rows} rows")
+                if stop_event.is_set():
+                    executor.shutdown(wait=True, cancel_futures=True)
+            finally:
+                writer.close()
+
+        if stop_event.is_set():
+            finish_run(conn, run_id, 'interrupted')
+            print(f"Interrupted after {scanned_files} files; run {run_id} will resume on the next start")
+            return
+
+        pruned_files = 0
+        if incremental:
+            pruned_files = finish_incremental(conn, known_signatures, seen_paths, counts['changed'], walk_failures)
+        if walk_failures:
+            # Leave the run unfinished so the next start resumes it and looks at these paths again.
+            finish_run(conn, run_id, 'failed', f"Could not read {len(walk_failures)} paths: " + ', '.join(walk_failures[:10]))
+        else:
+            finish_run(conn, run_id, 'completed')
+        if thumbnail_cache:
+            TC.evict(thumbnail_cache)
 
         print(f"Processed {scanned_files} media files and stored hashes in {db_name}")
-    except Exception as e:
-        print(f"Error processing folder {folder}: {e}")
+        if exact_index is not None and exact_index.duplicates:
+            print(f"Skipped decoding {exact_index.duplicates} exact duplicate images")
+        if incremental:
+            print(f"Skipped {counts['skipped']} unchanged files, re-hashed {counts['rehashed']}, pruned {pruned_files} missing")
+        if walk_failures:
+            print(f"Could not read {len(walk_failures)} paths; kept their rows, run {run_id} is left unfinished")
+    except BaseException as e:
+        print(f"Error processing folder {folder}: {e!r}")
+        traceback.print_exc()
+        if run_id is not None:
+            try:
+                finish_run(conn, run_id, 'failed', traceback.format_exc())
+            except sqlite3.Error:
+                pass
+        raise
     finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        conn.close()
 
 def dupchecker_main(IMAGE_FOLDER):
     process_images_and_store_hashes(IMAGE_FOLDER)
@@ -1,62 +1,143 @@
+import argparse
+import json
 import os
+import sqlite3
+import time
+from collections import Counter
+
+import traverse as TRV
+
+# Extensions always listed in the summary, in this order, even when absent.
+SUMMARY_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.mp4', '.3gp', '.json', '.pdf')
 
 
 class ExtCount:
+    """Streaming census of file extensions (count and total bytes) under a folder."""
+
     def __init__(self, folder):
-        # image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp']
-        self.pngcount = 0
-        self.jpgcount = 0
-        self.jpegcount = 0
-        self.gifcount = 0
-        self.bmpcount = 0
-        self.count3gp = 0
-        self.jsoncount = 0
-        self.pdfcount = 0
-        self.mp4count = 0
         self.folder = folder
-        self.ext_list = []
-
-    def get_ext_count(self):
-        for dir, _, files in os.walk(self.folder):
-            for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                self.ext_list.append(ext)
-                fpath = os.path.join(dir, file)
-
-                if file.lower().endswith(".png"):
-                    self.pngcount += 1
-                    print(file)
-                elif file.lower().endswith(".jpg"):
-                    self.jpgcount += 1
-                elif file.lower().endswith(".jpeg"):
-                    self.jpegcount += 1
-                elif file.lower().endswith(".gif"):
-                    self.gifcount += 1
-                elif file.lower().endswith(".bmp"):
-                    self.bmpcount += 1
-                elif file.lower().endswith(".mp4"):
-                    self.mp4count += 1
-                elif file.lower().endswith(".3gp"):
-                    self.count3gp += 1
-                    print(fpath)
-                elif file.lower().endswith(".json"):
-                    self.jsoncount += 1
-                elif file.lower().endswith(".pdf"):
-                    self.pdfcount += 1
-
-
-        print(f"PNG: {self.pngcount}")
-        print(f"JPG: {self.jpgcount}")
-        print(f"JPEG: {self.jpegcount}")
-        print(f"GIF: {self.gifcount}")
-        print(f"BMP: {self.bmpcount}")
-        print(f"MP4: {self.mp4count}")
-        print(f"3GP: {self.count3gp}")
-        print(f"JSON: {self.jsoncount}")
-        print(f"PDF: {self.pdfcount}")
-        print(f"ext_list: {list(set(self.ext_list))}")
+        self.counts = Counter()
+        self.sizes = Counter()
+        self.source = 'disk'
+        self.created = None
+
+    def get_ext_count(self, with_sizes=True):
+        """Walks folder once with os.scandir and prints the summary."""
+        self.scan(with_sizes)
+        self.print_summary()
+        return self
+
+    def scan(self, with_sizes=True, include=(), exclude=(), snapshot_path=None):
+        """
+        Counts every file under folder. with_sizes=False skips the stat() per
+        file, which is most of the cost on network or spinning disks.
+        include, exclude and snapshot_path are passed to traverse.walk.
+        """
+        skip_stat = None if with_sizes else (lambda path: True)
+        for path, name, size, _, _ in TRV.walk(self.folder, include, exclude, snapshot_path=snapshot_path, skip_stat=skip_stat):
+            self.add_file(name, path, size)
+        self.source = 'disk'
+        self.created = time.time()
+        return self
+
+    def add_file(self, file, fpath=None, size=None):
+        ext = os.path.splitext(file)[1].lower()
+        self.counts[ext] += 1
+        if size is not None:
+            self.sizes[ext] += size
+
+    def from_database(self, db_name):
+        """
+        Answers from the scan_state table dupchecker keeps, without touching the
+        files. Only media files are recorded there, so other extensions are absent.
+        """
+        prefix = os.path.join(self.folder, '')
+        conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True)
+        try:
+            cursor = conn.execute(
+                'SELECT path, size FROM scan_state WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix),
+            )
+            for path, size in cursor:
+                self.add_file(os.path.basename(path), path, size)
+        finally:
+            conn.close()
+        self.source = f"database:{db_name}"
+        self.created = time.time()
+        return self
+
+    def from_snapshot(self, snapshot_path):
+        """Loads a census written earlier by save_snapshot (or --json)."""
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        self.folder = snapshot['folder']
+        self.counts = Counter({ext: stats['count'] for ext, stats in snapshot['extensions'].items()})
+        self.sizes = Counter({ext: stats['bytes'] for ext, stats in snapshot['extensions'].items() if stats['bytes'] is not None})
+        self.source = f"snapshot:{snapshot_path}"
+        self.created = snapshot.get('created')
+        return self
+
+    def to_dict(self):
+        return {
+            'folder': self.folder,
+            'source': self.source,
+            'created': self.created,
+            'files': sum(self.counts.values()),
+            'bytes': sum(self.sizes.values()) if self.sizes else None,
+            'extensions': {
+                ext: {'count': count, 'bytes': self.sizes[ext] if ext in self.sizes else None}
+                for ext, count in self.counts.most_common()
+            },
+        }
+
+    def save_snapshot(self, snapshot_path):
+        tmp_path = f"{snapshot_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp_path, snapshot_path)
+
+    def print_summary(self):
+        def line(ext):
+            size = f" ({self.sizes[ext] / 1e6:.1f} MB)" if ext in self.sizes else ""
+            return f"{(ext.lstrip('.') or '(none)').upper()}: {self.counts[ext]}{size}"
+
+        for ext in SUMMARY_EXTENSIONS:
+            print(line(ext))
+        others = [ext for ext, _ in self.counts.most_common() if ext not in SUMMARY_EXTENSIONS]
+        for ext in others:
+            print(line(ext))
+        print(f"ext_list: {sorted(self.counts)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count files and bytes per extension under a folder.")
+    parser.add_argument('folder', nargs='?', default='/home/whitepi/Pictures')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--db', help="Answer from this dupchecker database instead of the disk (media files only)")
+    source.add_argument('--snapshot', help="Answer from a census saved earlier with --save")
+    parser.add_argument('--no-sizes', action='store_true', help="Skip the per-file stat (no byte totals)")
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB', help="Only count matching files (repeatable)")
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB', help="Skip matching files and directories (repeatable)")
+    parser.add_argument('--walk-snapshot', metavar='PATH', help="Directory snapshot database; unchanged directories are not listed again")
+    parser.add_argument('--json', action='store_true', help="Print JSON instead of the summary")
+    parser.add_argument('--save', metavar='PATH', help="Save the census as a snapshot for --snapshot")
+    args = parser.parse_args(argv)
+
+    ext_count = ExtCount(args.folder)
+    if args.db:
+        ext_count.from_database(args.db)
+    elif args.snapshot:
+        ext_count.from_snapshot(args.snapshot)
+    else:
+        ext_count.scan(not args.no_sizes, args.include, args.exclude, args.walk_snapshot)
+
+    if args.save:
+        ext_count.save_snapshot(args.save)
+    if args.json:
+        print(json.dumps(ext_count.to_dict(), indent=1))
+    else:
+        ext_count.print_summary()
 
 
 if __name__ == '__main__':
-    folder = '/home/whitepi/Pictures'
-    ext_counter = ExtCount(folder).get_ext_count()
\ No newline at end of file
+    main()
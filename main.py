@@ -1,15 +1,140 @@
-import dupchecker as DC
-import makemaster as MM
-import split as SPL
-import info as INF
-import corruptfiles as CF
+"""
+Command line entry point for the whole toolchain.
+
+    python main.py [all] [folder] [--destination DIR] [--max-gb N] [--plan PATH]
+    python main.py pipeline|hash|corrupt|makemaster|split ...
+    python main.py info|near|verify|merge|queue ...
+        (same options as info.py, nearduplicates.py, verifyduplicates.py, mergeshards.py, workqueue.py)
+
+Each subcommand imports only the modules it runs, so `main.py info` starts
+without Pillow, numpy or imagehash. Without a subcommand the full chain
+(pipeline, makemaster, split) runs on the folders below.
+"""
+import argparse
+import importlib
+import sys
 
 SOURCE_FOLDER = "/home/whitepi/MasterPics"
 DESTINATION_BASE_FOLDER = "/home/whitepi/MasterPicsDeduped"
 MAX_FOLDER_SIZE_GB = 1.85
+# Subcommands that hand their arguments to the module's own main(argv).
+DELEGATED_COMMANDS = {
+    'info': ('info', "Count files and bytes per extension (see info.py --help)"),
+    'near': ('nearduplicates', "Group near-duplicate images by pHash distance (see nearduplicates.py --help)"),
+    'verify': ('verifyduplicates', "Confirm pHash duplicates with dHash and SSIM (see verifyduplicates.py --help)"),
+    'merge': ('mergeshards', "Merge per-drive hash databases (see mergeshards.py --help)"),
+    'queue': ('workqueue', "Share one scan between worker processes or hosts (see workqueue.py --help)"),
+}
+
+
+def run_all(args):
+    import makemaster as MM
+    import pipeline as PL
+    import split as SPL
+
+    # Corruption check, icon detection, hashing and extension census in one walk.
+    PL.run_pipeline(args.folder)
+    MM.main(args.folder)
+    SPL.split_main(args.folder, args.destination, args.max_gb, args.plan)
+
+
+def run_pipeline(args):
+    import pipeline as PL
+
+    PL.run_pipeline(
+        args.folder, args.db, max_workers=args.workers, metrics_path=args.metrics,
+        include=args.include, exclude=args.exclude, walk_snapshot=args.walk_snapshot,
+        thumbnail_cache=args.thumbnail_cache, source_id=args.source,
+    )
+
+
+def run_hash(args):
+    import dupchecker as DC
+
+    DC.process_images_and_store_hashes(
+        args.folder, args.db, max_workers=args.workers, metrics_path=args.metrics,
+        include=args.include, exclude=args.exclude, walk_snapshot=args.walk_snapshot,
+        thumbnail_cache=args.thumbnail_cache, source_id=args.source,
+    )
+
+
+def run_corrupt(args):
+    import corruptfiles as CF
+
+    if args.tier not in CF.CHECK_TIERS:
+        sys.exit(f"--tier must be one of {', '.join(CF.CHECK_TIERS)}")
+    CF.corruptfiles_main(args.folder, args.tier, thumbnail_cache=args.thumbnail_cache)
+
+
+def run_makemaster(args):
+    import makemaster as MM
+
+    MM.main(args.folder, confirmed_only=args.confirmed_only, db_path=args.db)
+
+
+def run_split(args):
+    import split as SPL
+
+    SPL.split_main(args.folder, args.destination, args.max_gb, args.plan)
+
+
+def add_scan_options(parser):
+    parser.add_argument('folder', nargs='?', default=SOURCE_FOLDER)
+    parser.add_argument('--db', default='imagehash.db', help="Hash database")
+    parser.add_argument('--workers', type=int, default=2, help="Decode/hash processes")
+    parser.add_argument('--metrics', metavar='PATH', help="Write a metrics snapshot here")
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB', help="Only process matching files (repeatable)")
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB', help="Skip matching files and directories (repeatable)")
+    parser.add_argument('--walk-snapshot', metavar='PATH', help="Directory snapshot database; unchanged directories are not listed again")
+    parser.add_argument('--thumbnail-cache', metavar='PATH', help="Thumbnail cache database; unchanged images are not decoded again")
+    parser.add_argument('--source', metavar='ID', help="Source/volume ID the database is tagged with for merge (default host:folder)")
+
+
+def add_split_options(parser):
+    parser.add_argument('folder', nargs='?', default=SOURCE_FOLDER)
+    parser.add_argument('--destination', default=DESTINATION_BASE_FOLDER, help="Where the size-limited subfolders go")
+    parser.add_argument('--max-gb', type=float, default=MAX_FOLDER_SIZE_GB, help="Maximum size per subfolder")
+    parser.add_argument('--plan', metavar='PATH',
+                        help="Split plan file: replayed if it exists (skipping files that changed), else saved there")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Deduplicate and organize a photo and video collection.")
+    parser.set_defaults(
+        run=run_all, folder=SOURCE_FOLDER, destination=DESTINATION_BASE_FOLDER, max_gb=MAX_FOLDER_SIZE_GB, plan=None,
+    )
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    add_split_options(commands.add_parser('all', help="pipeline, then makemaster, then split (the default)"))
+    add_scan_options(commands.add_parser('pipeline', help="Corruption check, icons, hashes and census in one walk"))
+    add_scan_options(commands.add_parser('hash', help="Only store pHashes and video hashes"))
+    corrupt = commands.add_parser('corrupt', help="Delete corrupt images and move icons aside")
+    corrupt.add_argument('folder', nargs='?', default=SOURCE_FOLDER)
+    corrupt.add_argument('--tier', default='verify', help="structure, verify or decode (see corruptfiles.CHECK_TIER)")
+    corrupt.add_argument('--thumbnail-cache', metavar='PATH', help="Thumbnail cache database")
+    makemaster = commands.add_parser('makemaster', help="Copy one file per hash into the master folder")
+    makemaster.add_argument('folder', nargs='?', default=SOURCE_FOLDER)
+    makemaster.add_argument('--db', help="Scan or merged database to read (default makemaster.db_file)")
+    makemaster.add_argument('--confirmed-only', action='store_true',
+                            help="Only collapse duplicates confirmed by the verify subcommand")
+    add_split_options(commands.add_parser('split', help="Split a folder into size-limited subfolders"))
+    for name, (_, help_text) in DELEGATED_COMMANDS.items():
+        commands.add_parser(name, help=help_text, add_help=False)
+
+    for name, run in (('all', run_all), ('pipeline', run_pipeline), ('hash', run_hash), ('corrupt', run_corrupt),
+                      ('makemaster', run_makemaster), ('split', run_split)):
+        commands.choices[name].set_defaults(run=run)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in DELEGATED_COMMANDS:
+        module = importlib.import_module(DELEGATED_COMMANDS[argv[0]][0])
+        return module.main(argv[1:])
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
 
-corruptfiles = CF.corruptfiles_main(SOURCE_FOLDER)
-dcmain = DC.dupchecker_main(SOURCE_FOLDER)
-mmmain = MM.main(SOURCE_FOLDER)
-splmain = SPL.split_main(SOURCE_FOLDER, DESTINATION_BASE_FOLDER, MAX_FOLDER_SIZE_GB)
-infmain = INF.ExtCount(SOURCE_FOLDER).get_ext_count()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
 import os
 import sqlite3
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import dupchecker as DC
+import materialize as MAT
+import mergeshards as MS
 
 # Define the directories and database file
 master_pics_dir = '/media/piir/PiTB/MASTERPICS/'
 db_file = '/home/piir/dupcheckerpy/dupcheckerpy/imagehashes.db'
+FETCH_SIZE = 1000
 
 def create_master_pics_dir(master_pics_dir):
     """Create the MasterPics directory if it doesn't exist."""
@@ -19,107 +24,142 @@ def create_master_pics_dir(master_pics_dir):
         print(f"Directory '{master_pics_dir}' already exists.")
     return master_pics_dir
 
-def create_piclist(db_file):
-    """Create a list of image paths from the database."""
-    piclist = []
+def open_database(db_file):
+    """Open the one read connection shared by every list in a run."""
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("SELECT path, phash FROM hashes")
-        rows = cursor.fetchall()
-        for row in rows:
-            data = {
-                "path": row[0],
-                "phash": row[1]
-            }
-            piclist.append(data)
-        conn.close()
-        print(f"Successfully retrieved {len(piclist)} image paths from the database.")
+        return sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
     except sqlite3.Error as e:
-        print(f"Error connecting to or querying the database: {e}")
+        print(f"Error connecting to the database: {e}")
         exit(1)
-    return piclist
-
-
-def copy_images(piclist, master_pics_dir):
-    """Copy images from the piclist to the MasterPics directory."""
-    for data in piclist:
-        try:
-            src_path = data["path"]  # Extract the source path from the dictionary
-            if os.path.isfile(src_path):
-                dpath = os.path.join(master_pics_dir, f"{data['phash']}.jpg")
-                shutil.copy2(src_path, dpath)  # Use the extracted path
-                print(f"Copied '{os.path.basename(src_path)}' to\n\t '{dpath}'")
-            else:
-                print(f"Warning: Source path '{src_path}' is not a file. Skipping.")
-        except FileNotFoundError:
-            print(f"Error: Source file '{src_path}' not found.")
-        except OSError as e:
-            print(f"Error copying '{src_path}': {e}")
-# Loop through the piclist and copy the images
-    print("Image copying process completed.")
-
-def create_movlist(db_file):
-    """Create a list of video paths from the database."""
-    
-    movlist = []
 
+def iter_rows(conn, query, fetch_size=FETCH_SIZE):
+    """Stream (path, hash) tuples from the cursor fetch_size rows at a time."""
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("SELECT path, mhash FROM video_hashes")
-        rows = cursor.fetchall()
-        for row in rows:
-            data = {
-                "path": row[0],
-                "mhash": row[1]
-            }
-            movlist.append(data)
-        conn.close()
-        print(f"Successfully retrieved {len(movlist)} video paths from the database.")
+        cursor = conn.execute(query)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
     except sqlite3.Error as e:
-        print(f"Error connecting to or querying the database: {e}")
+        print(f"Error querying the database: {e}")
         exit(1)
-    try:
-        conn.close()
-        print("Database connection closed.")
-    except sqlite3.Error as e:
-        print(f"Error closing the database connection: {e}")
+
+def create_piclist(conn, confirmed_only=False):
+    """
+    Stream (path, phash) tuples for the images in the database, pHashes as hex.
+
+    By default that is one image per pHash. With confirmed_only, every hashed
+    image is listed except the redundant copies in groups verifyduplicates
+    confirmed, so images that merely share a pHash are all kept. A database
+    written by mergeshards lists one image per pHash across all its shards.
+    """
+    if MS.is_merged_database(conn):
+        if confirmed_only:
+            print("Confirmed duplicates are per scan database; run makemaster on a shard for confirmed_only.")
+            exit(1)
+        return iter_rows(conn, "SELECT path, printf('%016x', phash) FROM merged_hashes")
+    if not confirmed_only:
+        return iter_rows(conn, "SELECT path, printf('%016x', phash) FROM hashes")
+    has_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'verified_duplicates'"
+    ).fetchone()
+    if not has_table:
+        print("No verified duplicates in the database; run verifyduplicates.py first.")
         exit(1)
-    return movlist
+    return iter_rows(conn, """
+        SELECT s.path, printf('%016x', CAST(s.hash_value AS INTEGER)) AS phash
+        FROM scan_state s LEFT JOIN verified_duplicates v ON v.path = s.path
+        WHERE s.kind = 'hashes' AND s.hash_value IS NOT NULL AND (v.path IS NULL OR v.keeper)
+        ORDER BY phash, s.path
+    """)
 
-def copy_movies(movlist, master_pics_dir):
-    """Copy videos from the movlist to the MasterPics directory."""
+def unique_names(piclist):
+    """Suffixes repeated pHashes (_1, _2, ...) so unconfirmed look-alikes don't overwrite each other; expects them adjacent."""
+    previous = None
+    repeat = 0
+    for path, phash in piclist:
+        repeat = repeat + 1 if phash == previous else 0
+        previous = phash
+        yield path, phash if not repeat else f"{phash}_{repeat}"
+
+
+def copy_images(piclist, master_pics_dir, strategy=MAT.DEFAULT_STRATEGY, max_workers=MAT.MAX_WORKERS, verbose=False):
+    """Copy images from the piclist to the MasterPics directory."""
+    pairs = (
+        (path, os.path.join(master_pics_dir, f"{name}.jpg"))
+        for path, name in unique_names(piclist)
+    )
+    stats = MAT.materialize(pairs, strategy=strategy, max_workers=max_workers, verbose=verbose)
+    print("Image copying process completed.")
+    return stats
+
+def create_movlist(conn):
+    """
+    Stream (path, mhash, hash_algorithm) tuples for the videos in the database
+    (or in all shards of a merged one). mhash is NULL for videos the scan
+    never had to hash in full.
+    """
+    if MS.is_merged_database(conn):
+        return iter_rows(conn, "SELECT path, mhash, hash_algorithm FROM merged_videos")
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(video_hashes)')}
+    # Databases from before the column existed were all MD5.
+    algorithm = 'hash_algorithm' if 'hash_algorithm' in columns else "'md5'"
+    return iter_rows(conn, f"SELECT path, mhash, {algorithm} FROM video_hashes")
 
-    for data in movlist:
+def full_hash(row):
+    path, mhash, algorithm = row
+    if mhash is None:
         try:
-            src_path = data["path"]  # Extract the source path from the dictionary
-            if os.path.isfile(src_path):
-                dpath = os.path.join(master_pics_dir, f"{data['mhash']}.mp4")
-                shutil.copy2(src_path, dpath)  # Use the extracted path
-                print(f"Copied '{os.path.basename(src_path)}' to\t\n '{dpath}'")
-            else:
-                print(f"Warning: Source path '{src_path}' is not a file. Skipping.")
-        except FileNotFoundError:
-            print(f"Error: Source file '{src_path}' not found.")
+            mhash = DC.calculate_mhash(path, algorithm or 'md5')
         except OSError as e:
-            print(f"Error copying '{src_path}': {e}")
+            print(f"Error hashing {path}: {e}")
+            return None
+        if mhash is None:
+            print(f"Error hashing {path}: file not found")
+    return mhash
+
+def hashed_movies(movlist, max_workers=MAT.MAX_WORKERS):
+    """
+    Stream (path, mhash), hashing the videos that have no mhash yet on a
+    thread pool, so copies the scan never compared still get one name.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for row, mhash in DC.map_ordered_bounded(executor, full_hash, movlist, max_workers * 2):
+            if mhash is not None:
+                yield row[0], mhash
+
+def copy_movies(movlist, master_pics_dir, strategy=MAT.DEFAULT_STRATEGY, max_workers=MAT.MAX_WORKERS, verbose=False):
+    """Copy videos from the movlist to the MasterPics directory."""
+    pairs = (
+        (path, os.path.join(master_pics_dir, f"{mhash}.mp4"))
+        for path, mhash in hashed_movies(movlist, max_workers)
+    )
+    stats = MAT.materialize(pairs, strategy=strategy, max_workers=max_workers, verbose=verbose)
     print("Video copying process completed.")
-    
+    return stats
+
+def rows_seen(stats):
+    return stats['copied'] + stats['skipped'] + stats['missing'] + stats['failed']
 
-def main(pics_dir):
+def main(pics_dir, strategy=MAT.DEFAULT_STRATEGY, confirmed_only=False, db_path=None):
+    """
+    Copies one file per hash from db_path (default db_file), a scan database
+    or one merged from several with mergeshards, into pics_dir.
+    """
     master_pics_dir = create_master_pics_dir(pics_dir)
     print("MasterPics directory is ready.")
-    piclist = create_piclist(db_file)
-    if piclist:
-        copy_images(piclist, master_pics_dir)
-    else:
-        print("No images found in the database to copy.")
-    movlist = create_movlist(db_file)
-    if movlist:
-        copy_movies(movlist, master_pics_dir)
-    else:
-        print("No videos found in the database to copy.")
+    # Rows are streamed straight into the copy pool, so copying starts with the
+    # first fetched chunk and memory stays flat regardless of table size.
+    conn = open_database(db_path or db_file)
+    try:
+        if not rows_seen(copy_images(create_piclist(conn, confirmed_only), master_pics_dir, strategy)):
+            print("No images found in the database to copy.")
+        if not rows_seen(copy_movies(create_movlist(conn), master_pics_dir, strategy)):
+            print("No videos found in the database to copy.")
+    finally:
+        conn.close()
+        print("Database connection closed.")
 
 if __name__ == '__main__':
     main(master_pics_dir)
\ No newline at end of file
@@ -0,0 +1,178 @@
+import errno
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics as MET
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+STRATEGIES = ('auto', 'hardlink', 'reflink', 'copy_file_range', 'copy')
+DEFAULT_STRATEGY = 'auto'
+MAX_WORKERS = 8
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# errnos meaning "this filesystem/kernel can't do that here", so try the next strategy.
+FALLBACK_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EBADF}
+
+
+def hardlink_file(src_path, dst_path):
+    os.link(src_path, dst_path)
+
+
+def reflink_file(src_path, dst_path):
+    """Clones src into dst with FICLONE (btrfs, XFS, bcachefs...); no data is copied."""
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink is not supported on this platform")
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(src_path, dst_path)
+
+
+def kernel_copy_file(src_path, dst_path):
+    """Copies inside the kernel with copy_file_range, or sendfile on older kernels."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        offset = 0
+        while remaining > 0:
+            count = min(remaining, COPY_CHUNK_SIZE)
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, count)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL) or offset:
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            if copied == 0:
+                break
+            offset += copied
+            remaining -= copied
+    shutil.copystat(src_path, dst_path)
+
+
+def plain_copy_file(src_path, dst_path):
+    shutil.copy2(src_path, dst_path)
+
+
+STRATEGY_FUNCTIONS = {
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+    'copy_file_range': kernel_copy_file,
+    'copy': plain_copy_file,
+}
+AUTO_ORDER = ('reflink', 'copy_file_range', 'copy')
+
+
+def remove_partial(dst_path):
+    try:
+        os.remove(dst_path)
+    except OSError:
+        pass
+
+
+def materialize_file(src_path, dst_path, strategy=DEFAULT_STRATEGY):
+    """
+    Places a copy of src_path at dst_path using strategy.
+
+    'auto' tries a reflink, then an in-kernel copy, then a plain copy, moving
+    on whenever the filesystem refuses. Hardlinks are only made when asked
+    for, since the master copy would then share its inode with the original.
+    Returns (status, method, size) where status is 'copied', 'skipped' or 'missing'.
+    """
+    if not os.path.isfile(src_path):
+        return 'missing', None, 0
+    size = os.path.getsize(src_path)
+    try:
+        if os.path.getsize(dst_path) == size:
+            return 'skipped', None, size
+        os.remove(dst_path)
+    except FileNotFoundError:
+        pass
+
+    methods = AUTO_ORDER if strategy == 'auto' else (strategy,)
+    for position, method in enumerate(methods):
+        try:
+            STRATEGY_FUNCTIONS[method](src_path, dst_path)
+            return 'copied', method, size
+        except OSError as e:
+            if method != 'hardlink':
+                remove_partial(dst_path)
+            if position == len(methods) - 1 or e.errno not in FALLBACK_ERRNOS:
+                raise
+    raise ValueError(f"Unknown strategy {strategy!r}")
+
+
+def iter_bounded(executor, function, items, max_pending, metrics=None):
+    """Like executor.map, but never holds more than max_pending submitted items."""
+    pending = set()
+    for item in items:
+        pending.add(executor.submit(function, item))
+        if metrics is not None:
+            metrics.set_gauge('queue_depth', len(pending))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in pending:
+        yield future.result()
+
+
+def materialize(pairs, strategy=DEFAULT_STRATEGY, max_workers=MAX_WORKERS, verbose=False, metrics_path=None):
+    """
+    Materializes (src_path, dst_path) pairs on a bounded thread pool.
+    Returns a stats dict and prints throughput in MB/s and files/s.
+    Per-file lines are only printed with verbose, and then rate-limited.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {strategy!r}, expected one of {STRATEGIES}")
+    log = MET.RateLimitedLog(verbose)
+
+    def run(pair):
+        src_path, dst_path = pair
+        start = time.perf_counter()
+        try:
+            return pair, materialize_file(src_path, dst_path, strategy), None
+        except OSError as e:
+            return pair, ('failed', None, 0), e
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('copy', elapsed)
+            metrics.incr('worker_busy_seconds', elapsed)
+
+    stats = {'copied': 0, 'skipped': 0, 'missing': 0, 'failed': 0, 'bytes': 0, 'methods': {}}
+    start = time.perf_counter()
+    with MET.track('materialize', snapshot_path=metrics_path) as metrics, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        metrics.set_gauge('workers', max_workers)
+        for (src_path, dst_path), (status, method, size), error in iter_bounded(executor, run, pairs, max_workers * 4, metrics):
+            stats[status] += 1
+            metrics.incr('files')
+            if status == 'copied':
+                stats['bytes'] += size
+                metrics.incr('bytes_copied', size)
+                stats['methods'][method] = stats['methods'].get(method, 0) + 1
+                log(f"Copied '{os.path.basename(src_path)}' to\n\t '{dst_path}' ({method})")
+            elif status == 'missing':
+                print(f"Warning: Source path '{src_path}' is not a file. Skipping.")
+            elif status == 'failed':
+                print(f"Error copying '{src_path}': {error}")
+
+    elapsed = time.perf_counter() - start
+    stats['seconds'] = elapsed
+    rate_seconds = elapsed or 1e-9
+    print(f"Materialized {stats['copied']} files ({stats['bytes'] / 1e6:.1f} MB), "
+          f"skipped {stats['skipped']} existing, {stats['missing']} missing, {stats['failed']} failed "
+          f"in {elapsed:.2f}s: {stats['bytes'] / 1e6 / rate_seconds:.1f} MB/s, "
+          f"{(stats['copied'] + stats['skipped']) / rate_seconds:.1f} files/s")
+    if stats['methods']:
+        print("Methods used: " + ", ".join(f"{method}={count}" for method, count in stats['methods'].items()))
+    return stats
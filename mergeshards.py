@@ -0,0 +1,317 @@
+import argparse
+import os
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+import dupchecker as DC
+
+# Merged databases are written in big set-based statements: a large page
+# cache and memory-mapped reads pay off, but sorts of tens of millions of rows
+# stay in temp files rather than memory.
+MERGE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-262144',
+    'PRAGMA mmap_size=1073741824',
+)
+
+
+def sqlite_uri(path, mode=None):
+    uri = f"file:{pathname2url(os.path.abspath(path))}"
+    return f"{uri}?mode={mode}" if mode else uri
+
+
+def initialize_merged_database(db_name):
+    # Opened by URI so ATTACH accepts one too (shards are attached read-only).
+    conn = sqlite3.connect(sqlite_uri(db_name), uri=True)
+    for pragma in MERGE_PRAGMAS:
+        conn.execute(pragma)
+    # For shards written before pHashes were stored as integers.
+    conn.create_function('phash_to_int', 1, DC.phash_to_int, deterministic=True)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                source_id TEXT PRIMARY KEY,
+                shard_path TEXT NOT NULL,
+                merged_at REAL,
+                images INTEGER,
+                videos INTEGER
+            )
+        ''')
+        # Every hashed file of every shard, duplicates included.
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shard_images (
+                source_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT,
+                phash INTEGER NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                PRIMARY KEY (source_id, path)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shard_videos (
+                source_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT,
+                mhash TEXT,
+                hash_algorithm TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sample_hash TEXT,
+                PRIMARY KEY (source_id, path)
+            )
+        ''')
+        # One representative per pHash / content hash across all shards, how
+        # many files share it and whether they are on more than one source.
+        # Videos no shard needed to hash in full (mhash NULL) are listed on their own.
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS merged_hashes (
+                phash INTEGER PRIMARY KEY,
+                source_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT,
+                size INTEGER,
+                copies INTEGER NOT NULL,
+                cross_source INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS merged_videos (
+                hash_algorithm TEXT,
+                mhash TEXT,
+                source_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT,
+                size INTEGER,
+                copies INTEGER NOT NULL,
+                cross_source INTEGER NOT NULL,
+                UNIQUE (hash_algorithm, mhash)
+            )
+        ''')
+    return conn
+
+
+def is_merged_database(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'merged_hashes'"
+    ).fetchone() is not None
+
+
+def shard_source_id(conn, shard_path):
+    """The source ID the attached shard was scanned with, or its absolute path for shards from before IDs."""
+    has_meta = conn.execute(
+        "SELECT 1 FROM shard.sqlite_master WHERE type = 'table' AND name = 'meta'"
+    ).fetchone()
+    if has_meta:
+        row = conn.execute("SELECT value FROM shard.meta WHERE key = 'source_id'").fetchone()
+        if row is not None:
+            return row[0]
+    return os.path.abspath(shard_path)
+
+
+def shard_tables(conn):
+    return {name for (name,) in conn.execute("SELECT name FROM shard.sqlite_master WHERE type = 'table'")}
+
+
+def shard_columns(conn, table_name):
+    """{column name: declared type} for one of the attached shard's tables."""
+    return {row[1]: row[2].upper() for row in conn.execute(f'PRAGMA shard.table_info({table_name})')}
+
+
+def import_shard(conn, shard_path, source_id=None):
+    """
+    Replaces the rows of one shard in the merged database, in a single
+    transaction of INSERT ... SELECT statements over the attached file.
+    Returns (source_id, images, videos).
+    """
+    conn.execute('ATTACH DATABASE ? AS shard', (sqlite_uri(shard_path, 'ro'),))
+    try:
+        source_id = source_id or shard_source_id(conn, shard_path)
+        tables = shard_tables(conn)
+        previous = conn.execute('SELECT shard_path FROM shards WHERE source_id = ?', (source_id,)).fetchone()
+        if previous and previous[0] != os.path.abspath(shard_path):
+            print(f"Replacing source {source_id} (merged from {previous[0]}) with {shard_path}")
+        with conn:
+            conn.execute('DELETE FROM shard_images WHERE source_id = ?', (source_id,))
+            conn.execute('DELETE FROM shard_videos WHERE source_id = ?', (source_id,))
+            video_columns = shard_columns(conn, 'video_hashes') if 'video_hashes' in tables else {}
+            # Shards from before sample hashes had their own column kept them in mhash.
+            sample_in_mhash = 'hash_stage' in video_columns and 'sample_hash' not in video_columns
+            # Shards from before dupchecker recorded the video hash algorithm only used MD5.
+            video_algorithm = "coalesce(hash_algorithm, 'md5')" if 'hash_algorithm' in video_columns else "'md5'"
+            # Shards from before the INTEGER migration keep pHashes as hex, in
+            # scan_state (a TEXT column either way) too.
+            hex_phashes = 'hashes' in tables and shard_columns(conn, 'hashes').get('phash') == 'TEXT'
+            # scan_state lists every hashed file, including the ones the hashes
+            # table collapsed; path order keeps the primary key appends cheap.
+            if 'scan_state' in tables:
+                state_algorithm = (
+                    "coalesce(hash_algorithm, 'md5')" if 'hash_algorithm' in shard_columns(conn, 'scan_state') else "'md5'"
+                )
+                conn.execute(f'''
+                    INSERT INTO shard_images (source_id, path, filename, phash, size, mtime_ns)
+                    SELECT ?, path, filename,
+                           {'phash_to_int(hash_value)' if hex_phashes else 'CAST(hash_value AS INTEGER)'},
+                           size, mtime_ns
+                    FROM shard.scan_state
+                    WHERE kind = 'hashes' AND hash_value IS NOT NULL ORDER BY path
+                ''', (source_id,))
+                # Only full-content hashes; videos never hashed in full come from video_hashes below.
+                unhashed = """AND path NOT IN (
+                    SELECT path FROM shard.video_hashes WHERE hash_stage IN ('size', 'sample'))"""
+                conn.execute(f'''
+                    INSERT INTO shard_videos (source_id, path, filename, mhash, hash_algorithm, size, mtime_ns)
+                    SELECT ?, path, filename, hash_value, {state_algorithm}, size, mtime_ns FROM shard.scan_state
+                    WHERE kind = 'video_hashes' AND hash_value IS NOT NULL {unhashed if sample_in_mhash else ''}
+                    ORDER BY path
+                ''', (source_id,))
+            # Databases written before scan_state only have the representatives.
+            if 'hashes' in tables:
+                conn.execute('''
+                    INSERT OR IGNORE INTO shard_images (source_id, path, filename, phash, size, mtime_ns)
+                    SELECT ?, path, filename,
+                           CASE typeof(phash) WHEN 'integer' THEN phash ELSE phash_to_int(phash) END, NULL, NULL
+                    FROM shard.hashes WHERE phash IS NOT NULL
+                ''', (source_id,))
+            if 'video_hashes' in tables:
+                if sample_in_mhash:
+                    mhash = "CASE WHEN hash_stage IN ('size', 'sample') THEN NULL ELSE mhash END"
+                    sample_hash = "CASE WHEN hash_stage IN ('size', 'sample') THEN mhash END"
+                else:
+                    mhash, sample_hash = 'mhash', 'sample_hash' if 'sample_hash' in video_columns else 'NULL'
+                size, mtime_ns = (name if name in video_columns else 'NULL' for name in ('size', 'mtime_ns'))
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO shard_videos (source_id, path, filename, mhash, hash_algorithm, size, mtime_ns, sample_hash)
+                    SELECT ?, path, filename, {mhash}, {video_algorithm}, {size}, {mtime_ns}, {sample_hash}
+                    FROM shard.video_hashes
+                ''', (source_id,))
+            images = conn.execute('SELECT count(*) FROM shard_images WHERE source_id = ?', (source_id,)).fetchone()[0]
+            videos = conn.execute('SELECT count(*) FROM shard_videos WHERE source_id = ?', (source_id,)).fetchone()[0]
+            conn.execute(
+                'INSERT OR REPLACE INTO shards (source_id, shard_path, merged_at, images, videos) VALUES (?, ?, ?, ?, ?)',
+                (source_id, os.path.abspath(shard_path), time.time(), images, videos),
+            )
+    finally:
+        conn.execute('DETACH DATABASE shard')
+    return source_id, images, videos
+
+
+def drop_rank_indexes(conn):
+    """Imports run without the rank indexes; rebuilding them once afterwards is a single sort."""
+    with conn:
+        conn.execute('DROP INDEX IF EXISTS shard_images_rank')
+        conn.execute('DROP INDEX IF EXISTS shard_videos_rank')
+        conn.execute('DROP INDEX IF EXISTS shard_videos_size')
+
+
+def resolve_duplicates(conn):
+    """
+    Rebuilds merged_hashes and merged_videos from all shards: per pHash (per
+    content hash and algorithm for videos) the largest file is kept, ties
+    going to the first source ID and path.
+
+    Both run over an index in keeper order, so grouping streams through it
+    and each group's keeper is its first index entry. (Window functions give
+    the same result about five times slower.) Videos without a full-content
+    hash cannot be matched here and are each kept on their own.
+    """
+    with conn:
+        conn.execute('CREATE INDEX IF NOT EXISTS shard_images_rank ON shard_images (phash, size DESC, source_id, path)')
+        conn.execute('CREATE INDEX IF NOT EXISTS shard_videos_rank ON shard_videos (hash_algorithm, mhash, size DESC, source_id, path)')
+        # For spotting videos never hashed in full that may still have copies on other sources.
+        conn.execute('CREATE INDEX IF NOT EXISTS shard_videos_size ON shard_videos (size, source_id)')
+        conn.execute('DELETE FROM merged_hashes')
+        conn.execute('''
+            INSERT INTO merged_hashes (phash, source_id, path, filename, size, copies, cross_source)
+            SELECT grouped.phash, keeper.source_id, keeper.path, keeper.filename, keeper.size, copies, cross_source
+            FROM (
+                SELECT phash, count(*) AS copies, min(source_id) != max(source_id) AS cross_source,
+                       (SELECT rowid FROM shard_images AS candidate WHERE candidate.phash = shard_images.phash
+                        ORDER BY size DESC, source_id, path LIMIT 1) AS keeper_id
+                FROM shard_images GROUP BY phash
+            ) AS grouped
+            JOIN shard_images AS keeper ON keeper.rowid = grouped.keeper_id
+        ''')
+        conn.execute('DELETE FROM merged_videos')
+        conn.execute('''
+            INSERT INTO merged_videos (hash_algorithm, mhash, source_id, path, filename, size, copies, cross_source)
+            SELECT grouped.hash_algorithm, grouped.mhash, keeper.source_id, keeper.path, keeper.filename, keeper.size,
+                   copies, cross_source
+            FROM (
+                SELECT hash_algorithm, mhash, count(*) AS copies, min(source_id) != max(source_id) AS cross_source,
+                       (SELECT rowid FROM shard_videos AS candidate
+                        WHERE candidate.hash_algorithm IS shard_videos.hash_algorithm AND candidate.mhash = shard_videos.mhash
+                        ORDER BY size DESC, source_id, path LIMIT 1) AS keeper_id
+                FROM shard_videos WHERE mhash IS NOT NULL GROUP BY hash_algorithm, mhash
+            ) AS grouped
+            JOIN shard_videos AS keeper ON keeper.rowid = grouped.keeper_id
+        ''')
+        conn.execute('''
+            INSERT INTO merged_videos (hash_algorithm, mhash, source_id, path, filename, size, copies, cross_source)
+            SELECT hash_algorithm, NULL, source_id, path, filename, size, 1, 0 FROM shard_videos WHERE mhash IS NULL
+        ''')
+
+
+def merge_shards(merged_db, shard_paths, source_ids=None):
+    """
+    Imports each shard database (a dupchecker/pipeline imagehash.db) into
+    merged_db, replacing rows from an earlier import of the same source ID,
+    then resolves duplicates across all shards merged so far. source_ids,
+    if given, overrides the IDs stored in the shards, position by position.
+    """
+    conn = initialize_merged_database(merged_db)
+    try:
+        start = time.perf_counter()
+        drop_rank_indexes(conn)
+        for position, shard_path in enumerate(shard_paths):
+            if not os.path.exists(shard_path):
+                print(f"Error: shard not found at {shard_path}")
+                continue
+            shard_start = time.perf_counter()
+            source_id = source_ids[position] if source_ids and position < len(source_ids) else None
+            source_id, images, videos = import_shard(conn, shard_path, source_id)
+            print(f"Imported {source_id}: {images} images, {videos} videos in {time.perf_counter() - shard_start:.2f}s")
+
+        imported = time.perf_counter()
+        resolve_duplicates(conn)
+        resolved = time.perf_counter()
+
+        shards, images, videos = conn.execute(
+            'SELECT count(*), coalesce(sum(images), 0), coalesce(sum(videos), 0) FROM shards'
+        ).fetchone()
+        unique_images, cross_images = conn.execute(
+            'SELECT count(*), coalesce(sum(cross_source), 0) FROM merged_hashes'
+        ).fetchone()
+        unique_videos, cross_videos = conn.execute(
+            'SELECT count(*), coalesce(sum(cross_source), 0) FROM merged_videos'
+        ).fetchone()
+        print(f"\nMerged {shards} shards into {merged_db}: {images} images -> {unique_images} unique pHashes "
+              f"({cross_images} on more than one source), {videos} videos -> {unique_videos} unique "
+              f"({cross_videos} on more than one source)")
+        unhashed = conn.execute('''
+            SELECT count(*) FROM merged_videos AS video WHERE mhash IS NULL AND EXISTS (
+                SELECT 1 FROM shard_videos AS other WHERE other.size = video.size AND other.source_id != video.source_id)
+        ''').fetchone()[0]
+        if unhashed:
+            print(f"{unhashed} videos were never hashed in full but share their size with a video on another "
+                  f"source; makemaster hashes them before copying, so copies still end up under one name")
+        print(f"Import {imported - start:.2f}s, duplicate resolution {resolved - imported:.2f}s")
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge per-drive hash databases (shards) and resolve duplicates across them.")
+    parser.add_argument('merged_db', help="Merged database to create or update")
+    parser.add_argument('shards', nargs='*', help="Shard databases to import (re-importing a source replaces it)")
+    parser.add_argument('--source', action='append', default=[], metavar='ID',
+                        help="Source ID for the shard at the same position, overriding the stored one (repeatable)")
+    args = parser.parse_args(argv)
+    merge_shards(args.merged_db, args.shards, args.source)
+
+
+if __name__ == '__main__':
+    main()
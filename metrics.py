@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds between progress lines / snapshot writes for long-running stages.
+PROGRESS_INTERVAL = 10.0
+# Where to write periodic snapshots: a path ending in .prom gets the Prometheus
+# textfile format (for node_exporter's textfile collector), anything else JSON.
+SNAPSHOT_PATH = None
+# Per-file log lines allowed per second before they are summarized.
+LOG_LINES_PER_SECOND = 5
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Timings shown in the progress line when present.
+PROGRESS_TIMINGS = ('stat', 'cache_hit', 'structure', 'verify', 'open', 'decode', 'hash', 'db_flush', 'db_commit', 'copy')
+
+
+def record(timings, name, seconds):
+    """Appends a sample to a plain {name: [seconds]} dict (None disables recording)."""
+    if timings is not None:
+        timings.setdefault(name, []).append(seconds)
+
+
+def call_with_timings(function, *args, **kwargs):
+    """
+    Runs function(*args, timings=..., **kwargs) and returns (result, timings).
+    Meant to run inside pool workers, whose own metrics the parent cannot see;
+    the total call time is reported as worker_busy.
+    """
+    timings = {}
+    start = time.perf_counter()
+    result = function(*args, timings=timings, **kwargs)
+    timings['worker_busy'] = [time.perf_counter() - start]
+    return result, timings
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(HISTOGRAM_BUCKETS) and seconds > HISTOGRAM_BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return HISTOGRAM_BUCKETS[index] if index < len(HISTOGRAM_BUCKETS) else float('inf')
+        return float('inf')
+
+
+class Metrics:
+    """Thread-safe counters, gauges and timing histograms for one stage."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_many(self, timings):
+        """Merges {name: [seconds, ...]} gathered elsewhere, e.g. in a worker process."""
+        for name, samples in timings.items():
+            if name == 'worker_busy':
+                self.incr('worker_busy_seconds', sum(samples))
+                continue
+            for seconds in samples:
+                self.observe(name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def utilization(self):
+        """Fraction of worker time spent busy since the stage started."""
+        workers = self.gauges.get('workers')
+        if not workers:
+            return None
+        elapsed = time.time() - self.started
+        return self.counters.get('worker_busy_seconds', 0.0) / (elapsed * workers) if elapsed else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stage': self.stage,
+                'started': self.started,
+                'elapsed_seconds': round(time.time() - self.started, 3),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'worker_utilization': self.utilization(),
+                'timings': {
+                    name: {
+                        'count': histogram.count,
+                        'sum_seconds': round(histogram.total, 6),
+                        'p50': histogram.quantile(0.5),
+                        'p99': histogram.quantile(0.99),
+                        'buckets': dict(zip([*map(str, HISTOGRAM_BUCKETS), '+Inf'], histogram.counts)),
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            files = self.counters.get('files', 0)
+            parts = [f"[{self.stage}] {files} files, {files / elapsed if elapsed else 0:.1f} files/s"]
+            for name in PROGRESS_TIMINGS:
+                histogram = self.histograms.get(name)
+                if histogram and histogram.count:
+                    parts.append(f"{name} p50<={histogram.quantile(0.5) * 1000:g}ms")
+            if 'queue_depth' in self.gauges:
+                parts.append(f"queue {self.gauges['queue_depth']}")
+            utilization = self.utilization()
+            if utilization is not None:
+                parts.append(f"util {utilization:.0%}")
+        return " | ".join(parts)
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        label = f'stage="{self.stage}"'
+        lines = []
+        for name, value in snapshot['counters'].items():
+            lines.append(f"# TYPE dupchecker_{name}_total counter")
+            lines.append(f"dupchecker_{name}_total{{{label}}} {value}")
+        for name, value in snapshot['gauges'].items():
+            lines.append(f"# TYPE dupchecker_{name} gauge")
+            lines.append(f"dupchecker_{name}{{{label}}} {value}")
+        if snapshot['worker_utilization'] is not None:
+            lines.append("# TYPE dupchecker_worker_utilization gauge")
+            lines.append(f"dupchecker_worker_utilization{{{label}}} {snapshot['worker_utilization']:.4f}")
+        with self.lock:
+            histograms = list(self.histograms.items())
+        for name, histogram in histograms:
+            metric = f"dupchecker_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            running = 0
+            for bound, count in zip([*map(str, HISTOGRAM_BUCKETS), '+Inf'], histogram.counts):
+                running += count
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {running}')
+            lines.append(f"{metric}_sum{{{label}}} {histogram.total:.6f}")
+            lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        """Writes atomically so scrapers never see a half-written file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus_text())
+            else:
+                json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, path)
+
+
+class Reporter(threading.Thread):
+    """Prints a progress line and writes a snapshot every interval seconds."""
+
+    def __init__(self, metrics, interval, snapshot_path=None):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        print(self.metrics.progress_line())
+        if self.snapshot_path:
+            try:
+                self.metrics.write_snapshot(self.snapshot_path)
+            except OSError as e:
+                print(f"Error writing metrics snapshot {self.snapshot_path}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+
+@contextmanager
+def track(stage, interval=None, snapshot_path=None):
+    """
+    Runs a Reporter for the duration of a stage and yields its Metrics.
+    interval and snapshot_path default to PROGRESS_INTERVAL and SNAPSHOT_PATH.
+    """
+    metrics = Metrics(stage)
+    reporter = Reporter(
+        metrics,
+        PROGRESS_INTERVAL if interval is None else interval,
+        SNAPSHOT_PATH if snapshot_path is None else snapshot_path,
+    )
+    reporter.start()
+    try:
+        yield metrics
+    finally:
+        reporter.stop()
+
+
+class RateLimitedLog:
+    """Per-file log lines, capped at lines_per_second; the rest are counted and summarized."""
+
+    def __init__(self, enabled=True, lines_per_second=None):
+        self.enabled = enabled
+        self.lines_per_second = LOG_LINES_PER_SECOND if lines_per_second is None else lines_per_second
+        self.lock = threading.Lock()
+        self.window = 0
+        self.printed = 0
+        self.suppressed = 0
+
+    def __call__(self, message):
+        if not self.enabled:
+            return
+        with self.lock:
+            window = int(time.monotonic())
+            if window != self.window:
+                if self.suppressed:
+                    print(f"... {self.suppressed} more lines suppressed")
+                self.window, self.printed, self.suppressed = window, 0, 0
+            if self.printed >= self.lines_per_second:
+                self.suppressed += 1
+                return
+            self.printed += 1
+        print(message)
@@ -0,0 +1,329 @@
+import argparse
+import math
+import time
+from itertools import chain, combinations
+
+import numpy as np
+
+import dupchecker as DC
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 6
+# Widest band of a MultiIndexHash: each band table has 2**bits + 1 entries.
+MAX_BAND_BITS = 22
+# Time to filter one candidate pair relative to one band lookup (measured with NumPy 2.4).
+CANDIDATE_COST = 3
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def popcount64(values):
+    """Per-element popcount of a uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def hamming_distances(phashes, hash_value):
+    """Hamming distance from hash_value to every entry of a uint64 pHash array."""
+    return popcount64(phashes ^ np.uint64(hash_value & 0xFFFFFFFFFFFFFFFF))
+
+
+def split_bands(max_distance, count, hash_bits=HASH_BITS):
+    """
+    Splits the hash into bit bands for count stored hashes and returns
+    (bands, radius), bands as (shift, width) pairs.
+
+    Two hashes within max_distance bits of each other differ in at most
+    radius = max_distance // len(bands) bits on at least one band
+    (pigeonhole), so probing every band value within radius of a hash's own
+    finds them all. Each probe costs a lookup plus the count / 2**width
+    stored hashes it turns up; the band count is the one with the least
+    expected lookup and filtering time, which puts the width near log2(count)
+    bits (and never above MAX_BAND_BITS).
+    """
+    def cost(band_count):
+        width = hash_bits / band_count
+        radius = max_distance // band_count
+        probes = band_count * sum(math.comb(round(width), bits) for bits in range(radius + 1))
+        return probes * (1 + CANDIDATE_COST * count / 2 ** width)
+
+    band_count = min(range(-(-hash_bits // MAX_BAND_BITS), hash_bits + 1), key=cost)
+    bands = []
+    start = 0
+    for i in range(band_count):
+        width = hash_bits // band_count + (1 if i < hash_bits % band_count else 0)
+        bands.append((start, width))
+        start += width
+    return bands, max_distance // band_count
+
+
+def flip_masks(width, radius):
+    """Every width-bit value with at most radius bits set, as an int64 array."""
+    masks = [0]
+    for bits in range(1, min(radius, width) + 1):
+        masks.extend(sum(1 << bit for bit in chosen) for chosen in combinations(range(width), bits))
+    return np.array(masks, dtype=np.int64)
+
+
+class BandTable:
+    """
+    One band of a MultiIndexHash: the stored positions ordered by band value,
+    with where each band value starts in that order addressed directly.
+    """
+
+    def __init__(self, hashes, shift, width):
+        self.shift = shift
+        self.width = width
+        values = self.band_values(hashes)
+        self.order = np.argsort(values, kind='stable')
+        # Probing in band order keeps the lookups into starts close together.
+        self.sorted_values = values[self.order]
+        self.starts = np.zeros((1 << width) + 1, dtype=np.int32 if len(hashes) < 1 << 31 else np.int64)
+        np.cumsum(np.bincount(values, minlength=1 << width), out=self.starts[1:])
+
+    def band_values(self, hashes):
+        return ((hashes >> np.uint64(self.shift)) & np.uint64((1 << self.width) - 1)).astype(np.int64)
+
+    def lookup(self, values):
+        """(positions in values, stored positions) for every stored hash whose band value is in values."""
+        low = self.starts[values]
+        counts = self.starts[1:][values] - low
+        # Most probes of a band about log2(count) bits wide find nothing.
+        queries = np.flatnonzero(counts)
+        low, counts = low[queries], counts[queries]
+        if len(counts) and counts.max() > 1:
+            total = int(counts.sum())
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            queries, low = np.repeat(queries, counts), np.repeat(low, counts) + offsets
+        return queries, self.order[low]
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit pHashes for Hamming-distance lookups.
+
+    Hashes are added one at a time; the band tables are built (see
+    split_bands) when first needed and rebuilt after further adds. Copies of
+    a hash value are set aside first, so the tables only hold distinct values.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.hashes = []
+        self.keys = []
+        self.built = None
+
+    def add(self, key, hash_value):
+        index = len(self.hashes)
+        self.hashes.append(hash_value & 0xFFFFFFFFFFFFFFFF)
+        self.keys.append(key)
+        self.built = None
+        return index
+
+    def build(self):
+        """
+        Returns (representatives, inverse, tables, radius): the position of the
+        first copy of each distinct hash value, the distinct value each stored
+        hash has, and the band tables over the distinct values.
+        """
+        if self.built is None:
+            hashes = np.array(self.hashes, dtype=np.uint64)
+            _, representatives, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+            distinct = hashes[representatives]
+            bands, radius = split_bands(self.max_distance, len(distinct))
+            self.built = (representatives, inverse.reshape(-1), distinct,
+                          [BandTable(distinct, shift, width) for shift, width in bands], radius)
+        return self.built
+
+    def query(self, hash_value, max_distance=None):
+        """Returns [(key, distance)] for every stored hash within max_distance."""
+        if max_distance is None:
+            max_distance = self.max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"Index was built for distance <= {self.max_distance}")
+        if not self.hashes:
+            return []
+        representatives, inverse, distinct, tables, radius = self.build()
+        probe = np.array([hash_value & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64)
+        found = []
+        for table in tables:
+            values = table.band_values(probe) ^ flip_masks(table.width, radius)
+            found.append(table.lookup(values)[1])
+        found = np.unique(np.concatenate(found))
+        distances = popcount64(distinct[found] ^ probe)
+        near = distances <= max_distance
+        matches = []
+        for value, distance in zip(found[near].tolist(), distances[near].tolist()):
+            matches.extend((self.keys[index], distance) for index in np.flatnonzero(inverse == value).tolist())
+        return matches
+
+    def distinct_pairs(self):
+        """
+        (a, b, distances) arrays for every two distinct stored values within
+        max_distance, as indexes into the distinct values with a < b. Each
+        band is probed once per flip mask for all values at once.
+        """
+        _, _, distinct, tables, radius = self.build()
+        found = [np.empty(0, dtype=np.int64)]
+        for table in tables:
+            for mask in flip_masks(table.width, radius):
+                a, b = table.lookup(table.sorted_values ^ mask)
+                a = table.order[a]
+                keep = a < b
+                a, b = a[keep], b[keep]
+                near = popcount64(distinct[a] ^ distinct[b]) <= self.max_distance
+                found.append(a[near] * len(distinct) + b[near])
+        found = np.unique(np.concatenate(found))
+        a, b = np.divmod(found, len(distinct))
+        return a, b, popcount64(distinct[a] ^ distinct[b])
+
+    def pairs(self):
+        """
+        Yields (key_a, key_b, distance) so that every two stored hashes within
+        max_distance are linked, directly or through a shared first copy:
+        each copy of a hash value is paired with the first one stored (N
+        copies give N - 1 pairs, not N(N-1)/2), and only those first copies
+        are compared through the band tables. Take the transitive closure
+        (single linkage) to get every related pair.
+        """
+        if not self.hashes:
+            return
+        representatives, inverse = self.build()[:2]
+        firsts = representatives[inverse]
+        for index in np.flatnonzero(firsts != np.arange(len(self.hashes))).tolist():
+            yield self.keys[firsts[index]], self.keys[index], 0
+        for a, b, distance in zip(*(column.tolist() for column in self.distinct_pairs())):
+            a, b = sorted((representatives[a], representatives[b]))
+            yield self.keys[a], self.keys[b], distance
+
+    def clusters(self):
+        """
+        Groups stored hashes into single-linkage clusters where each member is
+        within max_distance of at least one other member. Returns lists of keys.
+        """
+        if not self.hashes:
+            return []
+        representatives, inverse = self.build()[:2]
+        parent = list(range(len(representatives)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        a, b, _ = self.distinct_pairs()
+        for i, j in zip(a.tolist(), b.tolist()):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+        labels = representatives[roots[inverse]]
+        order = np.argsort(labels, kind='stable')
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        return [
+            [self.keys[i] for i in members.tolist()]
+            for members in np.split(order, bounds) if len(members) > 1
+        ]
+
+
+def load_phash_array(conn):
+    """
+    Bulk-reads every stored pHash into NumPy arrays: (image_ids as int64,
+    phashes as uint64), aligned by position and ordered by image_id. The
+    signed INTEGER column is read straight into int64 and reinterpreted, so
+    no per-row Python strings are created.
+    """
+    cursor = conn.execute('SELECT image_id, phash FROM hashes WHERE phash IS NOT NULL ORDER BY image_id')
+    rows = np.fromiter(chain.from_iterable(cursor), dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0].copy(), rows[:, 1].view(np.uint64).copy()
+
+
+def find_within(image_ids, phashes, hash_value, max_distance=DEFAULT_MAX_DISTANCE):
+    """Returns [(image_id, distance)] for every pHash within max_distance of hash_value (brute force)."""
+    distances = hamming_distances(phashes, hash_value)
+    matches = np.flatnonzero(distances <= max_distance)
+    return [(int(image_ids[i]), int(distances[i])) for i in matches]
+
+
+def load_phash_index(conn, max_distance=DEFAULT_MAX_DISTANCE):
+    index = MultiIndexHash(max_distance)
+    image_ids, phashes = load_phash_array(conn)
+    for image_id, hash_value in zip(image_ids.tolist(), phashes.tolist()):
+        index.add(image_id, hash_value)
+    return index
+
+
+def store_groups(conn, groups):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS near_duplicates (
+                group_id INTEGER NOT NULL,
+                image_id INTEGER NOT NULL,
+                PRIMARY KEY (group_id, image_id)
+            )
+        ''')
+        conn.execute('DELETE FROM near_duplicates')
+        conn.executemany(
+            'INSERT INTO near_duplicates (group_id, image_id) VALUES (?, ?)',
+            [(group_id, image_id) for group_id, members in enumerate(groups, 1) for image_id in members],
+        )
+
+
+def find_near_duplicates(db_name='imagehash.db', max_distance=DEFAULT_MAX_DISTANCE):
+    conn = DC.initialize_database(db_name)
+    try:
+        start = time.perf_counter()
+        index = load_phash_index(conn, max_distance)
+        loaded = time.perf_counter()
+        groups = index.clusters()
+        clustered = time.perf_counter()
+        store_groups(conn, groups)
+        grouped_images = sum(len(members) for members in groups)
+        print(f"Loaded {len(index.hashes)} pHashes in {loaded - start:.2f}s")
+        print(f"Found {len(groups)} near-duplicate groups ({grouped_images} images) "
+              f"within distance {max_distance} in {clustered - loaded:.2f}s")
+        return groups
+    finally:
+        conn.close()
+
+
+def query_similar(db_name, phash, max_distance=DEFAULT_MAX_DISTANCE):
+    """Prints the stored images within max_distance of a hex pHash."""
+    conn = DC.initialize_database(db_name)
+    try:
+        start = time.perf_counter()
+        image_ids, phashes = load_phash_array(conn)
+        loaded = time.perf_counter()
+        matches = find_within(image_ids, phashes, int(phash, 16), max_distance)
+        searched = time.perf_counter()
+        print(f"Loaded {len(phashes)} pHashes in {loaded - start:.3f}s, searched in {(searched - loaded) * 1000:.1f}ms")
+        for image_id, distance in sorted(matches, key=lambda match: match[1]):
+            path, stored = conn.execute(
+                "SELECT path, printf('%016x', phash) FROM hashes WHERE image_id = ?", (image_id,)
+            ).fetchone()
+            print(f"{distance:2d}  {stored}  {path}")
+        return matches
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Group near-duplicate images by pHash Hamming distance.")
+    parser.add_argument('db_name', nargs='?', default='imagehash.db')
+    parser.add_argument('-k', '--max-distance', type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument('-q', '--query', metavar='PHASH', help="List images within the distance of this hex pHash instead of grouping")
+    args = parser.parse_args(argv)
+    if args.query:
+        query_similar(args.db_name, args.query, args.max_distance)
+    else:
+        find_near_duplicates(args.db_name, args.max_distance)
+
+
+if __name__ == '__main__':
+    main()
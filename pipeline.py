@@ -0,0 +1,238 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image
+
+import corruptfiles as CF
+import dupchecker as DC
+import info as INF
+import metrics as MET
+import thumbcache as TC
+import traverse as TRV
+
+ANALYZED_IMAGE_EXTENSIONS = CF.IMAGE_EXTENSIONS | DC.IMAGE_EXTENSIONS
+
+
+def analyze_image(entry, fast_decode=DC.FAST_DECODE, size_threshold=(128, 128), timings=None, cache=None):
+    """
+    Decodes an image once and derives everything the separate stages need from it.
+    Returns (is_corrupt, is_icon, message, thumbnail); thumbnail is None when the
+    image should not be hashed. With cache (a thumbcache.ThumbnailCache), images
+    cached under the same signature are not decoded and new ones are added.
+    """
+    image_path = entry[0]
+    extension = os.path.splitext(image_path)[1].lower()
+    checks_corruption = extension in CF.IMAGE_EXTENSIONS
+    hashable = extension in DC.IMAGE_EXTENSIONS
+    if cache is not None:
+        start = time.perf_counter()
+        features = cache.get(image_path, entry[1:4], fast_decode)
+        if features is not None:
+            MET.record(timings, 'cache_hit', time.perf_counter() - start)
+            if checks_corruption and CF.detect_icon_from_features(features, size_threshold):
+                return False, True, "Image loaded successfully.", None
+            return False, False, "Image loaded successfully.", features.phash_pixels if hashable else None
+    try:
+        start = time.perf_counter()
+        with Image.open(image_path) as img:
+            opened = time.perf_counter()
+            MET.record(timings, 'open', opened - start)
+            width, height = img.size
+            if fast_decode:
+                DC.draft_for_thumbnail(img)
+            img.load()
+            MET.record(timings, 'decode', time.perf_counter() - opened)
+
+            if cache is not None:
+                features = DC.image_features(img, width, height)
+                cache.put(image_path, entry[1:4], features, fast_decode)
+                is_icon = CF.detect_icon_from_features(features, size_threshold)
+                thumbnail = features.phash_pixels
+            else:
+                is_icon = CF.detect_icon(img, width, height, size_threshold)
+                thumbnail = DC.phash_thumbnail(img) if hashable else None
+            if checks_corruption and is_icon:
+                return False, True, "Image loaded successfully.", None
+            return False, False, "Image loaded successfully.", thumbnail if hashable else None
+    except Exception as e:
+        if checks_corruption:
+            return True, False, f"Image could not be decoded: {e}", None
+        print(f"Error calculating pHash for {image_path}: {e}")
+        return False, False, str(e), None
+
+
+def analyze_image_batch(entries, fast_decode=DC.FAST_DECODE, timings=None, thumbnail_cache=None):
+    """
+    Runs analyze_image over a batch and pHashes all hashable thumbnails at once.
+    Exact duplicates (entries that carry their original's path) are skipped;
+    the caller copies the original's outcome. thumbnail_cache is the path of a
+    thumbcache database to read and fill.
+    """
+    cache = TC.open_cache(thumbnail_cache) if thumbnail_cache else None
+    analyzed = [
+        analyze_image(entry, fast_decode, timings=timings, cache=cache) if len(entry) == 4 else (False, False, None, None)
+        for entry in entries
+    ]
+    if cache is not None:
+        cache.flush()
+    hashable = [position for position, result in enumerate(analyzed) if result[3] is not None]
+    phashes = [None] * len(entries)
+    if hashable:
+        start = time.perf_counter()
+        values = DC.phash_batch([analyzed[position][3] for position in hashable])
+        per_image = (time.perf_counter() - start) / len(hashable)
+        for position, value in zip(hashable, values):
+            phashes[position] = DC.phash_to_int(value)
+            MET.record(timings, 'hash', per_image)
+    return [
+        (entry, is_corrupt, is_icon, message, phash)
+        for entry, (is_corrupt, is_icon, message, _), phash in zip(entries, analyzed, phashes)
+    ]
+
+
+def run_pipeline(folder, db_name='imagehash.db', max_workers=2, batch_size=DC.DEFAULT_BATCH_SIZE, chunksize=32, incremental=True, fast_decode=DC.FAST_DECODE, metrics_path=None, video_hash=None, include=(), exclude=(), walk_snapshot=None, exact_duplicates=True, thumbnail_cache=None, bulk_load=None, source_id=None):
+    """
+    Runs the corruption check, icon detection, pHash/video hashing and extension
+    census over folder in a single walk, decoding every image only once.
+
+    Results go to the same places as the separate stages: corrupt images are
+    deleted, icons are moved to ./possible_icons, hashes are stored in db_name
+    and the extension counts are printed. include/exclude globs and
+    walk_snapshot are passed to traverse.walk. With exact_duplicates=True,
+    byte-identical copies of an earlier image are not decoded but share its
+    outcome (see dupchecker.ExactImageIndex). thumbnail_cache names a
+    thumbcache database that spares unchanged images the decode,
+    bulk_load picks the database writer's bulk mode and source_id tags the
+    database as a shard (see dupchecker.process_images_and_store_hashes).
+    """
+    conn = DC.initialize_database(db_name)
+    try:
+        bulk_load = DC.resolve_bulk_load(conn, bulk_load)
+        DC.resolve_source_id(conn, source_id, folder)
+        video_algorithm = DC.resolve_video_algorithm(conn, video_hash)
+        known_signatures = DC.load_stat_signatures(conn, folder, video_algorithm) if incremental else {}
+        if include or exclude:
+            # Files filtered out of this walk are not missing; keep them out of pruning.
+            known_signatures = {
+                path: signature for path, signature in known_signatures.items()
+                if TRV.selects(folder, path, include, exclude)
+            }
+        ext_count = INF.ExtCount(folder)
+        seen_paths = set()
+        walk_failures = []
+        video_entries = []
+        corrupted_images = []
+        possible_icons = []
+        counts = {'checked': 0, 'skipped': 0, 'rehashed': 0, 'changed': 0, 'hashed': 0}
+
+        def image_entries():
+            for path, name, size, mtime_ns, inode in TRV.walk(folder, include, exclude, snapshot_path=walk_snapshot,
+                                                              metrics=metrics, failures=walk_failures):
+                extension = os.path.splitext(name)[1].lower()
+                is_video = extension in DC.VIDEO_EXTENSIONS
+                if extension not in ANALYZED_IMAGE_EXTENSIONS and not is_video:
+                    ext_count.add_file(name, path, size)
+                    continue
+
+                entry = (path, size, mtime_ns, inode)
+                seen_paths.add(path)
+                if known_signatures.get(path) == entry[1:]:
+                    counts['skipped'] += 1
+                    ext_count.add_file(name, path, size)
+                    continue
+                counts['rehashed'] += 1
+                if path in known_signatures:
+                    counts['changed'] += 1
+                if is_video:
+                    video_entries.append(entry)
+                    ext_count.add_file(name, path, size)
+                    continue
+                yield entry
+
+        with MET.track('pipeline', snapshot_path=metrics_path) as metrics, \
+                ProcessPoolExecutor(max_workers=max_workers, initializer=DC.init_worker, initargs=(chunksize,)) as executor:
+            metrics.set_gauge('workers', max_workers)
+            exact_index = None
+            entries = image_entries()
+            if exact_duplicates:
+                # Images from earlier runs were neither corrupt nor icons, or they would be gone.
+                exact_index = DC.ExactImageIndex(
+                    None if bulk_load else conn,
+                    lambda phash: (False, False, "Image loaded successfully.", phash), metrics=metrics, executor=executor,
+                )
+                entries = DC.resolve_exact_copies(entries, exact_index)
+            writer = DC.DatabaseWriter(db_name, batch_size, metrics, bulk=bulk_load)
+            try:
+                image_batches = DC.chunked(entries, chunksize)
+                analyze_batch = partial(MET.call_with_timings, analyze_image_batch, fast_decode=fast_decode, thumbnail_cache=thumbnail_cache)
+                for _, (results, timings) in DC.map_ordered_bounded(executor, analyze_batch, image_batches, max_workers * 2, metrics=metrics):
+                    metrics.observe_many(timings)
+                    metrics.incr('files', len(results))
+                    for entry, is_corrupt, is_icon, message, phash in results:
+                        path = entry[0]
+                        original = None
+                        if len(entry) == 5:
+                            # The original came earlier in the same order, so its outcome is known by now.
+                            original = exact_index.lookup(entry[4], entry[1])
+                            is_corrupt, is_icon, message, phash = original.outcome
+                            if is_corrupt:
+                                message = f"Exact copy of corrupt {original.path}: {message}"
+                        elif exact_index is not None:
+                            exact_index.record(path, entry[1], (is_corrupt, is_icon, message, phash))
+                        if os.path.splitext(path)[1].lower() in CF.IMAGE_EXTENSIONS:
+                            counts['checked'] += 1
+                        if is_corrupt:
+                            CF.delete_corrupted_image(path, message)
+                            corrupted_images.append(path)
+                            seen_paths.discard(path)
+                            continue
+                        if is_icon:
+                            possible_icons.append(path)
+                            seen_paths.discard(path)
+                            continue
+                        ext_count.add_file(os.path.basename(path), path, entry[1])
+                        if phash is not None:
+                            counts['hashed'] += 1
+                            row = (os.path.basename(path), path, phash) + entry[1:4]
+                            link = None
+                            if original is not None:
+                                row, link = DC.exact_duplicate_rows(entry, original, phash)
+                            writer.put('hashes', row)
+                            if link is not None:
+                                # Queued after the hashes row, whose flush clears links for its path.
+                                writer.put('exact_duplicates', link)
+
+                if video_entries and incremental:
+                    DC.add_known_same_size_videos(conn, folder, video_entries, seen_paths)
+
+                for row in DC.hash_videos_staged(executor, video_entries, metrics=metrics, algorithm=video_algorithm):
+                    counts['hashed'] += 1
+                    metrics.incr('files')
+                    writer.put('video_hashes', row)
+            finally:
+                writer.close()
+
+        pruned_files = 0
+        if incremental:
+            pruned_files = DC.finish_incremental(conn, known_signatures, seen_paths, counts['changed'], walk_failures)
+        if thumbnail_cache:
+            TC.evict(thumbnail_cache)
+
+        CF.move_possible_icons(possible_icons)
+        CF.print_summary(counts['checked'], corrupted_images, possible_icons)
+        print(f"\nHashed {counts['hashed']} media files into {db_name}")
+        if exact_index is not None and exact_index.duplicates:
+            print(f"Skipped decoding {exact_index.duplicates} exact duplicate images")
+        if incremental:
+            print(f"Skipped {counts['skipped']} unchanged files, re-hashed {counts['rehashed']}, pruned {pruned_files} missing")
+        if walk_failures:
+            print(f"Could not read {len(walk_failures)} paths; kept their rows")
+        ext_count.print_summary()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    run_pipeline('/home/whitepi/MasterPics')
@@ -1,10 +1,16 @@
+import bisect
+import json
 import os
 import shutil
 import math
 
-from newdupchecker import SOURCE_FOLDER
+import materialize as MAT
+import metrics as MET
+import traverse as TRV
 
-def organize_images_by_size(source_folder, destination_base_folder, max_folder_size_gb):
+PART_NAME_FORMAT = "images_part_{:03d}"
+
+def organize_images_by_size(source_folder, destination_base_folder, max_folder_size_gb, verbose=False):
     """
     Organizes images from a source folder into subfolders,
     with each subfolder containing a maximum specified size of images.
@@ -13,7 +19,9 @@ def organize_images_by_size(source_folder, destination_base_folder, max_folder_s
         source_folder (str): The path to the folder containing all images.
         destination_base_folder (str): The base path where new subfolders will be created.
         max_folder_size_gb (float): The maximum size (in GB) for each subfolder.
+        verbose (bool): Print a (rate-limited) line for every copied file.
     """
+    log = MET.RateLimitedLog(verbose)
 
     # Convert max_folder_size_gb to bytes for calculations
     max_folder_size_bytes = max_folder_size_gb * 1024 * 1024 * 1024
@@ -31,29 +39,22 @@ def organize_images_by_size(source_folder, destination_base_folder, max_folder_s
     subfolder_count = 0
     current_subfolder_path = ""
 
-    # Get a list of all files in the source folder
-    # We'll sort them by name to ensure consistent behavior
-    all_files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
-    all_files.sort() # Sort to process files in a consistent order
+    # Get a list of all files in the source folder with their sizes,
+    # sorted by name to ensure consistent behavior
+    all_files = collect_file_sizes(source_folder)
 
     print(f"Starting to organize images from '{source_folder}'...")
     print(f"Each subfolder will contain a maximum of {max_folder_size_gb} GB of images.")
 
     # Iterate through each file in the source folder
-    for i, filename in enumerate(all_files):
+    for i, (filename, file_size) in enumerate(all_files):
         file_path = os.path.join(source_folder, filename)
 
-        try:
-            file_size = os.path.getsize(file_path)
-        except OSError as e:
-            print(f"Warning: Could not get size of '{filename}'. Skipping. Error: {e}")
-            continue
-
         # Check if adding this file would exceed the current subfolder's size limit
         # Or if it's the very first file, create the first subfolder
         if current_subfolder_size_bytes + file_size > max_folder_size_bytes or current_subfolder_path == "":
             subfolder_count += 1
-            current_subfolder_name = f"images_part_{subfolder_count:03d}" # e.g., images_part_001
+            current_subfolder_name = PART_NAME_FORMAT.format(subfolder_count) # e.g., images_part_001
             current_subfolder_path = os.path.join(destination_base_folder, current_subfolder_name)
             os.makedirs(current_subfolder_path, exist_ok=True) # Create the new subfolder
             current_subfolder_size_bytes = 0 # Reset size for the new folder
@@ -66,7 +67,7 @@ def organize_images_by_size(source_folder, destination_base_folder, max_folder_s
             # Move the file to the current subfolder
             shutil.copy2(file_path, destination_file_path)
             current_subfolder_size_bytes += file_size
-            print(f"Copied '{filename}' to\n\t'{current_subfolder_name}'\n\tCurrent size: {current_subfolder_size_bytes / (1024 * 1024 * 1024):.2f} GB")
+            log(f"Copied '{filename}' to\n\t'{current_subfolder_name}'\n\tCurrent size: {current_subfolder_size_bytes / (1024 * 1024 * 1024):.2f} GB")
         except shutil.Error as e:
             print(f"Error moving '{filename}' to '{current_subfolder_name}'. Error: {e}")
         except Exception as e:
@@ -74,12 +75,164 @@ def organize_images_by_size(source_folder, destination_base_folder, max_folder_s
 
     print(f"\nImage organization complete. Total subfolders created: {subfolder_count}")
 
-def split_main():
-    SOURCE_FOLDER = "/media/piir/PiTB/DONTDELETE"
-    DESTINATION_BASE_FOLDER = "/media/piir/PiTB/DONTDELETESPLIT"
-    MAX_FOLDER_SIZE_GB = 1.85
+def collect_file_sizes(source_folder, include=(), exclude=()):
+    """Returns [(filename, size)] for the files directly in source_folder, sorted by name."""
+    files = [
+        (name, size)
+        for _, name, size, _, _ in TRV.walk(source_folder, include, exclude, recursive=False)
+    ]
+    files.sort()
+    return files
+
+def plan_greedy(files, capacity):
+    """The split organize_images_by_size makes: fill parts in filename order."""
+    parts = []
+    current_size = 0
+    for filename, size in files:
+        if not parts or current_size + size > capacity:
+            parts.append([])
+            current_size = 0
+        parts[-1].append((filename, size))
+        current_size += size
+    return parts
+
+def plan_best_fit_decreasing(files, capacity):
+    """
+    Packs the largest files first, each into the part whose remaining space
+    fits it most tightly. Files larger than capacity get a part of their own.
+    """
+    parts = []
+    # Sorted (remaining_bytes, part_index) so the tightest fit is a bisect away.
+    remaining = []
+    for filename, size in sorted(files, key=lambda item: (-item[1], item[0])):
+        position = bisect.bisect_left(remaining, (size, -1))
+        if position < len(remaining):
+            space, index = remaining.pop(position)
+        else:
+            parts.append([])
+            space, index = capacity, len(parts) - 1
+        parts[index].append((filename, size))
+        if space - size > 0:
+            bisect.insort(remaining, (space - size, index))
+    for part in parts:
+        part.sort()
+    return parts
+
+PLANNERS = {
+    'greedy': plan_greedy,
+    'best_fit_decreasing': plan_best_fit_decreasing,
+}
+
+def build_plan(source_folder, max_folder_size_gb, algorithm='best_fit_decreasing', files=None):
+    capacity = int(max_folder_size_gb * 1024 * 1024 * 1024)
+    if files is None:
+        files = collect_file_sizes(source_folder)
+    return {
+        'source_folder': source_folder,
+        'max_folder_size_bytes': capacity,
+        'algorithm': algorithm,
+        'parts': PLANNERS[algorithm](files, capacity),
+    }
+
+def save_plan(plan, plan_file):
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=1)
+    print(f"Saved split plan to '{plan_file}'")
+
+def load_plan(plan_file):
+    with open(plan_file) as f:
+        plan = json.load(f)
+    plan['parts'] = [[tuple(item) for item in part] for part in plan['parts']]
+    return plan
+
+def drop_changed_files(plan):
+    """
+    Removes planned files that no longer exist in the plan's source folder or
+    whose size changed since it was made, and returns [(filename, reason)] for them.
+    """
+    current = dict(collect_file_sizes(plan['source_folder']))
+    changed = []
+    parts = []
+    for part in plan['parts']:
+        kept = []
+        for filename, size in part:
+            if filename not in current:
+                changed.append((filename, "missing"))
+            elif current[filename] != size:
+                changed.append((filename, f"size {size} -> {current[filename]}"))
+            else:
+                kept.append((filename, size))
+        # Emptied parts stay, so the others keep their images_part_NNN numbers.
+        parts.append(kept)
+    plan['parts'] = parts
+    return changed
+
+def describe_fill(parts, capacity):
+    fills = [sum(size for _, size in part) / capacity for part in parts]
+    if not fills:
+        return "0 parts"
+    return (f"{len(parts)} parts, mean fill {sum(fills) / len(fills):.1%}, "
+            f"min fill {min(fills):.1%}")
+
+def report_plan(plan, files):
+    capacity = plan['max_folder_size_bytes']
+    print(f"Greedy (filename order): {describe_fill(plan_greedy(files, capacity), capacity)}")
+    print(f"Plan ({plan['algorithm']}): {describe_fill(plan['parts'], capacity)}")
+
+def execute_plan(plan, destination_base_folder, strategy=MAT.DEFAULT_STRATEGY, max_workers=MAT.MAX_WORKERS):
+    """Copies every planned file into its images_part_NNN folder with the parallel copier."""
+    source_folder = plan['source_folder']
+    pairs = []
+    for number, part in enumerate(plan['parts'], 1):
+        part_path = os.path.join(destination_base_folder, PART_NAME_FORMAT.format(number))
+        os.makedirs(part_path, exist_ok=True)
+        pairs.extend(
+            (os.path.join(source_folder, filename), os.path.join(part_path, filename))
+            for filename, _ in part
+        )
+    return MAT.materialize(pairs, strategy=strategy, max_workers=max_workers)
+
+def organize_images_by_plan(source_folder, destination_base_folder, max_folder_size_gb,
+                            algorithm='best_fit_decreasing', plan_file=None,
+                            strategy=MAT.DEFAULT_STRATEGY, max_workers=MAT.MAX_WORKERS):
+    """
+    Splits source_folder like organize_images_by_size, but bin-packs the files
+    into as few, evenly filled parts as possible before copying anything.
+
+    If plan_file exists it is replayed; otherwise the new plan is saved there.
+    A replay skips (and lists) planned files that are gone or changed size.
+    """
+    if not os.path.isdir(source_folder):
+        print(f"Error: Source folder '{source_folder}' does not exist.")
+        return
+
+    if plan_file and os.path.exists(plan_file):
+        plan = load_plan(plan_file)
+        print(f"Replaying split plan from '{plan_file}'")
+        if plan['source_folder'] != source_folder:
+            print(f"Note: the plan was made for '{plan['source_folder']}', copying from there")
+        changed = drop_changed_files(plan)
+        if changed:
+            print(f"Skipping {len(changed)} files that changed since the plan was made:")
+            for filename, reason in changed:
+                print(f"  {filename}: {reason}")
+        print(f"Plan ({plan['algorithm']}): {describe_fill(plan['parts'], plan['max_folder_size_bytes'])}")
+    else:
+        files = collect_file_sizes(source_folder)
+        plan = build_plan(source_folder, max_folder_size_gb, algorithm, files)
+        report_plan(plan, files)
+        if plan_file:
+            save_plan(plan, plan_file)
+
+    os.makedirs(destination_base_folder, exist_ok=True)
+    execute_plan(plan, destination_base_folder, strategy, max_workers)
+    print(f"\nImage organization complete. Total subfolders created: {len(plan['parts'])}")
+    return plan
 
-    organize_images_by_size(SOURCE_FOLDER, DESTINATION_BASE_FOLDER, MAX_FOLDER_SIZE_GB)
+def split_main(SOURCE_FOLDER="/media/piir/PiTB/DONTDELETE",
+               DESTINATION_BASE_FOLDER="/media/piir/PiTB/DONTDELETESPLIT",
+               MAX_FOLDER_SIZE_GB=1.85, PLAN_FILE=None):
+    organize_images_by_plan(SOURCE_FOLDER, DESTINATION_BASE_FOLDER, MAX_FOLDER_SIZE_GB, plan_file=PLAN_FILE)
 
 if __name__ == "__main__":
     split_main()
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import dupchecker as DC
+
+
+def write_noise(path, seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(path)
+
+
+def stored_phashes(db_name, path):
+    conn = sqlite3.connect(db_name)
+    try:
+        hashes = conn.execute('SELECT phash FROM hashes WHERE path = ?', (path,)).fetchone()
+        state = conn.execute("SELECT hash_value FROM scan_state WHERE path = ?", (path,)).fetchone()
+        return hashes[0], int(state[0])
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def scanned_tree(tmp_path):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    for seed in range(3):
+        write_noise(folder / f'img{seed}.jpg', seed)
+    db_name = str(tmp_path / 'imagehash.db')
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    rewritten = str(folder / 'img0.jpg')
+    before = stored_phashes(db_name, rewritten)
+    write_noise(rewritten, 100)
+    os.utime(rewritten, ns=(1, 1))
+    return str(folder), db_name, rewritten, before
+
+
+def test_bulk_load_refuses_a_scanned_database(scanned_tree):
+    folder, db_name, rewritten, before = scanned_tree
+    with pytest.raises(ValueError):
+        DC.process_images_and_store_hashes(folder, db_name, max_workers=1, bulk_load=True)
+    assert stored_phashes(db_name, rewritten) == before
+
+
+def test_rescan_replaces_the_hash_of_a_rewritten_file(scanned_tree):
+    folder, db_name, rewritten, before = scanned_tree
+    DC.process_images_and_store_hashes(folder, db_name, max_workers=1)
+    phash, state = stored_phashes(db_name, rewritten)
+    assert phash == state != before[0]
+
+
+def test_rescan_keeps_rows_of_an_unreadable_directory(tmp_path, monkeypatch):
+    folder = tmp_path / 'pics'
+    (folder / 'sub').mkdir(parents=True)
+    write_noise(folder / 'img0.jpg', 0)
+    write_noise(folder / 'sub' / 'img1.jpg', 1)
+    db_name = str(tmp_path / 'imagehash.db')
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    kept = str(folder / 'sub' / 'img1.jpg')
+    before = stored_phashes(db_name, kept)
+
+    list_directory = DC.TRV.list_directory
+
+    def unreadable_sub(directory, *args, **kwargs):
+        if os.path.basename(directory) == 'sub':
+            raise PermissionError(13, 'Permission denied', directory)
+        return list_directory(directory, *args, **kwargs)
+
+    monkeypatch.setattr(DC.TRV, 'list_directory', unreadable_sub)
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    assert stored_phashes(db_name, kept) == before
+    conn = sqlite3.connect(db_name)
+    try:
+        status, error = conn.execute('SELECT status, error FROM scan_runs ORDER BY run_id DESC').fetchone()
+    finally:
+        conn.close()
+    assert status != 'completed' and str(folder / 'sub') in error
+
+
+def test_exact_copies_are_found_by_the_pool(tmp_path):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    write_noise(folder / 'a.png', 1)
+    (folder / 'b.png').write_bytes((folder / 'a.png').read_bytes())
+    write_noise(folder / 'c.png', 2)
+    db_name = str(tmp_path / 'imagehash.db')
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    conn = sqlite3.connect(db_name)
+    try:
+        links = conn.execute('SELECT path, original_path FROM exact_duplicates').fetchall()
+        hashed = dict(conn.execute("SELECT path, hash_value FROM scan_state WHERE kind = 'hashes'").fetchall())
+    finally:
+        conn.close()
+    assert [tuple(os.path.basename(p) for p in link) for link in links] == [('b.png', 'a.png')]
+    assert hashed[str(folder / 'b.png')] == hashed[str(folder / 'a.png')]
+    assert len(hashed) == 3
+
+
+def test_rewriting_an_original_drops_its_copy_links(tmp_path):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    write_noise(folder / 'a.png', 1)
+    (folder / 'b.png').write_bytes((folder / 'a.png').read_bytes())
+    db_name = str(tmp_path / 'imagehash.db')
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    conn = sqlite3.connect(db_name)
+    try:
+        (copy, original), = conn.execute('SELECT path, original_path FROM exact_duplicates').fetchall()
+    finally:
+        conn.close()
+    copy_phash = stored_phashes(db_name, original)[0]
+
+    write_noise(original, 100)
+    os.utime(original, ns=(1, 1))
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    conn = sqlite3.connect(db_name)
+    try:
+        assert conn.execute('SELECT count(*) FROM exact_duplicates').fetchone()[0] == 0
+        # The copy still holds the old content, so it takes over the old pHash.
+        assert conn.execute('SELECT path FROM hashes WHERE phash = ?', (copy_phash,)).fetchall() == [(copy,)]
+    finally:
+        conn.close()
+
+
+def test_resolve_exact_copies_keeps_walk_order(tmp_path):
+    payloads = [b'x' * 10, b'y' * 10, b'x' * 10, b'z' * 7]
+    entries = []
+    for i, payload in enumerate(payloads):
+        path = tmp_path / f'{i}.bin'
+        path.write_bytes(payload)
+        entries.append((str(path), len(payload)))
+    resolved = list(DC.resolve_exact_copies(entries, DC.ExactImageIndex(), lookahead=2))
+    assert [entry[0] for entry in resolved] == [entry[0] for entry in entries]
+    assert [entry[2:] for entry in resolved] == [(), (), (entries[0][0],), ()]
+
+
+def write_video(path, size, head=b'h', middle=b'm'):
+    sample = DC.VIDEO_SAMPLE_SIZE
+    path.write_bytes(head * sample + middle * (size - 2 * sample) + b't' * sample)
+    return (str(path),) + DC.TRV.stat_entry(str(path))
+
+
+def test_staged_video_hashes_keep_samples_out_of_mhash(tmp_path):
+    size = 2 * DC.VIDEO_SAMPLE_SIZE + 10
+    entries = [
+        # Never read: nothing else has its size, so a missing file still gets a row.
+        (str(tmp_path / 'missing.mp4'), 5, 0, 0),
+        write_video(tmp_path / 'a.mp4', size),
+        write_video(tmp_path / 'b.mp4', size, middle=b'M'),
+        write_video(tmp_path / 'c.mp4', size, head=b'H'),
+    ]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        rows = {row[1]: row for row in DC.hash_videos_staged(executor, entries, algorithm='md5')}
+    stages = {os.path.basename(path): (row[2], row[6], row[8]) for path, row in rows.items()}
+    sample_a = DC.calculate_sample_hash(entries[1][0], size, algorithm='md5')
+    assert stages['missing.mp4'] == (None, 'size', None)
+    assert stages['a.mp4'] == (DC.calculate_mhash(entries[1][0], 'md5'), 'full', sample_a)
+    assert stages['b.mp4'] == (DC.calculate_mhash(entries[2][0], 'md5'), 'full', sample_a)
+    assert stages['c.mp4'] == (None, 'sample', DC.calculate_sample_hash(entries[3][0], size, algorithm='md5'))
@@ -0,0 +1,24 @@
+import os
+import sqlite3
+
+import dupchecker as DC
+import makemaster as MM
+
+
+def test_videos_never_hashed_in_full_are_named_by_their_content(tmp_path):
+    folder = tmp_path / 'videos'
+    folder.mkdir()
+    video = folder / 'clip.mp4'
+    video.write_bytes(b'frames' * 1000)
+    db_name = str(tmp_path / 'imagehash.db')
+    DC.process_images_and_store_hashes(str(folder), db_name, max_workers=1)
+    conn = sqlite3.connect(db_name)
+    try:
+        assert conn.execute('SELECT mhash, hash_stage FROM video_hashes').fetchall() == [(None, 'size')]
+        master = tmp_path / 'master'
+        master.mkdir()
+        MM.copy_movies(MM.create_movlist(conn), str(master))
+    finally:
+        conn.close()
+    digest = DC.calculate_mhash(str(video), DC.VIDEO_HASH_ALGORITHM)
+    assert os.listdir(master) == [f"{digest}.mp4"]
@@ -0,0 +1,47 @@
+import sqlite3
+
+import dupchecker as DC
+import mergeshards as MS
+
+LEGACY_PHASH = 'f0e1d2c3b4a59687'
+
+
+def write_legacy_shard(path, scan_state=False):
+    """A shard in the schema dupchecker wrote before pHashes were integers and video algorithms recorded."""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE hashes (image_id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT UNIQUE, '
+                     'path TEXT UNIQUE, phash TEXT UNIQUE)')
+        conn.execute('CREATE TABLE video_hashes (video_id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT UNIQUE, '
+                     'path TEXT UNIQUE, mhash TEXT UNIQUE)')
+        conn.execute("INSERT INTO hashes (filename, path, phash) VALUES ('a.jpg', '/old/a.jpg', ?)", (LEGACY_PHASH,))
+        conn.execute("INSERT INTO video_hashes (filename, path, mhash) VALUES ('v.mp4', '/old/v.mp4', 'abc123')")
+        if scan_state:
+            conn.execute('CREATE TABLE scan_state (path TEXT PRIMARY KEY, kind TEXT NOT NULL, filename TEXT, '
+                         'hash_value TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER)')
+            conn.executemany(
+                'INSERT INTO scan_state (path, kind, filename, hash_value, size, mtime_ns, inode) VALUES (?, ?, ?, ?, 1, 1, 1)',
+                [('/old/a.jpg', 'hashes', 'a.jpg', LEGACY_PHASH), ('/old/b.jpg', 'hashes', 'b.jpg', LEGACY_PHASH),
+                 ('/old/v.mp4', 'video_hashes', 'v.mp4', 'abc123')],
+            )
+    conn.close()
+
+
+def test_legacy_shards_merge_with_converted_phashes(tmp_path):
+    baseline = str(tmp_path / 'baseline.db')
+    unmigrated = str(tmp_path / 'unmigrated.db')
+    write_legacy_shard(baseline)
+    write_legacy_shard(unmigrated, scan_state=True)
+    merged = str(tmp_path / 'merged.db')
+    MS.merge_shards(merged, [baseline, unmigrated], ['baseline', 'unmigrated'])
+    conn = sqlite3.connect(merged)
+    try:
+        images = conn.execute('SELECT source_id, phash FROM shard_images ORDER BY source_id, path').fetchall()
+        hashes = conn.execute('SELECT phash, copies, cross_source FROM merged_hashes').fetchall()
+        videos = conn.execute('SELECT hash_algorithm, mhash, copies FROM merged_videos').fetchall()
+    finally:
+        conn.close()
+    phash = DC.phash_to_int(LEGACY_PHASH)
+    assert images == [('baseline', phash), ('unmigrated', phash), ('unmigrated', phash)]
+    assert hashes == [(phash, 3, 1)]
+    assert videos == [('md5', 'abc123', 2)]
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import nearduplicates as ND
+from verifyduplicates import group_pairs
+
+
+def test_pairs_link_copies_through_first_copy():
+    index = ND.MultiIndexHash(0)
+    for key in range(100):
+        index.add(key, 0x1234)
+    pairs = list(index.pairs())
+    assert len(pairs) == 99
+    assert group_pairs([(a, b) for a, b, _ in pairs], 100) == [list(range(100))]
+
+
+def test_pairs_compare_distinct_hashes_within_distance():
+    index = ND.MultiIndexHash(2)
+    index.add('a', 0b0000)
+    index.add('b', 0b0011)
+    index.add('c', 0b0011)
+    index.add('d', 0xFF00)
+    pairs = {(a, b): distance for a, b, distance in index.pairs()}
+    assert pairs == {('b', 'c'): 0, ('a', 'b'): 2}
+
+
+def planted_hashes(count, max_distance, seed=0):
+    """Random hashes plus a copy of every tenth one with up to max_distance + 1 bits flipped."""
+    rng = np.random.default_rng(seed)
+    hashes = [int(value) << 1 for value in rng.integers(0, 1 << 63, count, dtype=np.int64)]
+    for position in range(0, count, 10):
+        flips = rng.choice(ND.HASH_BITS, size=position % (max_distance + 2), replace=False)
+        hashes.append(hashes[position] ^ sum(1 << int(bit) for bit in flips))
+    return hashes
+
+
+def brute_force_pairs(hashes, max_distance):
+    values = np.array(hashes, dtype=np.uint64)
+    found = set()
+    for i in range(len(values)):
+        distances = ND.popcount64(values[i + 1:] ^ values[i])
+        found.update((i, i + 1 + j) for j in np.flatnonzero(distances <= max_distance).tolist())
+    return found
+
+
+@pytest.mark.parametrize('count', [50, 3000])
+def test_pairs_find_every_hash_within_distance(count):
+    hashes = planted_hashes(count, 6)
+    index = ND.MultiIndexHash(6)
+    for key, hash_value in enumerate(hashes):
+        index.add(key, hash_value)
+    pairs = {(a, b) for a, b, _ in index.pairs()}
+    expected = brute_force_pairs(hashes, 6)
+    assert pairs == expected
+    assert sorted(map(sorted, index.clusters())) == sorted(group_pairs(expected, len(hashes)))
+    near_first = {(key, (hashes[0] ^ hashes[key]).bit_count()) for pair in expected if 0 in pair for key in pair}
+    assert set(index.query(hashes[0])) == near_first | {(0, 0)}
+
+
+def test_work_per_hash_grows_slowly(monkeypatch):
+    """Probes plus candidates per stored hash; comparing within 9-bit bands grows with the collection."""
+    lookup = ND.BandTable.lookup
+
+    def work_per_hash(count):
+        work = [0]
+
+        def counted(self, values):
+            queries, stored = lookup(self, values)
+            work[0] += len(values) + len(stored)
+            return queries, stored
+
+        monkeypatch.setattr(ND.BandTable, 'lookup', counted)
+        index = ND.MultiIndexHash(ND.DEFAULT_MAX_DISTANCE)
+        for key, hash_value in enumerate(planted_hashes(count, ND.DEFAULT_MAX_DISTANCE)):
+            index.add(key, hash_value)
+        index.clusters()
+        return work[0] / count
+
+    # Eight times the hashes; bucket scans would cost about eight times as much per hash.
+    assert work_per_hash(40000) < 2 * work_per_hash(5000)
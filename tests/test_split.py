@@ -0,0 +1,27 @@
+import json
+
+import main
+
+
+def test_a_saved_plan_is_replayed_without_changed_files(tmp_path, capsys):
+    source = tmp_path / 'pics'
+    source.mkdir()
+    for index, size in enumerate((600, 500, 400)):
+        (source / f'img{index}.jpg').write_bytes(b'x' * size)
+    plan_file = tmp_path / 'plan.json'
+    split_args = ['split', str(source), '--max-gb', str(1000 / 1024 ** 3), '--plan', str(plan_file)]
+
+    main.main(split_args + ['--destination', str(tmp_path / 'first')])
+    plan = json.loads(plan_file.read_text())
+    assert sorted(name for part in plan['parts'] for name, _ in part) == ['img0.jpg', 'img1.jpg', 'img2.jpg']
+
+    (source / 'img1.jpg').write_bytes(b'x' * 50)
+    (source / 'img2.jpg').unlink()
+    (source / 'img3.jpg').write_bytes(b'x' * 10)
+    capsys.readouterr()
+    main.main(split_args + ['--destination', str(tmp_path / 'second')])
+    output = capsys.readouterr().out
+    assert 'img1.jpg: size 500 -> 50' in output and 'img2.jpg: missing' in output
+    copied = sorted(path.name for path in (tmp_path / 'second').rglob('*.jpg'))
+    assert copied == ['img0.jpg']
+    assert json.loads(plan_file.read_text()) == plan
@@ -0,0 +1,50 @@
+import os
+
+import traverse as TRV
+
+
+def walk_sizes(folder, **kwargs):
+    return {name: size for _, name, size, _, _ in TRV.walk(folder, max_workers=2, **kwargs)}
+
+
+def test_snapshot_notices_a_file_rewritten_in_place(tmp_path, monkeypatch):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    for index in range(3):
+        (folder / f'img{index}.jpg').write_bytes(b'x' * 10)
+    old = 1_000_000_000
+    os.utime(folder, ns=(old, old))
+    snapshot_path = str(tmp_path / 'snapshot.db')
+    assert walk_sizes(str(folder), snapshot_path=snapshot_path) == {f'img{index}.jpg': 10 for index in range(3)}
+
+    # Rewriting a file in place leaves the directory's mtime alone.
+    (folder / 'img1.jpg').write_bytes(b'x' * 20)
+    os.utime(folder, ns=(old, old))
+    scandir = os.scandir
+    listed = []
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(TRV.os, 'scandir', counting_scandir)
+    assert walk_sizes(str(folder), snapshot_path=snapshot_path)['img1.jpg'] == 20
+    assert listed == []
+
+
+def test_walk_reports_what_it_could_not_read(tmp_path, monkeypatch):
+    folder = tmp_path / 'pics'
+    (folder / 'sub').mkdir(parents=True)
+    (folder / 'a.jpg').write_bytes(b'a')
+    (folder / 'sub' / 'b.jpg').write_bytes(b'b')
+    list_directory = TRV.list_directory
+
+    def unreadable_sub(directory, *args, **kwargs):
+        if os.path.basename(directory) == 'sub':
+            raise PermissionError(13, 'Permission denied', directory)
+        return list_directory(directory, *args, **kwargs)
+
+    monkeypatch.setattr(TRV, 'list_directory', unreadable_sub)
+    failures = []
+    assert walk_sizes(str(folder), failures=failures) == {'a.jpg': 1}
+    assert failures == [str(folder / 'sub')]
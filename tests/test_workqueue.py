@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+import dupchecker as DC
+import workqueue as WQ
+
+
+@pytest.fixture
+def queue(tmp_path):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    (folder / 'a.jpg').write_bytes(b'not really a jpeg')
+    db_name = str(tmp_path / 'imagehash.db')
+    assert WQ.plan_queue(str(folder), db_name)
+    conn = WQ.connect_queue(db_name)
+    yield conn
+    conn.close()
+
+
+def unit_row(conn):
+    return conn.execute('SELECT state, owner, attempts FROM work_units').fetchone()
+
+
+def hashes_row(path):
+    return ('a.jpg', path, 1, 17, 0, 0)
+
+
+def test_an_expired_lease_is_taken_over_and_its_holder_fenced_off(queue):
+    stale = WQ.claim_unit(queue, 'stale', lease_seconds=-1)
+    fresh = WQ.claim_unit(queue, 'fresh')
+    assert fresh.unit_id == stale.unit_id and fresh.token == stale.token + 1
+    assert unit_row(queue) == ('leased', 'fresh', 2)
+
+    # The stale holder can neither extend the new lease nor commit its rows.
+    WQ.renew_leases(queue, 'stale', [stale])
+    WQ.release_units(queue, 'stale', [stale])
+    assert unit_row(queue) == ('leased', 'fresh', 2)
+    stale.batches['hashes'].append(hashes_row('/stale/a.jpg'))
+    assert not WQ.complete_unit(queue, stale, 'stale')
+    assert queue.execute('SELECT count(*) FROM scan_state').fetchone()[0] == 0
+
+    fresh.batches['hashes'].append(hashes_row('/fresh/a.jpg'))
+    assert WQ.complete_unit(queue, fresh, 'fresh')
+    assert unit_row(queue) == ('done', 'fresh', 2)
+    assert queue.execute('SELECT path FROM scan_state').fetchall() == [('/fresh/a.jpg',)]
+
+
+def test_a_live_lease_is_not_taken_over(queue):
+    WQ.claim_unit(queue, 'first')
+    assert WQ.claim_unit(queue, 'second') is None
+
+
+def test_units_fail_after_max_attempts(queue):
+    for attempt in range(1, WQ.MAX_ATTEMPTS + 1):
+        lease = WQ.claim_unit(queue, 'worker')
+        # Stopping on request hands the unit back without using up the attempt.
+        WQ.release_units(queue, 'worker', [lease])
+        assert unit_row(queue)[::2] == ('pending', attempt - 1)
+        lease = WQ.claim_unit(queue, 'worker', lease_seconds=-1)
+        assert lease.token == attempt
+    assert WQ.claim_unit(queue, 'worker') is None
+    assert unit_row(queue)[::2] == ('failed', WQ.MAX_ATTEMPTS)
+
+
+def test_a_shared_queue_keeps_its_rollback_journal(tmp_path):
+    folder = tmp_path / 'pics'
+    folder.mkdir()
+    db_name = str(tmp_path / 'imagehash.db')
+    assert WQ.plan_queue(str(folder), db_name, shared=True)
+    DC.initialize_database(db_name).close()
+    writer = DC.DatabaseWriter(db_name)
+    writer.close()
+    assert WQ.plan_queue(str(folder), db_name, shared=True)
+    conn = WQ.connect_queue(db_name)
+    try:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == WQ.SHARED_JOURNAL_MODE.lower()
+    finally:
+        conn.close()
+
+
+def test_an_unreadable_directory_is_not_pruned_or_completed(tmp_path, monkeypatch):
+    folder = tmp_path / 'pics'
+    (folder / 'sub').mkdir(parents=True)
+    (folder / 'a.jpg').write_bytes(b'not really a jpeg')
+    (folder / 'sub' / 'b.jpg').write_bytes(b'not really a jpeg either')
+    db_name = str(tmp_path / 'imagehash.db')
+    kept = str(folder / 'sub' / 'b.jpg')
+    conn = DC.initialize_database(db_name)
+    DC.flush_batches(conn, {'hashes': [('b.jpg', kept, 1, 24, 0, 0)]})
+    conn.close()
+
+    list_directory = WQ.TRV.list_directory
+
+    def unreadable_sub(directory, *args, **kwargs):
+        if os.path.basename(directory) == 'sub':
+            raise PermissionError(13, 'Permission denied', directory)
+        return list_directory(directory, *args, **kwargs)
+
+    monkeypatch.setattr(WQ.TRV, 'list_directory', unreadable_sub)
+    assert WQ.plan_queue(str(folder), db_name)
+    assert WQ.finish_queue(db_name, max_workers=1, force=True)
+    conn = WQ.connect_queue(db_name)
+    try:
+        assert conn.execute('SELECT path FROM scan_state').fetchall() == [(kept,)]
+        assert conn.execute('SELECT status FROM scan_runs').fetchone() == ('failed',)
+    finally:
+        conn.close()
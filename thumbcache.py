@@ -0,0 +1,185 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Side of the grayscale thumbnail kept for similarity checks beyond pHash.
+THUMBNAIL_SIZE = 64
+# The cache is trimmed back to EVICT_TO * CACHE_MAX_BYTES, least recently
+# used entries first, once it grows past CACHE_MAX_BYTES.
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+EVICT_TO = 0.9
+# Recently used entries written per transaction.
+TOUCH_BATCH = 500
+
+# width/height are the original dimensions; has_alpha means some pixel is
+# not fully opaque. phash_pixels is the 32x32 array pHash works on, thumbnail
+# a THUMBNAIL_SIZE square grayscale reduction of the same image.
+ImageFeatures = namedtuple('ImageFeatures', 'width height mode has_alpha phash_pixels thumbnail')
+
+_connections = threading.local()
+_open_caches = []
+_open_lock = threading.Lock()
+
+
+def has_transparency(img):
+    """Whether a loaded image has any pixel that is not fully opaque."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and 'transparency' in img.info):
+        alpha = img.convert("RGBA").getchannel("A")
+        return alpha.getextrema()[0] < 255
+    return False
+
+
+def square_array(blob):
+    # numpy is only needed once there are features to unpack; corruptfiles
+    # imports this module whether or not it uses a cache.
+    import numpy as np
+    side = math.isqrt(len(blob))
+    return np.frombuffer(blob, dtype=np.uint8).reshape(side, side)
+
+
+class ThumbnailCache:
+    """
+    Decoded-image features per file, stored as BLOBs in a SQLite database so
+    a later stage (or a re-hash with other settings) does not decode the file
+    again. Entries are keyed by path and only served while the file's
+    (size, mtime_ns, inode) signature is unchanged.
+
+    Each process or thread needs its own instance; see open_cache. Once its
+    thread is done, another may flush or close it.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # Pool workers share the file.
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER,
+                    reduced INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    mode TEXT,
+                    has_alpha INTEGER,
+                    phash_pixels BLOB,
+                    thumbnail BLOB,
+                    bytes INTEGER NOT NULL,
+                    last_used INTEGER NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)')
+        self.pending = []
+        self.touched = []
+
+    def get(self, path, signature, reduced=False):
+        """
+        Returns the ImageFeatures cached for path, or None if there are none for
+        this signature. Features from a reduced (draft) decode are only served
+        when reduced is set; full-resolution ones always are.
+        """
+        row = self.conn.execute(
+            '''SELECT width, height, mode, has_alpha, phash_pixels, thumbnail FROM thumbnails
+               WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ? AND reduced <= ?''',
+            (path, *signature, int(reduced)),
+        ).fetchone()
+        if row is None:
+            return None
+        self.touched.append(path)
+        if len(self.touched) >= TOUCH_BATCH:
+            self.flush()
+        width, height, mode, has_alpha, phash_pixels, thumbnail = row
+        return ImageFeatures(width, height, mode, bool(has_alpha), square_array(phash_pixels), square_array(thumbnail))
+
+    def put(self, path, signature, features, reduced=False):
+        import numpy as np
+        phash_pixels = np.ascontiguousarray(features.phash_pixels, dtype=np.uint8).tobytes()
+        thumbnail = np.ascontiguousarray(features.thumbnail, dtype=np.uint8).tobytes()
+        self.pending.append((
+            path, *signature, int(reduced), features.width, features.height, features.mode,
+            int(features.has_alpha), phash_pixels, thumbnail, len(phash_pixels) + len(thumbnail) + len(path),
+            int(time.time()),
+        ))
+
+    def flush(self):
+        """Writes new entries and the last-used times of served ones in one transaction."""
+        if not self.pending and not self.touched:
+            return
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO thumbnails
+                    (path, size, mtime_ns, inode, reduced, width, height, mode, has_alpha,
+                     phash_pixels, thumbnail, bytes, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', self.pending)
+            self.conn.executemany('UPDATE thumbnails SET last_used = ? WHERE path = ?', [(now, path) for path in self.touched])
+        self.pending.clear()
+        self.touched.clear()
+
+    def total_bytes(self):
+        return self.conn.execute('SELECT total(bytes) FROM thumbnails').fetchone()[0]
+
+    def evict(self):
+        """Drops least recently used entries once the cache is over max_bytes; returns how many."""
+        self.flush()
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return 0
+        excess = total - self.max_bytes * EVICT_TO
+        victims = []
+        for path, size in self.conn.execute('SELECT path, bytes FROM thumbnails ORDER BY last_used'):
+            victims.append((path,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany('DELETE FROM thumbnails WHERE path = ?', victims)
+        return len(victims)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+        self.conn = None
+
+
+def open_cache(path):
+    """Returns this thread's ThumbnailCache for path, opening it on first use."""
+    caches = getattr(_connections, 'caches', None)
+    if caches is None:
+        caches = _connections.caches = {}
+    cache = caches.get(path)
+    if cache is None or cache.conn is None:
+        cache = caches[path] = ThumbnailCache(path)
+        with _open_lock:
+            _open_caches.append(cache)
+    return cache
+
+
+def close_caches():
+    """Flushes and closes every cache open_cache opened in this process; call once its threads are done."""
+    with _open_lock:
+        caches = list(_open_caches)
+        _open_caches.clear()
+    for cache in caches:
+        cache.close()
+
+
+def evict(path, max_bytes=None):
+    """Trims the cache at path to its size budget, printing what was dropped."""
+    cache = ThumbnailCache(path, max_bytes)
+    try:
+        evicted = cache.evict()
+        if evicted:
+            print(f"Evicted {evicted} least recently used thumbnails from {path}")
+        return evicted
+    finally:
+        cache.close()
@@ -0,0 +1,314 @@
+import fnmatch
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Directories listed at once. Every listing and stat() is a round trip on
+# NFS/SMB mounts, so this is well above the CPU count on purpose.
+MAX_WORKERS = 16
+# Files of one directory stat'ed per task; bigger directories are split
+# over the pool so a flat folder of 50k photos isn't stat'ed serially.
+STAT_CHUNK_SIZE = 256
+# Changed directory listings written to the snapshot per transaction.
+SNAPSHOT_BATCH = 500
+# Directories modified this recently are not cached: a change landing in the
+# same (possibly 1-2 s on SMB/FAT) mtime tick would otherwise go unnoticed.
+RACY_WINDOW_NS = 2_000_000_000
+
+
+def matches(patterns, relative_path, name):
+    """Globs without a '/' match the file or directory name, others its path relative to the walk root."""
+    return any(
+        fnmatch.fnmatchcase(relative_path if '/' in pattern else name, pattern)
+        for pattern in patterns
+    )
+
+
+def selects(folder, path, include=(), exclude=()):
+    """Whether walk(folder, include, exclude) would reach path (extensions aside)."""
+    parts = os.path.relpath(path, folder).split(os.sep)
+    for depth in range(1, len(parts)):
+        if exclude and matches(exclude, '/'.join(parts[:depth]), parts[depth - 1]):
+            return False
+    relative_path = '/'.join(parts)
+    if include and not matches(include, relative_path, parts[-1]):
+        return False
+    return not (exclude and matches(exclude, relative_path, parts[-1]))
+
+
+class DirectorySnapshot:
+    """
+    Persisted listing per directory, keyed by the directory's mtime. A
+    directory whose mtime is unchanged is not listed again; its recorded names
+    are stat'ed instead.
+
+    A directory's mtime changes when entries are added, removed or renamed, not
+    when a file is rewritten in place, so the files' own stats are never taken
+    from the snapshot.
+    """
+
+    def __init__(self, path, filter_key):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    directory TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    subdirs TEXT NOT NULL,
+                    files TEXT NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'filter'").fetchone()
+            if row is None or row[0] != filter_key:
+                # Listings are stored filtered, so a different filter starts over.
+                self.conn.execute('DELETE FROM directories')
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('filter', ?)", (filter_key,))
+        self.pending = []
+
+    def get(self, directory):
+        row = self.conn.execute(
+            'SELECT mtime_ns, subdirs, files FROM directories WHERE directory = ?', (directory,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), [tuple(entry) for entry in json.loads(row[2])]
+
+    def put(self, directory, mtime_ns, subdirs, files):
+        self.pending.append((directory, mtime_ns, json.dumps(subdirs), json.dumps(files)))
+        if len(self.pending) >= SNAPSHOT_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO directories (directory, mtime_ns, subdirs, files) VALUES (?, ?, ?, ?)',
+                    self.pending,
+                )
+            self.pending.clear()
+
+    def prune(self, root, visited):
+        """Drops directories under root that the finished walk no longer reached."""
+        prefix = os.path.join(root, '')
+        with self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS visited (directory TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM visited')
+            self.conn.executemany('INSERT OR IGNORE INTO visited (directory) VALUES (?)', ((d,) for d in visited))
+            self.conn.execute('''
+                DELETE FROM directories
+                WHERE (directory = ? OR substr(directory, 1, ?) = ?)
+                  AND directory NOT IN (SELECT directory FROM visited)
+            ''', (root, len(prefix), prefix))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def stat_entry(path, metrics=None):
+    start = time.perf_counter()
+    st = os.stat(path)
+    if metrics is not None:
+        metrics.observe('stat', time.perf_counter() - start)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def list_directory(directory, relative_dir, cached, want_mtime, keep_file, skip_stat, metrics=None):
+    """
+    Lists one directory (runs in a worker thread). Returns
+    (mtime_ns, subdirs, files, unstated, reused, failed) with files as
+    (name, size, mtime_ns, inode); the stat fields are None for files
+    skip_stat matches. Directories with more than STAT_CHUNK_SIZE files to
+    stat leave them in unstated so the caller can spread them over the pool.
+    failed lists the paths of entries that could not be read.
+
+    When cached holds the snapshot listing of an unchanged directory, its names
+    are used instead of listing the directory, but the files are stat'ed again.
+    """
+    start = time.perf_counter()
+    mtime_ns = os.stat(directory).st_mtime_ns if want_mtime else None
+    if cached is not None and cached[0] == mtime_ns:
+        files = []
+        to_stat = []
+        for name, *_ in cached[2]:
+            if skip_stat is not None and skip_stat(os.path.join(directory, name)):
+                files.append((name, None, None, None))
+            else:
+                to_stat.append(name)
+        if len(to_stat) > STAT_CHUNK_SIZE:
+            return mtime_ns, cached[1], files, to_stat, True, []
+        stated, failed = stat_names(directory, to_stat, metrics)
+        return mtime_ns, cached[1], files + stated, [], True, failed
+
+    subdirs = []
+    files = []
+    to_stat = []
+    failed = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    if not keep_file(relative_dir + entry.name, entry.name):
+                        continue
+                    if skip_stat is not None and skip_stat(entry.path):
+                        files.append((entry.name, None, None, None))
+                    else:
+                        to_stat.append(entry)
+            except OSError as e:
+                print(f"Error reading {entry.path}: {e}")
+                failed.append(entry.path)
+    if metrics is not None:
+        metrics.observe('list', time.perf_counter() - start)
+
+    # On Windows DirEntry.stat() is answered from the listing itself.
+    if len(to_stat) > STAT_CHUNK_SIZE and os.name != 'nt':
+        return mtime_ns, subdirs, files, [entry.name for entry in to_stat], False, failed
+    for entry in to_stat:
+        try:
+            stat_start = time.perf_counter()
+            st = entry.stat()
+            if metrics is not None:
+                metrics.observe('stat', time.perf_counter() - stat_start)
+            files.append((entry.name, st.st_size, st.st_mtime_ns, st.st_ino))
+        except OSError as e:
+            print(f"Error reading {entry.path}: {e}")
+            failed.append(entry.path)
+    return mtime_ns, subdirs, files, [], False, failed
+
+
+def stat_names(directory, names, metrics=None):
+    """Stats a chunk of one directory's files (runs in a worker thread). Returns (files, failed paths)."""
+    files = []
+    failed = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            files.append((name,) + stat_entry(path, metrics))
+        except OSError as e:
+            print(f"Error reading {path}: {e}")
+            failed.append(path)
+    return files, failed
+
+
+def walk(folder, include=(), exclude=(), extensions=None, recursive=True, max_workers=MAX_WORKERS,
+         snapshot_path=None, skip_stat=None, metrics=None, failures=None):
+    """
+    Yields (path, name, size, mtime_ns, inode) for every file under folder,
+    listing up to max_workers directories concurrently so stat() round trips
+    overlap; large directories have their stats split over the pool too.
+    Paths are built like os.walk's, and all files of a directory are yielded
+    together; directories come in no particular order.
+
+    include/exclude are glob lists (see matches): files must match an include
+    pattern, if any, and no exclude pattern; excluded directories are not
+    entered. extensions, if given, is a set of lower-case extensions to keep.
+    skip_stat(path) -> True yields that file with None stat fields.
+
+    snapshot_path names a DirectorySnapshot database; directories whose mtime
+    is unchanged since it was written are not listed again (their files are
+    still stat'ed).
+
+    Directories that cannot be listed and files that cannot be stat'ed are
+    reported and left out. failures, if given, is a list that receives their
+    paths: files under them were not seen, which does not make them deleted.
+    """
+    include, exclude = tuple(include), tuple(exclude)
+
+    def keep_file(relative_path, name):
+        if extensions is not None and os.path.splitext(name)[1].lower() not in extensions:
+            return False
+        if include and not matches(include, relative_path, name):
+            return False
+        return not (exclude and matches(exclude, relative_path, name))
+
+    snapshot = None
+    if snapshot_path:
+        filter_key = json.dumps([include, exclude, sorted(extensions) if extensions is not None else None, recursive])
+        snapshot = DirectorySnapshot(snapshot_path, filter_key)
+
+    pending = deque([(folder, '')])
+    in_flight = {}
+    # directory -> [mtime_ns, subdirs, files, chunk results, chunks left, failed, reused] while its stats are spread out
+    splitting = {}
+    visited = []
+    finished = False
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='traverse')
+
+    def fail(paths):
+        if failures is not None:
+            failures.extend(paths)
+        if metrics is not None and paths:
+            metrics.incr('walk_errors', len(paths))
+
+    def finish_directory(directory, mtime_ns, subdirs, files, reused, failed):
+        visited.append(directory)
+        if metrics is not None:
+            metrics.incr('dirs_reused' if reused else 'dirs_listed')
+        fail(failed)
+        if snapshot is not None and not reused and not failed and time.time_ns() - mtime_ns > RACY_WINDOW_NS \
+                and all(entry[1] is not None for entry in files):
+            snapshot.put(directory, mtime_ns, subdirs, files)
+        for name, size, file_mtime_ns, inode in files:
+            yield os.path.join(directory, name), name, size, file_mtime_ns, inode
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers * 2:
+                directory, relative_dir = pending.popleft()
+                cached = snapshot.get(directory) if snapshot is not None else None
+                future = executor.submit(
+                    list_directory, directory, relative_dir, cached, snapshot is not None,
+                    keep_file, skip_stat, metrics,
+                )
+                in_flight[future] = (directory, relative_dir, None)
+            if metrics is not None:
+                metrics.set_gauge('dirs_in_flight', len(in_flight))
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory, relative_dir, chunk = in_flight.pop(future)
+                if chunk is not None:
+                    state = splitting[directory]
+                    state[3][chunk], chunk_failed = future.result()
+                    state[5].extend(chunk_failed)
+                    state[4] -= 1
+                    if not state[4]:
+                        del splitting[directory]
+                        files = state[2] + [entry for chunk_files in state[3] for entry in chunk_files]
+                        yield from finish_directory(directory, state[0], state[1], files, state[6], state[5])
+                    continue
+
+                try:
+                    mtime_ns, subdirs, files, unstated, reused, failed = future.result()
+                except OSError as e:
+                    print(f"Error reading directory {directory}: {e}")
+                    fail([directory])
+                    continue
+                if recursive:
+                    for name in subdirs:
+                        relative_path = relative_dir + name
+                        if exclude and matches(exclude, relative_path, name):
+                            continue
+                        pending.append((os.path.join(directory, name), relative_path + '/'))
+                if unstated:
+                    chunks = [unstated[i:i + STAT_CHUNK_SIZE] for i in range(0, len(unstated), STAT_CHUNK_SIZE)]
+                    splitting[directory] = [mtime_ns, subdirs, files, [None] * len(chunks), len(chunks), failed, reused]
+                    for index, names in enumerate(chunks):
+                        in_flight[executor.submit(stat_names, directory, names, metrics)] = (directory, relative_dir, index)
+                    continue
+                yield from finish_directory(directory, mtime_ns, subdirs, files, reused, failed)
+        finished = True
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if snapshot is not None:
+            if finished:
+                snapshot.prune(folder, visited)
+            snapshot.close()
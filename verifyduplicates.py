@@ -0,0 +1,336 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import dupchecker as DC
+import nearduplicates as ND
+import thumbcache as TC
+
+# pHash distance a pair needs to become a candidate. 0 verifies only the
+# identical pHashes the hashes table already collapses; larger values also
+# confirm near duplicates (which makemaster then collapses too).
+DEFAULT_MAX_DISTANCE = 0
+# Largest relative difference in width/height ratio (tier 1).
+ASPECT_TOLERANCE = 0.02
+# dHash bits two thumbnails may differ in (tier 2). Re-encoded or resized
+# copies stay well below this; unrelated low-detail images, whose gradients
+# are mostly noise, land near 32.
+DHASH_MAX_DISTANCE = 12
+# Mean SSIM over SSIM_BLOCK x SSIM_BLOCK blocks of the cached thumbnails a
+# pair needs to be confirmed (tier 3), and pairs compared per NumPy batch.
+SSIM_THRESHOLD = 0.9
+SSIM_BLOCK = 8
+SSIM_BATCH = 1024
+# SSIM stabilizing constants for 8-bit pixels.
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+# Threads reading headers and decoding thumbnails; Pillow releases the GIL.
+MAX_WORKERS = 4
+
+
+class HashedImage:
+    """One image from scan_state and what the tiers have loaded for it."""
+
+    __slots__ = ('path', 'phash', 'signature', 'represented', 'dimensions', 'thumbnail')
+
+    def __init__(self, path, phash, signature, represented):
+        self.path = path
+        self.phash = phash
+        self.signature = signature
+        # Whether this is the path the hashes table keeps for its pHash.
+        self.represented = represented
+        self.dimensions = None
+        self.thumbnail = None
+
+
+class TierStats:
+    """Pairs entering and leaving one tier, and the time it took."""
+
+    def __init__(self, name, pairs_in=0):
+        self.name = name
+        self.pairs_in = pairs_in
+        self.pairs_out = 0
+        self.seconds = 0.0
+
+    @property
+    def eliminated(self):
+        return self.pairs_in - self.pairs_out
+
+
+def load_images(conn):
+    """Every hashed image, including the copies the hashes table folded into one row."""
+    rows = conn.execute('''
+        SELECT path, hash_value, size, mtime_ns, inode,
+               path IN (SELECT path FROM hashes) AS represented
+        FROM scan_state WHERE kind = 'hashes' AND hash_value IS NOT NULL
+        ORDER BY rowid
+    ''')
+    return [
+        HashedImage(path, int(phash), (size, mtime_ns, inode), bool(represented))
+        for path, phash, size, mtime_ns, inode, represented in rows
+    ]
+
+
+def load_exact_originals(conn):
+    """path -> original_path for byte-identical copies (see dupchecker.ExactImageIndex)."""
+    return dict(conn.execute('SELECT path, original_path FROM exact_duplicates'))
+
+
+def read_dimensions(image, thumbnail_cache=None, fast_decode=DC.FAST_DECODE):
+    """(width, height) from the thumbnail cache, or from the file header without decoding."""
+    cache = TC.open_cache(thumbnail_cache) if thumbnail_cache else None
+    if cache is not None:
+        features = cache.get(image.path, image.signature, fast_decode)
+        if features is not None:
+            image.thumbnail = features.thumbnail
+            return features.width, features.height
+    try:
+        with Image.open(image.path) as img:
+            return img.size
+    except Exception as e:
+        print(f"Error reading {image.path}: {e}")
+        return None
+
+
+def read_thumbnail(image, thumbnail_cache=None, fast_decode=DC.FAST_DECODE):
+    """The cached grayscale thumbnail, decoding the image (and caching it) on a miss."""
+    if image.thumbnail is not None:
+        return image.thumbnail
+    cache = TC.open_cache(thumbnail_cache) if thumbnail_cache else None
+    if cache is not None:
+        features = cache.get(image.path, image.signature, fast_decode)
+        if features is not None:
+            return features.thumbnail
+    try:
+        with Image.open(image.path) as img:
+            width, height = img.size
+            if fast_decode:
+                DC.draft_for_thumbnail(img)
+            img.load()
+            features = DC.image_features(img, width, height)
+    except Exception as e:
+        print(f"Error decoding {image.path}: {e}")
+        return None
+    if cache is not None:
+        cache.put(image.path, image.signature, features, fast_decode)
+    return features.thumbnail
+
+
+def aspect_matches(a, b, tolerance=ASPECT_TOLERANCE):
+    """Whether two (width, height) pairs have the same shape, orientation included."""
+    ratio_a = a[0] / a[1]
+    ratio_b = b[0] / b[1]
+    return abs(ratio_a - ratio_b) <= tolerance * max(ratio_a, ratio_b)
+
+
+def dhash_batch(thumbnails):
+    """
+    64-bit difference hashes of a (N, S, S) thumbnail stack: each row is
+    averaged down to 9 columns and every bit says whether a column is
+    brighter than the one to its left. Returns a uint64 array.
+    """
+    pixels = np.asarray(thumbnails, dtype=np.float64)
+    side = pixels.shape[1]
+    rows = np.add.reduceat(pixels, np.arange(0, side, side // 8), axis=1)
+    columns = np.add.reduceat(rows, (np.arange(9) * side) // 9, axis=2)
+    widths = np.diff(np.append((np.arange(9) * side) // 9, side))
+    grid = columns / widths
+    bits = (grid[:, :, 1:] > grid[:, :, :-1]).reshape(len(pixels), -1)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def ssim_batch(a, b, block=SSIM_BLOCK):
+    """Mean SSIM over non-overlapping block x block windows for each pair of (N, S, S) stacks."""
+    count, side = a.shape[0], a.shape[1]
+    blocks = side // block
+
+    def windows(stack):
+        stack = stack[:, :blocks * block, :blocks * block].astype(np.float64)
+        return stack.reshape(count, blocks, block, blocks, block).transpose(0, 1, 3, 2, 4).reshape(count, blocks * blocks, -1)
+
+    a, b = windows(a), windows(b)
+    mean_a, mean_b = a.mean(axis=2), b.mean(axis=2)
+    var_a, var_b = a.var(axis=2), b.var(axis=2)
+    covariance = ((a - mean_a[..., None]) * (b - mean_b[..., None])).mean(axis=2)
+    ssim = ((2 * mean_a * mean_b + SSIM_C1) * (2 * covariance + SSIM_C2)) / (
+        (mean_a ** 2 + mean_b ** 2 + SSIM_C1) * (var_a + var_b + SSIM_C2)
+    )
+    return ssim.mean(axis=1)
+
+
+def load_for(images, positions, function, thumbnail_cache, fast_decode, max_workers):
+    """Runs function over the given images in a thread pool; returns {position: result}."""
+    positions = sorted(positions)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda position: function(images[position], thumbnail_cache, fast_decode), positions)
+        loaded = dict(zip(positions, results))
+    if thumbnail_cache:
+        TC.close_caches()
+    return loaded
+
+
+def group_pairs(pairs, count):
+    """Single-linkage groups (lists of positions) from confirmed pairs."""
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+    groups = {}
+    for a, b in pairs:
+        groups.setdefault(find(a), set()).update((a, b))
+    return [sorted(members) for members in groups.values()]
+
+
+def pick_keeper(images, members, originals):
+    """
+    The copy to keep: most pixels, then largest file, then an original over its
+    byte-identical copies, then the one in hashes, then by path.
+    """
+    def rank(position):
+        image = images[position]
+        width, height = image.dimensions or (0, 0)
+        return (-width * height, -(image.signature[0] or 0), image.path in originals, not image.represented, image.path)
+    return min(members, key=rank)
+
+
+def store_verified(conn, images, groups, originals):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS verified_duplicates (
+                path TEXT PRIMARY KEY,
+                group_id INTEGER NOT NULL,
+                keeper INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('DELETE FROM verified_duplicates')
+        rows = []
+        for group_id, members in enumerate(groups, 1):
+            keeper = pick_keeper(images, members, originals)
+            rows.extend((images[position].path, group_id, int(position == keeper)) for position in members)
+        conn.executemany('INSERT INTO verified_duplicates (path, group_id, keeper) VALUES (?, ?, ?)', rows)
+
+
+def print_report(image_count, tiers, byte_identical, groups):
+    print(f"\n{'tier':<24} {'pairs in':>12} {'eliminated':>12} {'seconds':>9}")
+    for tier in tiers:
+        print(f"{tier.name:<24} {tier.pairs_in:>12} {tier.eliminated:>12} {tier.seconds:>9.2f}")
+    confirmed = tiers[-1].pairs_out + byte_identical
+    grouped = sum(len(members) for members in groups)
+    print(f"\nConfirmed {confirmed} duplicate pairs among {image_count} images "
+          f"({byte_identical} byte-identical, not decoded): {len(groups)} groups, "
+          f"{grouped - len(groups)} redundant copies")
+
+
+def verify_duplicates(db_name='imagehash.db', max_distance=DEFAULT_MAX_DISTANCE, thumbnail_cache=None,
+                      fast_decode=DC.FAST_DECODE, max_workers=MAX_WORKERS, ssim_threshold=SSIM_THRESHOLD):
+    """
+    Confirms which images sharing a pHash (or within max_distance of one) are
+    really the same picture, cheapest check first:
+
+    1. pHash distance (multi-index search) and aspect ratio from the header,
+    2. dHash of the 64x64 cached thumbnail,
+    3. block SSIM of the same thumbnails, batched over all remaining pairs.
+
+    Images sharing a pHash are each checked against the first of them
+    rather than against one another, so a pHash shared by thousands of
+    blank scans costs thousands of pairs, not millions; groups come from
+    single linkage over the confirmed pairs. Byte-identical copies recorded
+    by dupchecker are confirmed without decoding. Confirmed pairs are grouped and stored in verified_duplicates
+    with one keeper per group, for makemaster's confirmed_only mode. Returns
+    the groups as lists of paths.
+    """
+    conn = DC.initialize_database(db_name)
+    try:
+        images = load_images(conn)
+        originals = load_exact_originals(conn)
+        tiers = []
+
+        tier = TierStats(f"pHash <= {max_distance} + aspect", len(images) * (len(images) - 1) // 2)
+        start = time.perf_counter()
+        index = ND.MultiIndexHash(max_distance)
+        for position, image in enumerate(images):
+            index.add(position, image.phash & 0xFFFFFFFFFFFFFFFF)
+        candidates = []
+        confirmed = []
+        for a, b, _ in index.pairs():
+            if originals.get(images[a].path, images[a].path) == originals.get(images[b].path, images[b].path):
+                confirmed.append((a, b))
+            else:
+                candidates.append((a, b))
+        byte_identical = len(confirmed)
+        tier.pairs_in -= byte_identical
+        involved = {position for pair in candidates for position in pair} | {position for pair in confirmed for position in pair}
+        for position, dimensions in load_for(images, involved, read_dimensions, thumbnail_cache, fast_decode, max_workers).items():
+            images[position].dimensions = dimensions
+        candidates = [
+            (a, b) for a, b in candidates
+            if images[a].dimensions and images[b].dimensions and aspect_matches(images[a].dimensions, images[b].dimensions)
+        ]
+        tier.pairs_out = len(candidates)
+        tier.seconds = time.perf_counter() - start
+        tiers.append(tier)
+
+        tier = TierStats(f"dHash <= {DHASH_MAX_DISTANCE}", len(candidates))
+        start = time.perf_counter()
+        involved = sorted({position for pair in candidates for position in pair})
+        for position, thumbnail in load_for(images, involved, read_thumbnail, thumbnail_cache, fast_decode, max_workers).items():
+            images[position].thumbnail = thumbnail
+        candidates = [(a, b) for a, b in candidates if images[a].thumbnail is not None and images[b].thumbnail is not None]
+        if candidates:
+            involved = sorted({position for pair in candidates for position in pair})
+            slot = {position: i for i, position in enumerate(involved)}
+            thumbnails = np.stack([images[position].thumbnail for position in involved])
+            dhashes = dhash_batch(thumbnails)
+            pair_slots = np.array([(slot[a], slot[b]) for a, b in candidates], dtype=np.int64)
+            distances = ND.popcount64(dhashes[pair_slots[:, 0]] ^ dhashes[pair_slots[:, 1]])
+            keep = np.flatnonzero(distances <= DHASH_MAX_DISTANCE)
+            candidates = [candidates[i] for i in keep]
+            pair_slots = pair_slots[keep]
+        tier.pairs_out = len(candidates)
+        tier.seconds = time.perf_counter() - start
+        tiers.append(tier)
+
+        tier = TierStats(f"SSIM >= {ssim_threshold}", len(candidates))
+        start = time.perf_counter()
+        for offset in range(0, len(candidates), SSIM_BATCH):
+            chunk = pair_slots[offset:offset + SSIM_BATCH]
+            scores = ssim_batch(thumbnails[chunk[:, 0]], thumbnails[chunk[:, 1]])
+            confirmed.extend(candidates[offset + i] for i in np.flatnonzero(scores >= ssim_threshold))
+        tier.pairs_out = len(confirmed) - byte_identical
+        tier.seconds = time.perf_counter() - start
+        tiers.append(tier)
+
+        groups = group_pairs(confirmed, len(images))
+        store_verified(conn, images, groups, originals)
+        print_report(len(images), tiers, byte_identical, groups)
+        return [[images[position].path for position in members] for members in groups]
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Confirm pHash duplicates with dHash and SSIM before makemaster collapses them.")
+    parser.add_argument('db_name', nargs='?', default='imagehash.db')
+    parser.add_argument('-k', '--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="pHash distance for candidates (0: identical pHashes only)")
+    parser.add_argument('--thumbnail-cache', metavar='PATH', help="Thumbnail cache database to read and fill")
+    parser.add_argument('--ssim', type=float, default=SSIM_THRESHOLD, help="SSIM a pair needs to be confirmed")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="Threads reading and decoding images")
+    args = parser.parse_args(argv)
+    verify_duplicates(args.db_name, args.max_distance, args.thumbnail_cache, max_workers=args.workers,
+                      ssim_threshold=args.ssim)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,675 @@
+"""
+Shares one scan between any number of worker processes, on this machine or
+on others that mount the same tree and database.
+
+    python workqueue.py plan FOLDER --db imagehash.db
+    python workqueue.py work --db imagehash.db [--processes N]    (as many as you like, started any time)
+    python workqueue.py status --db imagehash.db
+    python workqueue.py finish --db imagehash.db
+    python workqueue.py run FOLDER --db imagehash.db --workers N  (all of the above on this machine)
+
+plan walks the tree once and stores it as work units (a few hundred media
+files each, see UNIT_FILES) in the scan database itself. Workers lease
+units, hash their images and write the rows and the unit's completion in
+one transaction; videos are only recorded, since whether one needs reading
+depends on the sizes of videos in other units. A lease that is not renewed within LEASE_SECONDS (the worker
+died or hung) is handed to the next worker that asks. finish hashes the
+video size collisions across units, completes the scan run and drops the
+queue; the database is then an ordinary dupchecker database.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import dupchecker as DC
+import metrics as MET
+import traverse as TRV
+
+# Media files per work unit: small directories are packed together, larger
+# ones split. Big enough that claiming and committing a unit (a few ms) is
+# noise next to hashing it, small enough that a lost unit is cheap to redo.
+UNIT_FILES = 256
+# Seconds a unit stays leased without renewal before another worker may take it over.
+LEASE_SECONDS = 60.0
+# Workers renew their leases this often (a fraction of the lease) while hashing.
+RENEW_FRACTION = 0.25
+# Seconds an idle worker waits before looking for expired leases again.
+POLL_INTERVAL = 2.0
+# A unit leased this many times without being finished is marked failed
+# rather than handed out again, so one unreadable file cannot stall the queue.
+MAX_ATTEMPTS = 3
+# Every worker writes to the same database, so waits for its lock are longer than dupchecker's.
+BUSY_TIMEOUT_MS = 60000
+# WAL needs shared memory, which only works between processes on one host.
+# Queues shared with other machines over NFS/SMB use a rollback journal.
+SHARED_JOURNAL_MODE = 'DELETE'
+QUEUE_META_KEYS = ('queue_folder', 'queue_filters', 'queue_run_id', 'queue_video_hash', 'queue_walk_failures')
+
+
+class LeaseLost(Exception):
+    """The unit was re-leased to another worker before this one finished it."""
+
+
+class Lease:
+    __slots__ = ('unit_id', 'token', 'dirs', 'tasks_left', 'batches', 'videos', 'files')
+
+    def __init__(self, unit_id, token, dirs):
+        self.unit_id = unit_id
+        # The attempt number: a worker whose lease was taken over no longer matches it.
+        self.token = token
+        self.dirs = dirs
+        self.tasks_left = 0
+        self.batches = {'hashes': [], 'video_hashes': [], 'exact_duplicates': []}
+        self.videos = []
+        self.files = 0
+
+
+def connect_queue(db_name):
+    conn = sqlite3.connect(db_name)
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA journal_mode={DC.journal_mode(conn)}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+@contextmanager
+def immediate(conn):
+    """A transaction that takes the write lock up front, so what it reads cannot change before it writes."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def initialize_queue(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS work_units (
+                unit_id INTEGER PRIMARY KEY,
+                files INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                hashed INTEGER,
+                finished_at REAL,
+                error TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS work_units_state ON work_units (state, lease_expires)')
+        # A directory with more than UNIT_FILES files is split into parts by name hash.
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS unit_dirs (
+                unit_id INTEGER NOT NULL,
+                directory TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                parts INTEGER NOT NULL,
+                PRIMARY KEY (unit_id, directory, part)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS queue_workers (
+                worker_id TEXT PRIMARY KEY,
+                host TEXT,
+                pid INTEGER,
+                started_at REAL,
+                heartbeat REAL,
+                units INTEGER NOT NULL DEFAULT 0,
+                files INTEGER NOT NULL DEFAULT 0,
+                state TEXT
+            )
+        ''')
+        # Videos hashed by units; finish re-stages the sizes they share with other videos.
+        conn.execute('CREATE TABLE IF NOT EXISTS queue_videos (path TEXT PRIMARY KEY, size INTEGER)')
+
+
+def queue_settings(conn):
+    """The planned queue's {meta key: value}, or None if the database has no queue."""
+    try:
+        rows = dict(conn.execute(
+            f"SELECT key, value FROM meta WHERE key IN ({', '.join('?' * len(QUEUE_META_KEYS))})", QUEUE_META_KEYS
+        ))
+    except sqlite3.OperationalError:
+        return None
+    return rows if 'queue_run_id' in rows else None
+
+
+def unit_counts(conn):
+    """{state: (units, files)} over the queue."""
+    return {
+        state: (units, files)
+        for state, units, files in conn.execute('SELECT state, count(*), sum(files) FROM work_units GROUP BY state')
+    }
+
+
+def pack_units(dir_counts, unit_files=UNIT_FILES):
+    """
+    Groups {directory: media files} into units of about unit_files files:
+    lists of (directory, part, parts). Directories are taken in path order,
+    so a unit's directories are neighbours on disk.
+    """
+    units = []
+    current = []
+    current_files = 0
+    for directory in sorted(dir_counts):
+        files = dir_counts[directory]
+        if files > unit_files:
+            parts = -(-files // unit_files)
+            units.extend(([(directory, part, parts)], files // parts) for part in range(parts))
+            continue
+        if current and current_files + files > unit_files:
+            units.append((current, current_files))
+            current, current_files = [], 0
+        current.append((directory, 0, 1))
+        current_files += files
+    if current:
+        units.append((current, current_files))
+    return units
+
+
+def plan_queue(folder, db_name='imagehash.db', include=(), exclude=(), unit_files=UNIT_FILES, video_hash=None,
+               source_id=None, shared=False):
+    """
+    Walks folder once (names only, no stat) and queues its media files as
+    work units in db_name. Rows of files that disappeared since the last scan
+    are pruned here, as the walk sees every file. A database that already
+    has a queue for folder keeps it, so plan can be re-run safely.
+
+    shared switches db_name to a rollback journal for workers on other hosts,
+    for good: it is recorded in meta, which every later connection honours.
+    """
+    conn = DC.initialize_database(db_name)
+    try:
+        initialize_queue(conn)
+        if shared:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_mode', ?)", (SHARED_JOURNAL_MODE,))
+            conn.execute(f'PRAGMA journal_mode={SHARED_JOURNAL_MODE}')
+        settings = queue_settings(conn)
+        if settings is not None:
+            if settings['queue_folder'] != folder:
+                print(f"Error: {db_name} already has a queue for {settings['queue_folder']}; finish it first")
+                return False
+            print(f"Queue for {folder} already planned (run {settings['queue_run_id']}), keeping it")
+            print_status(conn)
+            return True
+
+        start = time.perf_counter()
+        dir_counts = {}
+        seen_paths = set()
+        walk_failures = []
+        for file_path, *_ in TRV.walk(folder, include, exclude, DC.MEDIA_EXTENSIONS, skip_stat=lambda path: True,
+                                      failures=walk_failures):
+            seen_paths.add(file_path)
+            directory = os.path.dirname(file_path)
+            dir_counts[directory] = dir_counts.get(directory, 0) + 1
+        walked = time.perf_counter()
+
+        video_algorithm = DC.resolve_video_algorithm(conn, video_hash)
+        known_signatures = {
+            path: signature for path, signature in DC.load_stat_signatures(conn, folder).items()
+            if TRV.selects(folder, path, include, exclude)
+        }
+        pruned = DC.finish_incremental(conn, known_signatures, seen_paths, 0, walk_failures)
+        DC.resolve_source_id(conn, source_id, folder)
+        run_id, _ = DC.start_run(conn, folder, resume=False)
+
+        units = pack_units(dir_counts, unit_files)
+        with conn:
+            for unit_id, (dirs, files) in enumerate(units, 1):
+                conn.execute('INSERT INTO work_units (unit_id, files) VALUES (?, ?)', (unit_id, files))
+                conn.executemany(
+                    'INSERT INTO unit_dirs (unit_id, directory, part, parts) VALUES (?, ?, ?, ?)',
+                    [(unit_id,) + entry for entry in dirs],
+                )
+            conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (
+                ('queue_folder', folder),
+                ('queue_filters', json.dumps([list(include), list(exclude)])),
+                ('queue_run_id', str(run_id)),
+                ('queue_video_hash', video_algorithm),
+                ('queue_walk_failures', json.dumps(walk_failures)),
+            ))
+        print(f"Queued {len(seen_paths)} media files in {len(dir_counts)} directories as {len(units)} units "
+              f"(walk {walked - start:.2f}s), pruned {pruned} missing")
+        if walk_failures:
+            print(f"Could not read {len(walk_failures)} paths; kept their rows, the run will not complete")
+        return True
+    finally:
+        conn.close()
+
+
+def claim_unit(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    """Leases the next pending unit, or one whose lease ran out, to worker_id. Returns a Lease or None."""
+    now = time.time()
+    with immediate(conn):
+        conn.execute(
+            "UPDATE work_units SET state = 'failed', error = ? WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (f"lease expired {MAX_ATTEMPTS} times", now, MAX_ATTEMPTS),
+        )
+        row = conn.execute("SELECT unit_id, attempts, owner FROM work_units WHERE state = 'pending' ORDER BY unit_id LIMIT 1").fetchone()
+        if row is None:
+            row = conn.execute(
+                "SELECT unit_id, attempts, owner FROM work_units WHERE state = 'leased' AND lease_expires < ? "
+                "ORDER BY lease_expires LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            print(f"Taking over unit {row[0]} from {row[2]} (lease expired)")
+        unit_id, attempts, _ = row
+        conn.execute(
+            "UPDATE work_units SET state = 'leased', owner = ?, lease_expires = ?, attempts = ? WHERE unit_id = ?",
+            (worker_id, now + lease_seconds, attempts + 1, unit_id),
+        )
+    dirs = conn.execute('SELECT directory, part, parts FROM unit_dirs WHERE unit_id = ? ORDER BY directory, part', (unit_id,)).fetchall()
+    return Lease(unit_id, attempts + 1, dirs)
+
+
+def renew_leases(conn, worker_id, leases, lease_seconds=LEASE_SECONDS):
+    """Extends worker_id's leases and heartbeat. Leases another worker took over stay lost; finishing them fails."""
+    now = time.time()
+    with conn:
+        for lease in leases:
+            conn.execute(
+                "UPDATE work_units SET lease_expires = ? WHERE unit_id = ? AND owner = ? AND attempts = ? AND state = 'leased'",
+                (now + lease_seconds, lease.unit_id, worker_id, lease.token),
+            )
+        conn.execute('UPDATE queue_workers SET heartbeat = ? WHERE worker_id = ?', (now, worker_id))
+
+
+def release_units(conn, worker_id, leases, error=None):
+    """
+    Hands unfinished units back to the queue so other workers take them at
+    once. A worker that stopped on request does not use up an attempt; one
+    that failed does (see MAX_ATTEMPTS).
+    """
+    with conn:
+        for lease in leases:
+            conn.execute('''
+                UPDATE work_units SET
+                    state = CASE WHEN ? IS NOT NULL AND attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    attempts = attempts - (? IS NULL), lease_expires = NULL, error = ?
+                WHERE unit_id = ? AND owner = ? AND attempts = ? AND state = 'leased'
+            ''', (error, MAX_ATTEMPTS, error, error, lease.unit_id, worker_id, lease.token))
+
+
+def complete_unit(conn, lease, worker_id, metrics=None):
+    """
+    Writes the unit's rows and marks it done in one transaction, so a unit is
+    either finished with all its rows or still waiting for a worker. Returns
+    False (and writes nothing) if the lease went to another worker meanwhile.
+    """
+    hashed = sum(len(rows) for rows in lease.batches.values())
+
+    def checkpoint(conn):
+        cursor = conn.execute(
+            "UPDATE work_units SET state = 'done', lease_expires = NULL, hashed = ?, finished_at = ?, error = NULL "
+            "WHERE unit_id = ? AND owner = ? AND attempts = ? AND state = 'leased'",
+            (hashed, time.time(), lease.unit_id, worker_id, lease.token),
+        )
+        if cursor.rowcount == 0:
+            raise LeaseLost(lease.unit_id)
+        conn.executemany('INSERT OR REPLACE INTO queue_videos (path, size) VALUES (?, ?)', lease.videos)
+        conn.execute(
+            'UPDATE queue_workers SET units = units + 1, files = files + ?, heartbeat = ? WHERE worker_id = ?',
+            (lease.files, time.time(), worker_id),
+        )
+
+    try:
+        DC.flush_batches(conn, lease.batches, checkpoint, metrics)
+    except LeaseLost:
+        print(f"Lost the lease on unit {lease.unit_id} to another worker; dropped its {hashed} rows")
+        return False
+    return True
+
+
+def unit_entries(conn, lease, folder, include=(), exclude=(), video_algorithm=DC.VIDEO_HASH_ALGORITHM, metrics=None):
+    """
+    Lists and stats the unit's media files. Returns (images, videos) as
+    (path, size, mtime_ns, inode) entries, leaving out files whose signature
+    matches the stored scan. Parts of a split directory are taken by name
+    hash, so files added since plan do not shift the other parts.
+    """
+    entries = []
+    for directory, part, parts in lease.dirs:
+        try:
+            with os.scandir(directory) as listing:
+                names = sorted(entry.name for entry in listing if entry.is_file())
+        except OSError as e:
+            print(f"Error reading directory {directory}: {e}")
+            continue
+        for name in names:
+            if os.path.splitext(name)[1].lower() not in DC.MEDIA_EXTENSIONS:
+                continue
+            if parts > 1 and zlib.crc32(name.encode('utf-8', 'surrogateescape')) % parts != part:
+                continue
+            file_path = os.path.join(directory, name)
+            if (include or exclude) and not TRV.selects(folder, file_path, include, exclude):
+                continue
+            try:
+                entries.append((file_path,) + TRV.stat_entry(file_path, metrics))
+            except OSError as e:
+                print(f"Error reading {file_path}: {e}")
+
+    known = {}
+    for chunk in DC.chunked([entry[0] for entry in entries], 500):
+        known.update((path, (size, mtime_ns, inode)) for path, size, mtime_ns, inode in conn.execute(
+            f'''SELECT path, size, mtime_ns, inode FROM scan_state
+                WHERE path IN ({', '.join('?' * len(chunk))}) AND (kind != 'video_hashes' OR hash_algorithm = ?)''',
+            chunk + [video_algorithm],
+        ))
+    images = []
+    videos = []
+    for entry in entries:
+        if known.get(entry[0]) == entry[1:]:
+            continue
+        is_video = os.path.splitext(entry[0])[1].lower() in DC.VIDEO_EXTENSIONS
+        (videos if is_video else images).append(entry)
+    lease.files = len(entries)
+    if metrics is not None:
+        metrics.incr('skipped', len(entries) - len(images) - len(videos))
+    return images, videos
+
+
+def hash_unit_batch(item, timings=None, fast_decode=DC.FAST_DECODE, thumbnail_cache=None):
+    """
+    Pool task for one (unit_id, entries) item of images: their pHashes (see
+    dupchecker.process_image_batch), one row (or None) per entry.
+    """
+    return DC.process_image_batch(item[1], fast_decode, timings, thumbnail_cache)
+
+
+def register_worker(conn, worker_id):
+    now = time.time()
+    with conn:
+        conn.execute('''
+            INSERT INTO queue_workers (worker_id, host, pid, started_at, heartbeat, state) VALUES (?, ?, ?, ?, ?, 'working')
+            ON CONFLICT (worker_id) DO UPDATE SET pid = excluded.pid, heartbeat = excluded.heartbeat, state = 'working'
+        ''', (worker_id, socket.gethostname(), os.getpid(), now, now))
+
+
+def set_worker_state(conn, worker_id, state):
+    with conn:
+        conn.execute('UPDATE queue_workers SET state = ?, heartbeat = ? WHERE worker_id = ?', (state, time.time(), worker_id))
+
+
+def work(db_name='imagehash.db', worker_id=None, processes=1, chunksize=DC.PHASH_BATCH_SIZE, fast_decode=DC.FAST_DECODE,
+         thumbnail_cache=None, metrics_path=None, wait=True, lease_seconds=LEASE_SECONDS):
+    """
+    Claims and hashes units from db_name's queue until none are left. Any
+    number of workers can run at once and join or leave at any time.
+
+    Each worker hashes with a pool of processes, claiming the next unit while
+    the last batches of the current one are still in the pool. With wait,
+    a worker that runs out of units stays until the units other workers hold
+    are done, taking over any whose lease (lease_seconds, renewed while
+    the worker is alive) expires. SIGINT/SIGTERM stop
+    claiming, commit the units already hashed and hand the rest back.
+    """
+    conn = connect_queue(db_name)
+    try:
+        settings = queue_settings(conn)
+        if settings is None:
+            print(f"No work queue in {db_name}; run plan first")
+            return
+        folder = settings['queue_folder']
+        include, exclude = json.loads(settings['queue_filters'])
+        video_algorithm = settings['queue_video_hash']
+        worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        register_worker(conn, worker_id)
+        held = {}
+        state = 'failed'
+        last_renewal = time.monotonic()
+
+        def keep_leases():
+            nonlocal last_renewal
+            if held and time.monotonic() - last_renewal >= lease_seconds * RENEW_FRACTION:
+                renew_leases(conn, worker_id, held.values(), lease_seconds)
+                last_renewal = time.monotonic()
+
+        def finish(lease):
+            del held[lease.unit_id]
+            if complete_unit(conn, lease, worker_id, metrics):
+                metrics.incr('units')
+
+        def unit_batches():
+            while not stop_event.is_set():
+                keep_leases()
+                lease = claim_unit(conn, worker_id, lease_seconds)
+                if lease is None:
+                    return
+                held[lease.unit_id] = lease
+                images, videos = unit_entries(conn, lease, folder, include, exclude, video_algorithm, metrics)
+                # Videos are read by finish, and only those whose size another video shares.
+                lease.batches['video_hashes'].extend(DC.video_row(entry, None, 'size', video_algorithm) for entry in videos)
+                lease.videos.extend((entry[0], entry[1]) for entry in videos)
+                tasks = list(DC.chunked(images, chunksize))
+                lease.tasks_left = len(tasks)
+                if not tasks:
+                    finish(lease)
+                for task in tasks:
+                    yield lease.unit_id, task
+
+        with MET.track(f'worker {worker_id}', snapshot_path=metrics_path) as metrics, DC.StopRequest() as stop_event, \
+                ProcessPoolExecutor(max_workers=processes, initializer=DC.init_worker, initargs=(chunksize,)) as executor:
+            metrics.set_gauge('workers', processes)
+            hash_batch = partial(MET.call_with_timings, hash_unit_batch, fast_decode=fast_decode,
+                                 thumbnail_cache=thumbnail_cache)
+            try:
+                while True:
+                    for (unit_id, entries), (results, timings) in DC.map_ordered_bounded(
+                            executor, hash_batch, unit_batches(), processes * 2, stop_event, metrics):
+                        metrics.observe_many(timings)
+                        metrics.incr('files', len(entries))
+                        lease = held[unit_id]
+                        for result in results:
+                            if result is not None:
+                                lease.batches[result[0]].append(result[1:])
+                        lease.tasks_left -= 1
+                        if not lease.tasks_left:
+                            finish(lease)
+                        keep_leases()
+                    if stop_event.is_set():
+                        break
+                    counts = unit_counts(conn)
+                    if not wait or ('pending' not in counts and 'leased' not in counts):
+                        break
+                    # Other workers still hold units; one of them may die and leave its lease to expire.
+                    if stop_event.wait(POLL_INTERVAL):
+                        break
+                state = 'stopped' if stop_event.is_set() else 'finished'
+            finally:
+                if held:
+                    release_units(conn, worker_id, list(held.values()), None if state == 'stopped' else 'worker failed')
+                set_worker_state(conn, worker_id, state)
+        print(f"Worker {worker_id} {state}: {metrics.counters.get('units', 0)} units, "
+              f"{metrics.counters.get('files', 0)} files hashed, {metrics.counters.get('skipped', 0)} unchanged")
+    finally:
+        conn.close()
+
+
+def restage_videos(conn, folder, executor, algorithm, batch_size=DC.DEFAULT_BATCH_SIZE, metrics=None):
+    """
+    Units do not read their videos, so none of them has been compared yet.
+    Runs dupchecker's staged video hashing over every video under folder
+    that shares its size with one recorded by a unit.
+    """
+    prefix = os.path.join(folder, '')
+    entries = conn.execute('''
+        SELECT path, size, mtime_ns, inode FROM scan_state
+        WHERE kind = 'video_hashes' AND substr(path, 1, ?) = ? AND size IN (
+            SELECT size FROM scan_state WHERE kind = 'video_hashes' AND substr(path, 1, ?) = ?
+              AND size IN (SELECT size FROM queue_videos)
+            GROUP BY size HAVING count(*) > 1
+        )
+    ''', (len(prefix), prefix, len(prefix), prefix)).fetchall()
+    batches = {'hashes': [], 'video_hashes': [], 'exact_duplicates': []}
+    for row in DC.hash_videos_staged(executor, entries, metrics=metrics, algorithm=algorithm):
+        DC.stage_row(conn, batches, 'video_hashes', row, batch_size, metrics=metrics)
+    DC.flush_batches(conn, batches, metrics=metrics)
+    return len(entries)
+
+
+def finish_queue(db_name='imagehash.db', max_workers=2, force=False):
+    """
+    Completes a queue whose units are all done: re-stages videos that share
+    a size across units, rebuilds representatives for pruned or changed
+    files, completes the scan run and drops the queue tables' rows.
+    Units that failed are listed; their files are picked up by the next scan.
+    With force, units still pending or leased are abandoned the same way.
+    """
+    conn = connect_queue(db_name)
+    try:
+        settings = queue_settings(conn)
+        if settings is None:
+            print(f"No work queue in {db_name}")
+            return False
+        counts = unit_counts(conn)
+        if ('pending' in counts or 'leased' in counts) and not force:
+            print_status(conn)
+            print("Units are still pending or leased; wait for the workers (or use --force)")
+            return False
+        folder = settings['queue_folder']
+        run_id = int(settings['queue_run_id'])
+
+        with MET.track('queue finish') as metrics, \
+                ProcessPoolExecutor(max_workers=max_workers, initializer=DC.init_worker) as executor:
+            restaged = restage_videos(conn, folder, executor, settings['queue_video_hash'], metrics=metrics)
+        DC.promote_orphaned_duplicates(conn)
+
+        print_status(conn)
+        unfinished = conn.execute(
+            "SELECT w.unit_id, d.directory, w.state, w.error FROM work_units AS w JOIN unit_dirs AS d USING (unit_id) "
+            "WHERE w.state != 'done' ORDER BY w.unit_id, d.directory"
+        ).fetchall()
+        for unit_id, directory, state, error in unfinished:
+            print(f"  unit {unit_id} {state}: {directory}{f' ({error})' if error else ''}")
+        walk_failures = json.loads(settings.get('queue_walk_failures', '[]'))
+        for path in walk_failures:
+            print(f"  unreadable when planned: {path}")
+        errors = []
+        if unfinished:
+            errors.append(f"{len(unfinished)} directories not hashed")
+        if walk_failures:
+            errors.append(f"could not read {len(walk_failures)} paths: " + ', '.join(walk_failures[:10]))
+        DC.finish_run(conn, run_id, 'failed' if errors else 'completed', '; '.join(errors) or None)
+        with conn:
+            for table_name in ('work_units', 'unit_dirs', 'queue_workers', 'queue_videos'):
+                conn.execute(f'DELETE FROM {table_name}')
+            conn.executemany('DELETE FROM meta WHERE key = ?', [(key,) for key in QUEUE_META_KEYS])
+        print(f"Finished the queue for {folder}: re-staged {restaged} same-size videos"
+              f"{f', {len(unfinished)} directories left for the next scan' if unfinished else ''}")
+        return True
+    finally:
+        conn.close()
+
+
+def print_status(conn):
+    counts = unit_counts(conn)
+    total_units = sum(units for units, _ in counts.values())
+    total_files = sum(files or 0 for _, files in counts.values())
+    print(f"{total_units} units, {total_files} files: " + ", ".join(
+        f"{state} {units} ({files or 0} files)" for state, (units, files) in sorted(counts.items())
+    ))
+    now = time.time()
+    for worker_id, state, units, files, started_at, heartbeat in conn.execute(
+            'SELECT worker_id, state, units, files, started_at, heartbeat FROM queue_workers ORDER BY started_at'):
+        elapsed = (heartbeat - started_at) if heartbeat and started_at else 0
+        print(f"  {worker_id:<32} {state:<9} {units:>6} units {files:>9} files "
+              f"{files / elapsed if elapsed else 0:8.1f} files/s  last seen {now - heartbeat:.0f}s ago")
+
+
+def run_local(folder, db_name='imagehash.db', workers=2, processes=1, include=(), exclude=(), thumbnail_cache=None):
+    """plan, then workers local worker processes, then finish: the whole queue on this machine."""
+    if not plan_queue(folder, db_name, include, exclude):
+        return
+    start = time.perf_counter()
+    command = [sys.executable, os.path.abspath(__file__), 'work', '--db', db_name, '--processes', str(processes)]
+    if thumbnail_cache:
+        command += ['--thumbnail-cache', thumbnail_cache]
+    host = socket.gethostname()
+    children = [subprocess.Popen(command + ['--worker-id', f"{host}:local{number}"]) for number in range(workers)]
+    try:
+        for child in children:
+            child.wait()
+    except KeyboardInterrupt:
+        # The workers got the same SIGINT; let them hand back their units.
+        for child in children:
+            child.wait()
+        print("Interrupted; run plan/work again to continue the queue")
+        return
+    elapsed = time.perf_counter() - start
+    conn = connect_queue(db_name)
+    try:
+        files = conn.execute('SELECT coalesce(sum(files), 0) FROM queue_workers').fetchone()[0]
+    finally:
+        conn.close()
+    print(f"{workers} workers x {processes} processes: {files} files in {elapsed:.2f}s, {files / elapsed if elapsed else 0:.1f} files/s")
+    finish_queue(db_name, max(workers * processes, 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share one scan between worker processes on one or more hosts.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plan = commands.add_parser('plan', help="Walk the folder and queue it as work units")
+    plan.add_argument('folder')
+    plan.add_argument('--unit-files', type=int, default=UNIT_FILES, help="Media files per work unit")
+    plan.add_argument('--shared', action='store_true', help="Workers on other hosts will use the database (no WAL)")
+    plan.add_argument('--source', metavar='ID', help="Source ID the database is tagged with for mergeshards")
+    run = commands.add_parser('run', help="plan, local workers, finish")
+    run.add_argument('folder')
+    run.add_argument('--workers', type=int, default=2, help="Worker processes to start")
+    worker = commands.add_parser('work', help="Hash units until the queue is empty")
+    worker.add_argument('--worker-id', help="Name in the queue (default host:pid)")
+    worker.add_argument('--no-wait', action='store_true', help="Exit when no unit is free instead of waiting for expired leases")
+    worker.add_argument('--metrics', metavar='PATH', help="Write a metrics snapshot here")
+    worker.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS, help="Lease length; another worker takes over a unit after it")
+    finish = commands.add_parser('finish', help="Complete the scan once every unit is done")
+    finish.add_argument('--workers', type=int, default=2, help="Processes for the video re-staging")
+    finish.add_argument('--force', action='store_true', help="Finish even with units pending or leased")
+    status = commands.add_parser('status', help="Show units and workers")
+    for command in (plan, run):
+        command.add_argument('--include', action='append', default=[], metavar='GLOB', help="Only queue matching files (repeatable)")
+        command.add_argument('--exclude', action='append', default=[], metavar='GLOB', help="Skip matching files and directories (repeatable)")
+    for command in (run, worker):
+        command.add_argument('--processes', type=int, default=1, help="Hashing processes per worker")
+        command.add_argument('--thumbnail-cache', metavar='PATH', help="Thumbnail cache database (one per host)")
+    for command in (plan, run, worker, finish, status):
+        command.add_argument('--db', default='imagehash.db', help="Scan database holding the queue")
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan':
+        plan_queue(args.folder, args.db, args.include, args.exclude, args.unit_files, source_id=args.source, shared=args.shared)
+    elif args.command == 'run':
+        run_local(args.folder, args.db, args.workers, args.processes, args.include, args.exclude, args.thumbnail_cache)
+    elif args.command == 'work':
+        work(args.db, args.worker_id, args.processes, thumbnail_cache=args.thumbnail_cache,
+             metrics_path=args.metrics, wait=not args.no_wait, lease_seconds=args.lease_seconds)
+    elif args.command == 'finish':
+        finish_queue(args.db, args.workers, args.force)
+    else:
+        conn = connect_queue(args.db)
+        try:
+            if queue_settings(conn) is None:
+                print(f"No work queue in {args.db}")
+            else:
+                print_status(conn)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()